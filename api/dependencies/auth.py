@@ -0,0 +1,17 @@
+import hmac
+from typing import Optional
+
+from fastapi import Header, HTTPException
+from starlette.status import HTTP_403_FORBIDDEN
+
+from core.config import OPERATOR_TOKEN
+
+
+def require_operator(x_operator_token: Optional[str] = Header(None)) -> None:
+    """
+    Operator endpoints act on any chat, the visitor's x-session-id is not
+    enough for them. Without OPERATOR_TOKEN configured they stay closed.
+    """
+    token = str(OPERATOR_TOKEN)
+    if not token or not x_operator_token or not hmac.compare_digest(x_operator_token, token):
+        raise HTTPException(status_code=HTTP_403_FORBIDDEN, detail="Operator token required.")
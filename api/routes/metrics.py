@@ -0,0 +1,10 @@
+from fastapi import APIRouter, Response
+
+from core.metrics import registry, METRICS_PATH, CONTENT_TYPE
+
+router = APIRouter()
+
+
+@router.get(METRICS_PATH, name='metrics', include_in_schema=False)
+async def metrics():
+    return Response(registry.render(), media_type=CONTENT_TYPE)
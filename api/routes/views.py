@@ -1,25 +1,48 @@
 import asyncio
-from typing import List
+from typing import Dict, List, Optional, Set
 
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Request, Depends, HTTPException, Body
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Request, Depends, HTTPException, Body, Query, \
+    Response
 from loguru import logger
-from starlette.status import HTTP_400_BAD_REQUEST
+from starlette.status import HTTP_400_BAD_REQUEST, HTTP_304_NOT_MODIFIED
 
-from api.dependencies.database import get_repository, get_ws_repository
+from api.dependencies.auth import require_operator
+from api.dependencies.database import get_repository, get_ws_repository, get_agent_repository
+from core.clients.queue_services import rabbit_publisher
+from core.config import WS_SEND_QUEUE_SIZE, WS_SLOW_CONSUMER_POLICY
 from core.exceptions import ConnectionErrorException
-from db.models import UserChat, UserForm
-from db.repositories.models import UserRepository
+from core.metrics import ws_connects, ws_disconnects, ws_active
+from core.realtime.delivery import SocketConnection, delivery_stats, message_frame
+from core.realtime.presence import PresenceRegistry, presence
+from db.models import UserChat, UserForm, ChatBootstrap, AgentBroadcast, BroadcastResult
+from db.repositories.models import UserRepository, AgentRepository
 
 router = APIRouter()
 
+# only what the widget renders of the visitor, contact details and context stay server side
+BOOTSTRAP_INCLUDE = {"channel_id": ..., "direction": ..., "intro": ..., "last_agent": ..., "history": ...,
+                     "chat": {"name", "lang", "is_default"}}
+BOOTSTRAP_EXCLUDE = {"last_agent": {"id", "chat_id"},
+                     "history": {"__all__": {"id", "chat_id"}}}
+
 
 class SocketManager:
-    def __init__(self):
-        self.active_connections: List[(WebSocket, str)] = []
+    def __init__(self, registry: PresenceRegistry = presence):
+        self.registry = registry
+
+    @property
+    def active_connections(self) -> Dict[str, Set[SocketConnection]]:
+        return self.registry.connections
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
 
+    async def register(self, channel: str, connection: SocketConnection):
+        await self.registry.join(channel, connection)
+
+    async def unregister(self, channel: str, connection: SocketConnection):
+        await self.registry.leave(channel, connection)
+
 
 manager = SocketManager()
 
@@ -36,30 +59,58 @@ async def receiving(websocket):
 async def chat(
         channel: str,
         websocket: WebSocket,
+        last_event_id: Optional[str] = Query(None),
+        since: Optional[int] = Query(None),
         users_repo: UserRepository = Depends(get_ws_repository(UserRepository))):
 
-    await manager.connect(websocket)
-    pubsub = websocket.app.state.db.redis.pubsub()
-    ws_status = asyncio.ensure_future(
-         receiving(websocket)
-    )
-
-    chat_info = await users_repo.check_chat_info()
-    if not chat_info:
-        await websocket.close()
-        raise ConnectionErrorException()
-
-    async with pubsub as p:
-        await p.subscribe(channel)
-        asyncio.ensure_future(
-            users_repo.initial_pass_chat_info(ch_info=chat_info)
+    hub = websocket.app.state.hub
+    connection = ws_status = sender = None
+    try:
+        await manager.connect(websocket)
+        connection = SocketConnection(websocket, max_queue=WS_SEND_QUEUE_SIZE, policy=WS_SLOW_CONSUMER_POLICY)
+        ws_status = asyncio.ensure_future(
+             receiving(websocket)
         )
-        while True:
-            if ws_status.done() or ws_status.cancelled():
-                break
-            msg = await pubsub.get_message(ignore_subscribe_messages=True)
-            if msg and msg.get('data'):
-                await websocket.send_json(msg)
+        chat_info = await users_repo.check_chat_info()
+        if not chat_info:
+            await websocket.close()
+            raise ConnectionErrorException()
+
+        replay = websocket.app.state.db.replay
+        position = replay.position(last_event_id, since)
+        if position:
+            connection.hold()
+        # returns once Redis confirmed the subscription, the intro goes to this socket only
+        await hub.subscribe(channel, connection.push)
+        await manager.register(channel, connection)
+        ws_connects.inc()
+        ws_active.inc()
+        sender = asyncio.ensure_future(connection.run())
+
+        # a reconnect gets what it missed, or the whole chat once that is no longer buffered
+        missed = await replay.since(channel, position) if position else None
+        if missed is not None:
+            connection.resume(missed, position)
+        else:
+            connection.resume()
+            bootstrap = await users_repo.get_bootstrap(ch_info=chat_info)
+            frame = bootstrap.json(include=BOOTSTRAP_INCLUDE, exclude=BOOTSTRAP_EXCLUDE)
+            connection.push(message_frame(channel, frame))
+            connection.push(message_frame(channel, await users_repo.initial_pass_chat_info(ch_info=chat_info,
+                                                                                            intro=bootstrap.intro)))
+        await asyncio.wait({ws_status, sender}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        if sender:
+            ws_disconnects.inc()
+            ws_active.dec()
+            sender.cancel()
+        if ws_status:
+            ws_status.cancel()
+        if connection:
+            # both are no-ops for a channel that never got this connection
+            await hub.unsubscribe(channel, connection.push)
+            await manager.unregister(channel, connection)
+            connection.close()
 
 
 @router.post("/user/publish", name='user-publish', status_code=201)
@@ -76,6 +127,23 @@ async def chat_publish(
     return {"success": 1}
 
 
+@router.post("/agent/broadcast", response_model=List[BroadcastResult], name='agent-broadcast', status_code=201,
+             dependencies=[Depends(require_operator)])
+async def agent_broadcast(
+        broadcast: AgentBroadcast = Body(...),
+        agents_repo: AgentRepository = Depends(get_agent_repository(AgentRepository))):
+
+    session_ids = broadcast.session_ids
+    if broadcast.online:
+        online = (await manager.registry.online())['sessions']
+        session_ids = online if session_ids is None else list(filter(set(online).__contains__, session_ids))
+    if session_ids is None:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Pass session_ids or online.")
+
+    return await agents_repo.broadcast(name=broadcast.name, message=broadcast.message,
+                                       session_ids=session_ids, avatar=broadcast.avatar)
+
+
 @router.post("/update", name='form-update', status_code=201)
 async def chat_update(
         user_form: UserForm = Body(...),
@@ -100,3 +168,92 @@ async def chat_update(
 async def chat_history(
         users_repo: UserRepository = Depends(get_repository(UserRepository))):
     return await users_repo.get_last_chat_history()
+
+
+@router.get("/bootstrap",
+            response_model=ChatBootstrap,
+            name='chat-bootstrap',
+            response_model_include=BOOTSTRAP_INCLUDE,
+            response_model_exclude=BOOTSTRAP_EXCLUDE,
+            status_code=200)
+async def chat_bootstrap(
+        users_repo: UserRepository = Depends(get_repository(UserRepository))):
+    return await users_repo.get_bootstrap()
+
+
+@router.get("/history/page",
+            response_model=List[UserChat],
+            name='chat-history-page',
+            response_model_exclude={"chat_id"},
+            status_code=200)
+async def chat_history_page(
+        request: Request,
+        response: Response,
+        before_id: Optional[int] = Query(None, gt=0),
+        after_id: Optional[int] = Query(None, gt=0),
+        limit: int = Query(15, ge=1, le=50),
+        users_repo: UserRepository = Depends(get_repository(UserRepository))):
+
+    if before_id and after_id:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Pass either before_id or after_id.")
+
+    etag = await users_repo.get_history_etag(before_id=before_id, after_id=after_id, limit=limit)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in map(str.strip, request.headers.get('if-none-match', '').split(',')):
+        return Response(status_code=HTTP_304_NOT_MODIFIED, headers=headers)
+
+    response.headers.update(headers)
+    return await users_repo.get_chat_history_page(before_id=before_id, after_id=after_id, limit=limit)
+
+
+@router.get("/stats/delivery", name='delivery-stats', status_code=200)
+async def delivery_statistics():
+    return delivery_stats.snapshot()
+
+
+@router.get("/presence", name='presence', status_code=200)
+async def presence_online():
+    # session ids give access to the chats, only operators see them
+    online = await manager.registry.online()
+    return {"online": online["online"], "nodes": len(online["nodes"])}
+
+
+@router.get("/agent/presence", name='agent-presence', status_code=200, dependencies=[Depends(require_operator)])
+async def presence_sessions():
+    return await manager.registry.online()
+
+
+@router.get("/stats/presence", name='presence-stats', status_code=200)
+async def presence_statistics():
+    return manager.registry.snapshot()
+
+
+@router.get("/stats/pubsub", name='pubsub-stats', status_code=200)
+async def pubsub_statistics(request: Request):
+    return {**request.app.state.db.pubsub.snapshot(), "channels": request.app.state.hub.snapshot()}
+
+
+@router.get("/stats/replay", name='replay-stats', status_code=200)
+async def replay_statistics(request: Request):
+    return request.app.state.db.replay.snapshot()
+
+
+@router.get("/stats/rabbit", name='rabbit-stats', status_code=200)
+async def rabbit_statistics():
+    return rabbit_publisher.snapshot()
+
+
+@router.get("/stats/archive", name='archive-stats', status_code=200)
+async def archive_statistics(request: Request):
+    return request.app.state.db.archiver.snapshot()
+
+
+# the slow query log carries bound values
+@router.get("/stats/queries", name='query-stats', status_code=200, dependencies=[Depends(require_operator)])
+async def query_statistics(request: Request):
+    return request.app.state.db.db.snapshot()
+
+
+@router.get("/stats/session-cache", name='session-cache-stats', status_code=200)
+async def session_cache_statistics(request: Request):
+    return request.app.state.db.sessions.snapshot()
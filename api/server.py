@@ -6,10 +6,13 @@ from fastapi.middleware.cors import CORSMiddleware
 from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
 
 from api.routes import router as api_router
+from api.routes.metrics import router as metrics_router
 from core import tasks
 from core.middlewares.authenticator import AuthenticateMiddleware
 from core.middlewares.botblock import BotBlockMiddleware
 from core.middlewares.errorhandler import WebsocketErrorHandlerMiddleware
+from core.middlewares.metrics import MetricsMiddleware
+from core.middlewares.ratelimit import RateLimitMiddleware
 
 
 def get_application():
@@ -29,11 +32,14 @@ def get_application():
     app.add_event_handler("startup", tasks.create_start_app_handler(app))
     app.add_event_handler("shutdown", tasks.create_stop_app_handler(app))
 
+    app.add_middleware(RateLimitMiddleware)
     app.add_middleware(BotBlockMiddleware)
     app.add_middleware(AuthenticateMiddleware)
     app.add_middleware(WebsocketErrorHandlerMiddleware)
+    app.add_middleware(MetricsMiddleware)
 
     app.include_router(api_router, prefix="/ws")
+    app.include_router(metrics_router)
 
     return app
 
@@ -1,9 +1,13 @@
-from collections import deque
+import codecs
+import re
+from typing import Any, Callable, List, Union
 
-import requests
 from fastapi import Request
 from loguru import logger
 
+from core import serialization
+from core.geoip import geoip
+
 PROPERTY_FULL_TYPES = [
     "Apartment",
     "Penthouse",
@@ -24,13 +28,14 @@ PROPERTY_FULL_TYPES = [
     "Hotel"
 ]
 
+_STRUCTURE_TOKENS = re.compile(r'[{}\[\]"]')
+_STRING_TOKENS = re.compile(r'["\\]')
+_STRING_REST = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_NON_SPACE = re.compile(r'\S')
 
-def get_ip_info(ip):
-    req = requests.get(f'http://ip-api.com/json/{ip}')
-    if req.status_code == 200:
-        return req.json()
 
-    return None
+def get_ip_info(ip):
+    return geoip.lookup(ip)
 
 
 def get_client_ip(request: Request):
@@ -45,33 +50,103 @@ def get_client_ip(request: Request):
     return ip
 
 
-def json_fixer(js_str: str):
-    indexes_js = {}
-    queue = deque()
-    result = set()
-
+class JSONStreamDecoder:
+    """
+    Splits concatenated JSON documents, e.g. '{"foo": "bar"}{"foo": "zulu"}',
+    fed in chunks as they arrive. Completed documents are returned in order,
+    only the unfinished one is kept and it may not grow over max_frame_size.
+    """
+
+    def __init__(self, max_frame_size: int = 1024 * 1024, loads: Callable = serialization.loads) -> None:
+        self.max_frame_size = max_frame_size
+        self.loads = loads
+        self.reset()
+
+    def reset(self) -> None:
+        self.pending = ''
+        self.scanned = 0
+        self.depth = 0
+        self.in_string = False
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def feed(self, chunk: Union[str, bytes]) -> List[Any]:
+        return [self.loads(frame) for frame in self.split(chunk)]
+
+    def split(self, chunk: Union[str, bytes]) -> List[str]:
+        if isinstance(chunk, bytes):
+            chunk = self._decoder.decode(chunk)
+
+        text = self.pending + chunk
+        start, pos, frames = 0, self.scanned, []
+        while pos < len(text):
+            if self.in_string:
+                match = _STRING_TOKENS.search(text, pos)
+                if not match:
+                    pos = len(text)
+                elif match.group() == '"':
+                    self.in_string = False
+                    pos = match.end()
+                elif match.end() < len(text):
+                    pos = match.end() + 1
+                else:
+                    # the escaped character is in the next chunk
+                    pos = match.start()
+                    break
+                continue
+
+            if not self.depth:
+                match = _NON_SPACE.search(text, pos)
+                if not match:
+                    start = pos = len(text)
+                    break
+                if match.group() not in '{[':
+                    self.reset()
+                    raise ValueError(f"Unexpected {match.group()!r} between JSON documents")
+                start = match.start()
+
+            match = _STRUCTURE_TOKENS.search(text, pos)
+            if not match:
+                pos = len(text)
+                break
+
+            token, pos = match.group(), match.end()
+            if token == '"':
+                literal = _STRING_REST.match(text, pos)
+                if literal:
+                    pos = literal.end()
+                else:
+                    self.in_string = True
+            elif token in '{[':
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if not self.depth:
+                    frames.append(text[start:pos])
+                    start = pos
+
+        self.pending, self.scanned = text[start:], pos - start
+        if len(self.pending) > self.max_frame_size:
+            self.reset()
+            raise ValueError(f"JSON document exceeds {self.max_frame_size} characters")
+        return frames
+
+    def close(self) -> None:
+        pending = self.pending.strip()
+        self.reset()
+        if pending:
+            raise ValueError(f"Truncated JSON document: {pending[:50]}")
+
+
+def json_fixer(js_str: str) -> List[str]:
+    decoder = JSONStreamDecoder(max_frame_size=len(js_str) + 1)
     try:
-        for i, c in enumerate(js_str):
-            if c == '{':
-                queue.append(i)
-            elif c == '}':
-                if len(queue) == 0:
-                    raise IndexError("No matching closing parens at: " + str(i))
-                indexes_js[queue.pop()] = i
-
-        if len(queue) > 0:
-            raise IndexError("No matching opening parens at: " + str(queue.pop()))
-
-        start_idx = 0
-        while indexes_js.get(start_idx):
-            vl = indexes_js[start_idx]
-            pjs = js_str[start_idx:vl + 1]
-            result.add(pjs)
-            start_idx = vl + 1
-    except Exception as err:
+        frames = decoder.split(js_str)
+        decoder.close()
+    except ValueError as err:
         logger.exception(err)
+        return []
 
-    return result
+    return frames
 
 
 def create_colored_png(webhexcolor):
@@ -0,0 +1,389 @@
+"""
+End-to-end latency and fan-out of the chat pipeline: user publishes and
+operator broadcasts over HTTP, delivered to websocket subscribers through
+Redis pub/sub, against a uvicorn worker started from get_application.
+
+    python -m benchmarks.e2e --sessions 200 --tabs 2 --rate 200 --duration 10
+    python -m benchmarks.e2e --redis-url redis://localhost/15 --output after.json --compare before.json
+
+Without --redis-url the worker runs on the in-process Redis stand-in from
+tests/fakes.py; the database is always a throwaway SQLite file. Results are
+written as JSON, --compare prints the change against an earlier run.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import deque
+from typing import Dict, List, Optional
+
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) chat-benchmark"
+STATS_PATH = "/ws/api/bench/stats"
+MARKER = "bench"
+OPERATOR_TOKEN = uuid.uuid4().hex
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))], 3)
+
+
+def resident_memory() -> int:
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# --- worker side -------------------------------------------------------------
+
+class LoopLagMonitor:
+    """
+    How late the event loop wakes up a task sleeping for ``interval``.
+    """
+
+    def __init__(self, interval: float = 0.02) -> None:
+        self.interval = interval
+        self.lags = deque(maxlen=100000)
+
+    async def run(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append((loop.time() - started - self.interval) * 1000)
+
+    def snapshot(self, reset: bool = False) -> dict:
+        lags = list(self.lags)
+        if reset:
+            self.lags.clear()
+        return {"p50_ms": percentile(lags, 50), "p99_ms": percentile(lags, 99),
+                "max_ms": round(max(lags), 3) if lags else None}
+
+
+def in_process_redis():
+    from tests.fakes import FakeRedis, FakePubSub
+
+    class StandInPubSub(FakePubSub):
+        """
+        Wakes up on the next message instead of polling every timeout.
+        """
+
+        async def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+            if self.messages.empty() and timeout:
+                getter = asyncio.ensure_future(self.messages.get())
+                try:
+                    await asyncio.wait({getter}, timeout=timeout)
+                finally:
+                    getter.cancel()
+                if not getter.cancelled() and getter.done():
+                    message = getter.result()
+                    if ignore_subscribe_messages and message['type'] != 'message':
+                        return None
+                    return message
+            return await super().get_message(ignore_subscribe_messages, 0.0)
+
+    class StandInRedis(FakeRedis):
+        def pubsub(self):
+            pubsub = StandInPubSub(self)
+            self.pubsubs.append(pubsub)
+            return pubsub
+
+        async def close(self):
+            pass
+
+    return StandInRedis()
+
+
+async def serve(port: int, redis_url: Optional[str]) -> None:
+    import uvicorn
+    from databases import Database
+
+    from api.server import get_application
+    from core.clients.crm import crm_outbox
+    from core.config import DATABASE_URL_TEST
+    from db import tasks as db_tasks
+    from db.migrations import migrate
+
+    database = Database(DATABASE_URL_TEST)
+    await database.connect()
+    await migrate(database)
+    await database.execute("INSERT INTO tropico_welcomes (name, message, lang, created_at) "
+                           "VALUES ('Anna', 'Hello!', 'en', 0)")
+    await database.execute("INSERT INTO tropico_intro (message, quick_replies, lang) "
+                           "VALUES ('How can we help?', '[\"Buy\"]', 'en')")
+    await database.disconnect()
+
+    if not redis_url:
+        redis = in_process_redis()
+
+        async def from_url(*args, **kwargs):
+            return redis
+
+        db_tasks.from_url = from_url
+
+    async def crm_sink(event: dict) -> bool:
+        return True
+
+    crm_outbox.send = crm_sink
+
+    monitor = LoopLagMonitor()
+    app = get_application()
+
+    async def bench_stats(reset: bool = False):
+        return {"rss": resident_memory(), "loop_lag": monitor.snapshot(reset)}
+
+    app.add_api_route(STATS_PATH, bench_stats)
+
+    config = uvicorn.Config(app, host="127.0.0.1", port=port, ws="websockets", log_level="warning",
+                            lifespan="on")
+    server = uvicorn.Server(config)
+    lag = asyncio.ensure_future(monitor.run())
+    try:
+        await server.serve()
+    finally:
+        lag.cancel()
+
+
+# --- load side ---------------------------------------------------------------
+
+class Subscriber:
+    def __init__(self, session_id: str) -> None:
+        self.session_id = session_id
+        self.latencies: List[float] = []
+        self.frames = 0
+        self.ready = asyncio.Event()
+
+    async def run(self, base_url: str) -> None:
+        import websockets
+
+        url = f"{base_url.replace('http', 'ws', 1)}/ws/api/subscribe/{self.session_id}"
+        async with websockets.connect(url, extra_headers={"User-Agent": USER_AGENT}, max_queue=None) as ws:
+            async for data in ws:
+                received = time.time()
+                self.frames += 1
+                # bootstrap first, then the intro once the subscription is confirmed
+                if self.frames == 2:
+                    self.ready.set()
+                message = json.loads(data).get("message") or ""
+                if message.startswith(MARKER):
+                    self.latencies.append((received - float(message.split(":")[2])) * 1000)
+
+
+class LoadGenerator:
+    def __init__(self, args: argparse.Namespace, base_url: str) -> None:
+        self.args = args
+        self.base_url = base_url
+        self.sessions = [f"{MARKER}-{i}-{uuid.uuid4()}" for i in range(args.sessions)]
+        self.subscribers = [Subscriber(session_id) for session_id in self.sessions for _ in range(args.tabs)]
+        self.published = {"user": 0, "operator": 0}
+        self.failed = 0
+
+    @staticmethod
+    def headers(session_id: str) -> Dict[str, str]:
+        return {"x-session-id": session_id, "user-agent": USER_AGENT}
+
+    async def stats(self, client, reset: bool = False) -> dict:
+        response = await client.get(STATS_PATH, params={"reset": reset}, headers=self.headers(MARKER))
+        return response.json()
+
+    async def publish(self, client, seq: int) -> None:
+        session_id = self.sessions[seq % len(self.sessions)]
+        message = f"{MARKER}:{seq}:{time.time()!r}"
+        operator = random.random() < self.args.operator_share
+        try:
+            if operator:
+                response = await client.post("/ws/api/agent/broadcast",
+                                             headers={**self.headers(session_id), "x-operator-token": OPERATOR_TOKEN},
+                                             json={"name": "Maria", "message": message, "session_ids": [session_id]})
+            else:
+                response = await client.post("/ws/api/user/publish", headers=self.headers(session_id),
+                                             json={"message": message})
+            response.raise_for_status()
+            self.published["operator" if operator else "user"] += 1
+        except Exception:
+            self.failed += 1
+
+    async def run(self) -> dict:
+        import httpx
+
+        limits = httpx.Limits(max_connections=self.args.concurrency, max_keepalive_connections=self.args.concurrency)
+        async with httpx.AsyncClient(base_url=self.base_url, limits=limits, timeout=30) as client:
+            for session_id in self.sessions:
+                (await client.get("/ws/api/bootstrap", headers=self.headers(session_id))).raise_for_status()
+
+            idle = await self.stats(client)
+            listeners = [asyncio.ensure_future(subscriber.run(self.base_url)) for subscriber in self.subscribers]
+            await asyncio.wait_for(asyncio.gather(*(s.ready.wait() for s in self.subscribers)), timeout=60)
+            connected = await self.stats(client, reset=True)
+
+            # fixed schedule, a slow response does not hold back the next publish
+            started = time.perf_counter()
+            total = int(self.args.rate * self.args.duration)
+            publishes = []
+            for seq in range(total):
+                delay = started + seq / self.args.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                publishes.append(asyncio.ensure_future(self.publish(client, seq)))
+            await asyncio.gather(*publishes)
+            sent_in = time.perf_counter() - started
+
+            expected = (total - self.failed) * self.args.tabs
+            deadline = time.perf_counter() + self.args.drain
+            while self.delivered < expected and time.perf_counter() < deadline:
+                await asyncio.sleep(0.05)
+            elapsed = time.perf_counter() - started
+            loaded = await self.stats(client)
+
+            for listener in listeners:
+                listener.cancel()
+            await asyncio.gather(*listeners, return_exceptions=True)
+
+        latencies = [latency for subscriber in self.subscribers for latency in subscriber.latencies]
+        connections = len(self.subscribers)
+        return {
+            "published": self.published,
+            "failed": self.failed,
+            "publish_rate": round(total / sent_in, 1),
+            "delivered": self.delivered,
+            "expected": expected,
+            "deliveries_per_second": round(self.delivered / elapsed, 1),
+            "latency_ms": {"p50": percentile(latencies, 50), "p95": percentile(latencies, 95),
+                           "p99": percentile(latencies, 99), "max": round(max(latencies), 3) if latencies else None},
+            "memory_per_connection": round((connected["rss"] - idle["rss"]) / connections) if connections else None,
+            "worker_rss": loaded["rss"],
+            "loop_lag": loaded["loop_lag"],
+        }
+
+    @property
+    def delivered(self) -> int:
+        return sum(len(subscriber.latencies) for subscriber in self.subscribers)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def wait_until_up(base_url: str, worker: subprocess.Popen, timeout: float = 30.0) -> None:
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            if worker.poll() is not None:
+                raise RuntimeError(f"Worker exited with {worker.returncode}")
+            try:
+                response = await client.get(STATS_PATH, headers=LoadGenerator.headers(MARKER))
+                if response.status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Worker did not come up")
+
+
+async def benchmark(args: argparse.Namespace, base_url: str, worker: subprocess.Popen) -> dict:
+    await wait_until_up(base_url, worker)
+    return await LoadGenerator(args, base_url).run()
+
+
+def compare(results: dict, previous: dict) -> None:
+    rows = [("latency p50 ms", ("latency_ms", "p50")), ("latency p95 ms", ("latency_ms", "p95")),
+            ("latency p99 ms", ("latency_ms", "p99")), ("deliveries/s", ("deliveries_per_second",)),
+            ("bytes/connection", ("memory_per_connection",)), ("loop lag p99 ms", ("loop_lag", "p99_ms"))]
+    print(f"\n{'metric':<18} {previous.get('commit') or 'before':>12} {results.get('commit') or 'after':>12} "
+          f"{'change':>8}")
+    for label, path in rows:
+        before, after = previous["results"], results["results"]
+        for key in path:
+            before, after = (before or {}).get(key), (after or {}).get(key)
+        change = f"{(after - before) / before * 100:+.1f}%" if before and after is not None else "-"
+        print(f"{label:<18} {before if before is not None else '-':>12} {after if after is not None else '-':>12} "
+              f"{change:>8}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=100, help="chats with an open websocket")
+    parser.add_argument("--tabs", type=int, default=1, help="websockets per chat, the fan-out")
+    parser.add_argument("--rate", type=float, default=100, help="messages published per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load")
+    parser.add_argument("--operator-share", type=float, default=0.3, help="share of operator broadcasts")
+    parser.add_argument("--concurrency", type=int, default=50, help="HTTP connections of the publishers")
+    parser.add_argument("--drain", type=float, default=5, help="seconds to wait for late deliveries")
+    parser.add_argument("--redis-url", help="a local Redis instead of the in-process stand-in")
+    parser.add_argument("--output", default="benchmark-e2e.json")
+    parser.add_argument("--compare", help="results of an earlier run")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        asyncio.run(serve(args.serve, args.redis_url))
+        return
+
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    workdir = tempfile.mkdtemp(prefix="chat-benchmark-")
+    env = {**os.environ, "TESTING": "1", "DATABASE_URL": f"sqlite:///{workdir}/chat.db", "RATE_LIMITS": "",
+           "GEOIP_DATASET": "", "ARCHIVE_AFTER_DAYS": "0", "OPERATOR_TOKEN": OPERATOR_TOKEN}
+    if args.redis_url:
+        env["REDIS_URL"] = args.redis_url
+    for name in ("DB_USER", "DB_PASSWD", "DB_NAME", "RABBIT_HOST", "RABBIT_PORT", "RABBIT_USERNAME",
+                 "RABBIT_PASSWORD"):
+        env.setdefault(name, "benchmark")
+
+    command = [sys.executable, "-m", "benchmarks.e2e", "--serve", str(port)]
+    if args.redis_url:
+        command += ["--redis-url", args.redis_url]
+    worker = subprocess.Popen(command, env=env)
+    try:
+        results = asyncio.run(benchmark(args, base_url, worker))
+    finally:
+        worker.send_signal(signal.SIGINT)
+        try:
+            worker.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            worker.kill()
+
+    report = {"commit": git_commit(), "timestamp": int(time.time()),
+              "config": {key: value for key, value in vars(args).items() if key not in ("serve", "output", "compare")},
+              "results": results}
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"Saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(report, json.load(previous))
+
+
+if __name__ == "__main__":
+    main()
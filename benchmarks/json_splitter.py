@@ -0,0 +1,66 @@
+"""
+Throughput of splitting glued JSON documents: the former brace matching
+json_fixer against JSONStreamDecoder, whole and in socket sized chunks.
+
+    python -m benchmarks.json_splitter --frames 20000
+"""
+import argparse
+import json
+import time
+from collections import deque
+
+from api.tools import JSONStreamDecoder, json_fixer
+
+EVENT = {"channel_id": "f9eb7ff2-eed0-4c0a-83ba-b0503b59a5cc", "name": "Maria",
+         "message": "Sure, we have a few offplan villas in Bang Tao, starting from 450k.",
+         "direction": "OUT", "avatar": None, "created_at": 1650000000}
+
+
+def legacy_json_fixer(js_str: str):
+    indexes_js = {}
+    queue = deque()
+    result = set()
+
+    for i, c in enumerate(js_str):
+        if c == '{':
+            queue.append(i)
+        elif c == '}':
+            indexes_js[queue.pop()] = i
+
+    start_idx = 0
+    while indexes_js.get(start_idx):
+        vl = indexes_js[start_idx]
+        result.add(js_str[start_idx:vl + 1])
+        start_idx = vl + 1
+    return result
+
+
+def chunked(glued: str, size: int = 4096):
+    decoder = JSONStreamDecoder()
+    frames = []
+    for offset in range(0, len(glued), size):
+        frames.extend(decoder.split(glued[offset:offset + size]))
+    decoder.close()
+    return frames
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--frames", type=int, default=20000)
+    args = parser.parse_args()
+
+    glued = ''.join(json.dumps({**EVENT, "id": i}) for i in range(args.frames))
+    megabytes = len(glued.encode()) / 1024 / 1024
+
+    print(f"{'splitter':<18} {'frames':>8} {'MB/s':>10} {'frames/s':>12}")
+    for label, split in (("legacy json_fixer", legacy_json_fixer),
+                         ("json_fixer", json_fixer),
+                         ("decoder, 4k chunks", chunked)):
+        started = time.perf_counter()
+        frames = split(glued)
+        elapsed = time.perf_counter() - started
+        print(f"{label:<18} {len(frames):>8} {megabytes / elapsed:>10.1f} {len(frames) / elapsed:>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
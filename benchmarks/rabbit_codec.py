@@ -0,0 +1,40 @@
+"""
+Compares the binary queue message format with the legacy base64 JSON one.
+
+    python -m benchmarks.rabbit_codec --number 100000
+"""
+import argparse
+import timeit
+
+from core.clients.schemas import RabbitBody
+
+SESSION_ID = "f9eb7ff2-eed0-4c0a-83ba-b0503b59a5cc"
+
+SAMPLES = {
+    "short": RabbitBody("Hi, any villas?", SESSION_ID),
+    "typical": RabbitBody("Hello! We are looking for a 3 bedroom villa with a pool close to the beach, "
+                          "budget around 500k, ready in 2023.", SESSION_ID),
+    "long": RabbitBody("Привет! Подскажите по рассрочке и видам из окон. " * 40, SESSION_ID),
+}
+
+
+def measure(number: int, stmt) -> float:
+    return number / timeit.timeit(stmt, number=number)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=50000)
+    args = parser.parse_args()
+
+    print(f"{'sample':<8} {'format':<7} {'bytes':>6} {'encode/s':>12} {'decode/s':>12}")
+    for name, body in SAMPLES.items():
+        for label, encode in (("legacy", body.encode_legacy), ("binary", body.encode)):
+            payload = encode()
+            encodes = measure(args.number, encode)
+            decodes = measure(args.number, lambda: RabbitBody.decode(payload))
+            print(f"{name:<8} {label:<7} {len(payload):>6} {encodes:>12,.0f} {decodes:>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
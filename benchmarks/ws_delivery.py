@@ -0,0 +1,90 @@
+"""
+Frames per second one worker pushes through a websocket send queue, with
+the payload re-encoded by send_json (before) or relayed with send_text.
+
+    python -m benchmarks.ws_delivery --frames 100000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from core import serialization
+from core.realtime.delivery import SocketConnection, DeliveryStats, message_frame
+
+CHANNEL = "f9eb7ff2-eed0-4c0a-83ba-b0503b59a5cc"
+EVENT = {"channel_id": CHANNEL, "name": "Maria", "message": "Sure, we have a few offplan villas in Bang Tao.",
+         "direction": "OUT", "avatar": "https://media.tropico.dev/agent/maria.jpg", "created_at": 1650000000}
+
+
+class SinkWebSocket:
+    """
+    Mimics what starlette does before handing a frame to the ASGI server.
+    """
+
+    def __init__(self, frames: int, done: asyncio.Event) -> None:
+        self.remaining = frames
+        self.done = done
+        self.bytes = 0
+
+    async def send_json(self, data) -> None:
+        await self.send_text(json.dumps(data))
+
+    async def send_text(self, data: str) -> None:
+        self.bytes += len(data.encode())
+        self.remaining -= 1
+        if not self.remaining:
+            self.done.set()
+
+    async def close(self, code: int = 1000) -> None:
+        pass
+
+
+class JSONSocketConnection(SocketConnection):
+    """
+    The previous sender, which serialized the whole pub/sub message again.
+    """
+
+    async def run(self) -> None:
+        while True:
+            if not self.frames:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            await self.websocket.send_json(self.frames.popleft())
+
+
+async def measure(connection_class, dumps, frames: int, batch: int = 100):
+    done = asyncio.Event()
+    websocket = SinkWebSocket(frames, done)
+    connection = connection_class(websocket, max_queue=batch, stats=DeliveryStats())
+    sender = asyncio.ensure_future(connection.run())
+
+    started = time.perf_counter()
+    for sent in range(0, frames, batch):
+        for _ in range(min(batch, frames - sent)):
+            connection.push(message_frame(CHANNEL, dumps(EVENT)))
+        await asyncio.sleep(0)
+    await done.wait()
+    elapsed = time.perf_counter() - started
+
+    sender.cancel()
+    connection.close()
+    return frames / elapsed, websocket.bytes / frames
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--frames", type=int, default=100000)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    print(f"JSON backend: {serialization.backend}")
+    print(f"{'path':<12} {'frames/s':>12} {'bytes/frame':>12}")
+    for label, connection_class, dumps in (("send_json", JSONSocketConnection, json.dumps),
+                                           ("send_text", SocketConnection, serialization.dumps)):
+        rate, size = loop.run_until_complete(measure(connection_class, dumps, args.frames))
+        print(f"{label:<12} {rate:>12,.0f} {size:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import asyncio
+import json
+import time
+import uuid
+from typing import List, Optional
+
+import aiohttp
+from aioredis import Redis
+from loguru import logger
+
+from core.config import BITRIX_CHAT_URL, CRM_OUTBOX_SIZE, CRM_BATCH_SIZE, CRM_MAX_RETRIES, CRM_POOL_SIZE
+
+
+class CRMOutbox:
+    """
+    Background delivery of Bitrix notifications. Hot paths only enqueue, a
+    worker posts batches over a pooled keep-alive session and retries with
+    backoff; whatever cannot be delivered is spilled to a Redis list and
+    replayed once the CRM answers again. A replay first moves its events to
+    a processing list of this worker, claims older than ``claim_ttl`` belong
+    to a worker that died mid-replay and go back to the spill list.
+    """
+
+    SPILL_KEY = 'crm:outbox'
+    PROCESSING_KEY = 'crm:outbox:processing:'
+    CLAIMS_KEY = 'crm:outbox:claims'
+
+    def __init__(self, base_url: str, maxsize: int = 10000, batch_size: int = 20, max_retries: int = 4,
+                 backoff: float = 0.5, pool_size: int = 10, timeout: float = 5.0,
+                 replay_interval: float = 10.0, claim_ttl: float = 600.0) -> None:
+        self.base_url = base_url
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.replay_interval = replay_interval
+        self.claim_ttl = claim_ttl
+        self.processing = f"{self.PROCESSING_KEY}{uuid.uuid4().hex}"
+        self.redis: Optional[Redis] = None
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker = None
+        # the queued batch being delivered, narrowed to what is still undelivered
+        self.in_flight: List[dict] = []
+        self.last_replay = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.spilled = 0
+
+    def enqueue(self, path: str, payload: dict) -> None:
+        event = {"path": path, "payload": payload}
+        if self.queue is None:
+            logger.warning(f"CRM outbox is not running, dropped {event}")
+            return
+
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            asyncio.ensure_future(self.__spill([event]))
+
+    async def start(self, redis: Redis) -> None:
+        self.redis = redis
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.pool_size),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        self.worker = asyncio.ensure_future(self.__run())
+
+    async def stop(self) -> None:
+        if self.worker:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+
+        pending, self.in_flight = self.in_flight, []
+        while self.queue and not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        if pending:
+            await self.__spill(pending)
+        if self.redis:
+            try:
+                await self.__release(self.processing)
+            except Exception as e:
+                logger.warning("--- CRM OUTBOX SPILL ERROR ---")
+                logger.warning(e)
+                logger.warning(f"Claimed events are kept in {self.processing}")
+                logger.warning("--- CRM OUTBOX SPILL ERROR ---")
+
+        if self.session:
+            await self.session.close()
+
+    async def send(self, event: dict) -> bool:
+        async with self.session.post(self.base_url + event['path'], json=event['payload']) as response:
+            if response.status >= 500:
+                return False
+            if response.status >= 400:
+                logger.warning(f"CRM rejected {event['path']} with {response.status}")
+            return True
+
+    async def __deliver(self, batch: List[dict]) -> List[dict]:
+        """
+        Narrows ``batch`` in place to the events still undelivered and returns it.
+        """
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+
+            results = await asyncio.gather(*(self.send(event) for event in batch), return_exceptions=True)
+            failed = [event for event, result in zip(batch, results) if result is not True]
+            self.sent += len(batch) - len(failed)
+            batch[:] = failed
+            if not batch:
+                return batch
+
+        self.failed += len(batch)
+        return batch
+
+    async def __spill(self, events: List[dict]) -> None:
+        try:
+            await self.redis.rpush(self.SPILL_KEY, *[json.dumps(event) for event in events])
+            self.spilled += len(events)
+        except Exception as e:
+            logger.warning("--- CRM OUTBOX SPILL ERROR ---")
+            logger.warning(e)
+            logger.warning(events)
+            logger.warning("--- CRM OUTBOX SPILL ERROR ---")
+
+    async def __release(self, processing: str) -> None:
+        while await self.redis.rpoplpush(processing, self.SPILL_KEY):
+            pass
+        await self.redis.zrem(self.CLAIMS_KEY, processing)
+
+    async def __replay(self) -> None:
+        self.last_replay = time.monotonic()
+        for processing in await self.redis.zrangebyscore(self.CLAIMS_KEY, '-inf', time.time() - self.claim_ttl):
+            logger.warning(f"Releasing abandoned CRM events of {processing}")
+            await self.__release(processing)
+
+        # the events stay in Redis until they are delivered or spilled again
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(self.CLAIMS_KEY, {self.processing: time.time()})
+            for _ in range(self.batch_size):
+                pipe.rpoplpush(self.SPILL_KEY, self.processing)
+            spilled = [event for event in (await pipe.execute())[1:] if event]
+        if not spilled:
+            await self.redis.zrem(self.CLAIMS_KEY, self.processing)
+            return
+
+        failed = await self.__deliver([json.loads(event) for event in spilled])
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if failed:
+                pipe.rpush(self.SPILL_KEY, *[json.dumps(event) for event in failed])
+            await pipe.delete(self.processing).zrem(self.CLAIMS_KEY, self.processing).execute()
+        self.spilled += len(failed)
+
+    async def __next_batch(self) -> List[dict]:
+        try:
+            batch = [await asyncio.wait_for(self.queue.get(), timeout=self.replay_interval)]
+        except asyncio.TimeoutError:
+            return []
+
+        while len(batch) < self.batch_size and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def __run(self) -> None:
+        while True:
+            try:
+                batch = self.in_flight = await self.__next_batch()
+                if batch:
+                    failed = await self.__deliver(batch)
+                    if failed:
+                        await self.__spill(failed)
+                        self.in_flight = []
+                        continue
+                self.in_flight = []
+
+                if time.monotonic() - self.last_replay >= self.replay_interval:
+                    await self.__replay()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("--- CRM OUTBOX ERROR ---")
+                logger.warning(e)
+                logger.warning("--- CRM OUTBOX ERROR ---")
+                await asyncio.sleep(self.backoff)
+
+
+crm_outbox = CRMOutbox(BITRIX_CHAT_URL, maxsize=CRM_OUTBOX_SIZE, batch_size=CRM_BATCH_SIZE,
+                       max_retries=CRM_MAX_RETRIES, pool_size=CRM_POOL_SIZE)
@@ -1,29 +1,200 @@
+import asyncio
+import time
+from collections import deque
+from itertools import cycle
+from typing import Deque, List, Optional, Set, Tuple
+
 import aiormq
+from loguru import logger
 
 from core.clients.schemas import RabbitBody
-from core.config import RABBIT_USERNAME, RABBIT_PASSWORD, RABBIT_HOST
+from core.config import RABBIT_USERNAME, RABBIT_PASSWORD, RABBIT_HOST, RABBIT_PORT, RABBIT_EXCHANGE, \
+    RABBIT_CHANNEL_POOL_SIZE, RABBIT_BATCH_SIZE, RABBIT_BUFFER_SIZE
+
+RABBIT_URL = "amqp://{}:{}@{}:{}/".format(RABBIT_USERNAME, RABBIT_PASSWORD, RABBIT_HOST, RABBIT_PORT)
 
 
 class MessageQueueClient:
+    """
+    Long lived publisher of chat messages. One connection with a small pool
+    of confirm channels is kept open, the exchange is declared once per
+    connection and messages are buffered locally, published in batches spread
+    over the pool and kept until the broker confirmed them.
+    """
 
-    def __init__(self, exchange_name):
+    def __init__(self, url: str, exchange_name: str, routing_key: str = 'tropico_chat', pool_size: int = 4,
+                 batch_size: int = 50, buffer_size: int = 10000, reconnect_interval: float = 1.0,
+                 confirm_timeout: float = 5.0) -> None:
+        self.url = url
         self.exchange_name = exchange_name
+        self.routing_key = routing_key
+        self.pool_size = pool_size
+        self.batch_size = batch_size
+        self.reconnect_interval = reconnect_interval
+        self.confirm_timeout = confirm_timeout
+        self.buffer: Deque[Tuple[float, bytes]] = deque(maxlen=buffer_size)
+        self.connection = None
+        self.channels: List = []
+        self.worker = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self.in_flight = 0
+        self.published = 0
+        self.nacked = 0
+        self.dropped = 0
+        self.connects = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    async def push_to_rabbit(self, *, message: str, session_id: str) -> None:
+        self.publish(RabbitBody(message, session_id).encode())
+
+    def publish(self, body: bytes) -> None:
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append((time.monotonic(), body))
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self.worker = asyncio.ensure_future(self.__run())
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        if self.worker:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+
+        try:
+            await asyncio.wait_for(self.__drain(), timeout=timeout)
+        except Exception as e:
+            logger.warning(e)
+        if self.buffer:
+            logger.warning(f"RabbitMQ publisher stopped with {len(self.buffer)} unpublished messages")
+        await self.__close()
+
+    async def connect(self):
+        return await aiormq.connect(self.url)
+
+    def snapshot(self) -> dict:
+        confirmed = self.published + self.nacked
+        return {
+            "connected": self.__is_open(),
+            "buffered": len(self.buffer),
+            "in_flight": self.in_flight,
+            "published": self.published,
+            "nacked": self.nacked,
+            "dropped": self.dropped,
+            "connects": self.connects,
+            "latency_avg_ms": round(self.latency_total / confirmed * 1000, 3) if confirmed else 0.0,
+            "latency_max_ms": round(self.latency_max * 1000, 3),
+        }
+
+    async def __open(self) -> None:
+        self.connection = await self.connect()
+        self.channels = [await self.connection.channel(publisher_confirms=True) for _ in range(self.pool_size)]
+        await self.channels[0].exchange_declare(exchange=self.exchange_name, exchange_type='direct')
+
+    def __is_open(self) -> bool:
+        if self.connection is None or self.connection.is_closed:
+            return False
+        return not any(channel.is_closed for channel in self.channels)
+
+    async def __close(self) -> None:
+        connection, self.connection, self.channels = self.connection, None, []
+        if connection is not None:
+            try:
+                await connection.close()
+            except Exception as e:
+                logger.warning(e)
+
+    async def __send(self, channel, messages: List[Tuple[float, bytes]], acked: Set[int]) -> List[Tuple[float, bytes]]:
+        failed = []
+        for message in messages:
+            enqueued_at, body = message
+            confirmation = None
+            if not channel.is_closed:
+                try:
+                    confirmation = await channel.basic_publish(
+                        body,
+                        routing_key=self.routing_key,
+                        exchange=self.exchange_name,
+                        properties=aiormq.spec.Basic.Properties(delivery_mode=2),
+                        timeout=self.confirm_timeout,
+                    )
+                except Exception as e:
+                    logger.warning(e)
+            self.in_flight -= 1
+
+            if isinstance(confirmation, aiormq.spec.Basic.Ack):
+                latency = time.monotonic() - enqueued_at
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+                self.published += 1
+                acked.add(id(message))
+                continue
+
+            if confirmation is not None:
+                self.nacked += 1
+            failed.append(message)
+        return failed
+
+    async def __publish_batch(self) -> bool:
+        batch = [self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))]
+        shares = [[] for _ in self.channels]
+        for share, message in zip(cycle(shares), batch):
+            share.append(message)
+
+        # aiormq waits for every confirm under the channel lock, the pool is what pipelines a batch
+        self.in_flight += len(batch)
+        acked = set()
+        try:
+            results = await asyncio.gather(*(self.__send(channel, share, acked)
+                                             for channel, share in zip(self.channels, shares)))
+        except asyncio.CancelledError:
+            # confirmed messages are with the broker, publishing them again would duplicate them
+            self.in_flight = 0
+            self.__requeue([message for message in batch if id(message) not in acked])
+            raise
+
+        failed = sorted(message for share in results for message in share)
+        self.__requeue(failed)
+        return not failed
+
+    def __requeue(self, messages: List[Tuple[float, bytes]]) -> None:
+        self.dropped += max(0, len(self.buffer) + len(messages) - self.buffer.maxlen)
+        self.buffer.extendleft(reversed(messages))
+
+    async def __drain(self) -> None:
+        while self.buffer and self.__is_open():
+            if not await self.__publish_batch():
+                return
+
+    async def __run(self) -> None:
+        while True:
+            try:
+                if not self.buffer:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
 
-    async def push_to_rabbit(self, *, message: str, session_id: str):
-        connection = await aiormq.connect("amqp://{}:{}@{}/".format(RABBIT_USERNAME, RABBIT_PASSWORD, RABBIT_HOST))
-        channel = await connection.channel()
+                if not self.__is_open():
+                    await self.__close()
+                    await self.__open()
+                    self.connects += 1
 
-        request = RabbitBody(message, session_id)
+                if not await self.__publish_batch():
+                    await asyncio.sleep(self.reconnect_interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("--- RABBITMQ PUBLISH ERROR ---")
+                logger.warning(e)
+                logger.warning("--- RABBITMQ PUBLISH ERROR ---")
+                await self.__close()
+                await asyncio.sleep(self.reconnect_interval)
 
-        await channel.exchange_declare(
-            exchange=self.exchange_name, exchange_type='direct'
-        )
 
-        await channel.basic_publish(
-            request.encode(),
-            routing_key='tropico_chat',
-            exchange=self.exchange_name,
-            properties=aiormq.spec.Basic.Properties(
-                delivery_mode=2
-            )
-        )
+rabbit_publisher = MessageQueueClient(RABBIT_URL, exchange_name=RABBIT_EXCHANGE, pool_size=RABBIT_CHANNEL_POOL_SIZE,
+                                      batch_size=RABBIT_BATCH_SIZE, buffer_size=RABBIT_BUFFER_SIZE)
@@ -1,6 +1,20 @@
 import json
+import struct
+import zlib
 from base64 import b64encode, b64decode
 from dataclasses import dataclass
+from typing import Union
+
+# Wire format: magic, version, flags, then every field as a uint32 length
+# prefixed utf-8 string, zlib compressed as a whole when flagged. The magic
+# byte is outside of the base64 alphabet so legacy payloads stay decodable.
+WIRE_MAGIC = 0xC7
+WIRE_VERSION = 1
+FLAG_ZLIB = 0x01
+COMPRESS_THRESHOLD = 512
+
+_HEADER = struct.Struct('!BBB')
+_LENGTH = struct.Struct('!I')
 
 
 @dataclass
@@ -8,11 +22,41 @@ class RabbitBody:
     message: str
     session_id: str
 
-    def encode(self):
+    def encode(self, compress_threshold: int = COMPRESS_THRESHOLD) -> bytes:
+        fields = b''.join(_LENGTH.pack(len(field)) + field
+                          for field in (self.message.encode(), self.session_id.encode()))
+        flags = 0
+        if len(fields) > compress_threshold:
+            fields = zlib.compress(fields, 1)
+            flags |= FLAG_ZLIB
+        return _HEADER.pack(WIRE_MAGIC, WIRE_VERSION, flags) + fields
+
+    def encode_legacy(self) -> bytes:
         return b64encode(self.json().encode())
 
     @staticmethod
-    def decode(encoded):
+    def decode(encoded: Union[bytes, str]) -> 'RabbitBody':
+        if isinstance(encoded, str) or not encoded or encoded[0] != WIRE_MAGIC:
+            return RabbitBody.decode_legacy(encoded)
+
+        _, version, flags = _HEADER.unpack_from(encoded)
+        if version != WIRE_VERSION:
+            raise ValueError(f"Unsupported queue message version {version}")
+
+        payload = memoryview(encoded)[_HEADER.size:]
+        if flags & FLAG_ZLIB:
+            payload = memoryview(zlib.decompress(payload))
+
+        fields, offset = [], 0
+        for _ in range(2):
+            size, = _LENGTH.unpack_from(payload, offset)
+            offset += _LENGTH.size
+            fields.append(str(payload[offset:offset + size], 'utf-8'))
+            offset += size
+        return RabbitBody(*fields)
+
+    @staticmethod
+    def decode_legacy(encoded: Union[bytes, str]) -> 'RabbitBody':
         data = json.loads(b64decode(encoded))
         return RabbitBody(**data)
 
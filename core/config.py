@@ -1,6 +1,6 @@
 from databases import DatabaseURL
 from starlette.config import Config
-from starlette.datastructures import Secret
+from starlette.datastructures import CommaSeparatedStrings, Secret
 
 config = Config(".env")
 
@@ -17,6 +17,10 @@ RABBIT_HOST = config("RABBIT_HOST", cast=str)
 RABBIT_PORT = config("RABBIT_PORT", cast=str)
 RABBIT_USERNAME = config("RABBIT_USERNAME", cast=str)
 RABBIT_PASSWORD = config("RABBIT_PASSWORD", cast=str)
+RABBIT_EXCHANGE = config("RABBIT_EXCHANGE", cast=str, default="tropico_chat")
+RABBIT_CHANNEL_POOL_SIZE = config("RABBIT_CHANNEL_POOL_SIZE", cast=int, default=4)
+RABBIT_BATCH_SIZE = config("RABBIT_BATCH_SIZE", cast=int, default=50)
+RABBIT_BUFFER_SIZE = config("RABBIT_BUFFER_SIZE", cast=int, default=10000)
 
 DATABASE_URL_TEST = config(
         "DATABASE_URL",
@@ -30,11 +34,60 @@ DATABASE_URL = config(
     default=f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_SERVER}:{POSTGRES_PORT}/{POSTGRES_DB}"
 )
 
+REDIS_URL = config("REDIS_URL", cast=str, default="redis://redis/8")
+REDIS_PUBSUB_URLS = config("REDIS_PUBSUB_URLS", cast=CommaSeparatedStrings, default="")
+REDIS_PUBSUB_REPLICAS = config("REDIS_PUBSUB_REPLICAS", cast=int, default=160)
+
 MEDIA_URL = 'https://d7i54qaggkyj3.cloudfront.net/'
 
 AVAILABLE_CHANNELS = dict()
 BITRIX_URL = "https://crm.axcap.ae/"
 WS_SESSION_ID_PREFIX = 'WS_EX_'
+OPERATOR_TOKEN = config("OPERATOR_TOKEN", cast=Secret, default="")
 TG_API_TOKEN = ''
 TG_CHANNEL_ID = ""
 
+WS_SEND_QUEUE_SIZE = config("WS_SEND_QUEUE_SIZE", cast=int, default=100)
+WS_SLOW_CONSUMER_POLICY = config("WS_SLOW_CONSUMER_POLICY", cast=str, default="drop_oldest")
+WS_REPLAY_MAXLEN = config("WS_REPLAY_MAXLEN", cast=int, default=100)
+WS_REPLAY_TTL = config("WS_REPLAY_TTL", cast=int, default=600)
+JSON_BACKEND = config("JSON_BACKEND", cast=str, default="auto")
+PRESENCE_HEARTBEAT_INTERVAL = config("PRESENCE_HEARTBEAT_INTERVAL", cast=float, default=15.0)
+PRESENCE_TTL = config("PRESENCE_TTL", cast=float, default=45.0)
+
+RATE_LIMITS = config("RATE_LIMITS", cast=str,
+                     default="/ws/api/user/publish=30/60,/ws/api/update=10/60,/ws/api/subscribe=20/60")
+RATE_LIMIT_CACHE_SIZE = config("RATE_LIMIT_CACHE_SIZE", cast=int, default=10000)
+RATE_LIMIT_IP_FACTOR = config("RATE_LIMIT_IP_FACTOR", cast=int, default=5)
+
+GEOIP_DATASET = config("GEOIP_DATASET", cast=str, default="")
+GEOIP_CACHE_SIZE = config("GEOIP_CACHE_SIZE", cast=int, default=65536)
+GEOIP_RELOAD_INTERVAL = config("GEOIP_RELOAD_INTERVAL", cast=float, default=300.0)
+
+BITRIX_CHAT_URL = config("BITRIX_CHAT_URL", cast=str, default="http://bitrix_chat:8000/bitrix/")
+CRM_OUTBOX_SIZE = config("CRM_OUTBOX_SIZE", cast=int, default=10000)
+CRM_BATCH_SIZE = config("CRM_BATCH_SIZE", cast=int, default=20)
+CRM_MAX_RETRIES = config("CRM_MAX_RETRIES", cast=int, default=4)
+CRM_POOL_SIZE = config("CRM_POOL_SIZE", cast=int, default=10)
+
+SESSION_CACHE_SIZE = config("SESSION_CACHE_SIZE", cast=int, default=10000)
+SESSION_CACHE_TTL = config("SESSION_CACHE_TTL", cast=float, default=60.0)
+SESSION_CACHE_REDIS_TTL = config("SESSION_CACHE_REDIS_TTL", cast=int, default=86400)
+
+CONTENT_REFRESH_INTERVAL = config("CONTENT_REFRESH_INTERVAL", cast=float, default=30.0)
+
+MESSAGE_FLUSH_SIZE = config("MESSAGE_FLUSH_SIZE", cast=int, default=100)
+MESSAGE_FLUSH_INTERVAL = config("MESSAGE_FLUSH_INTERVAL", cast=float, default=0.5)
+ARCHIVE_AFTER_DAYS = config("ARCHIVE_AFTER_DAYS", cast=int, default=30)
+ARCHIVE_BATCH_SIZE = config("ARCHIVE_BATCH_SIZE", cast=int, default=1000)
+ARCHIVE_BATCH_PAUSE = config("ARCHIVE_BATCH_PAUSE", cast=float, default=0.2)
+ARCHIVE_INTERVAL = config("ARCHIVE_INTERVAL", cast=float, default=3600.0)
+BROADCAST_BATCH_SIZE = config("BROADCAST_BATCH_SIZE", cast=int, default=500)
+SLOW_QUERY_MS = config("SLOW_QUERY_MS", cast=float, default=200.0)
+SLOW_QUERY_LOG_SIZE = config("SLOW_QUERY_LOG_SIZE", cast=int, default=100)
+SLOW_QUERY_REDACT = config("SLOW_QUERY_REDACT", cast=CommaSeparatedStrings,
+                           default="name,email,phone,message,context,ip,session_id")
+
+HISTORY_BUFFER_SIZE = config("HISTORY_BUFFER_SIZE", cast=int, default=15)
+HISTORY_BUFFER_TTL = config("HISTORY_BUFFER_TTL", cast=int, default=86400)
+HISTORY_VERSION_TTL = config("HISTORY_VERSION_TTL", cast=int, default=3600)
@@ -0,0 +1,180 @@
+import asyncio
+import csv
+import ipaddress
+import os
+from array import array
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Optional, List, Tuple
+
+from loguru import logger
+
+from core.config import GEOIP_CACHE_SIZE
+
+
+class RangeIndex:
+    """
+    Sorted, non-overlapping IP ranges kept in flat arrays. IPv4 bounds are
+    stored as unsigned 32-bit integers, IPv6 bounds as python ints.
+    """
+
+    def __init__(self, rows: List[Tuple[int, int, int, dict]]) -> None:
+        self.locations: List[dict] = []
+        v4, v6 = [], []
+        seen = {}
+        for version, start, end, location in rows:
+            key = (location['country'], location['city'])
+            if key not in seen:
+                seen[key] = len(self.locations)
+                self.locations.append(location)
+            (v4 if version == 4 else v6).append((start, end, seen[key]))
+
+        v4.sort()
+        v6.sort()
+        self.v4_starts = array('I', (r[0] for r in v4))
+        self.v4_ends = array('I', (r[1] for r in v4))
+        self.v4_locations = array('I', (r[2] for r in v4))
+        self.v6_starts = [r[0] for r in v6]
+        self.v6_ends = [r[1] for r in v6]
+        self.v6_locations = array('I', (r[2] for r in v6))
+
+    def __len__(self) -> int:
+        return len(self.v4_starts) + len(self.v6_starts)
+
+    def describe(self) -> str:
+        return f"{len(self)} ranges"
+
+    def close(self) -> None:
+        pass
+
+    def find(self, ip: str) -> Optional[dict]:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+
+        if address.version == 4:
+            starts, ends, locations = self.v4_starts, self.v4_ends, self.v4_locations
+        else:
+            starts, ends, locations = self.v6_starts, self.v6_ends, self.v6_locations
+
+        value = int(address)
+        i = bisect_right(starts, value) - 1
+        if i >= 0 and value <= ends[i]:
+            return self.locations[locations[i]]
+
+
+def _to_address(value: str):
+    value = value.strip()
+    if value.isdigit():
+        return ipaddress.ip_address(int(value))
+    return ipaddress.ip_address(value)
+
+
+def read_csv_ranges(path: str) -> List[Tuple[int, int, int, dict]]:
+    """
+    Accepts either ``start,end,country,city`` rows (dotted or integer bounds)
+    or ``network,country,city`` rows with CIDR networks. A header row is skipped.
+    """
+    rows = []
+    with open(path, newline='', encoding='utf-8') as f:
+        for record in csv.reader(f):
+            if not record or record[0].startswith('#'):
+                continue
+            try:
+                if '/' in record[0]:
+                    network = ipaddress.ip_network(record[0].strip(), strict=False)
+                    start, end = network.network_address, network.broadcast_address
+                    country, city = record[1:3]
+                else:
+                    start, end = _to_address(record[0]), _to_address(record[1])
+                    country, city = record[2:4]
+            except ValueError:
+                continue
+
+            rows.append((start.version, int(start), int(end),
+                         {"country": country.strip() or None, "city": city.strip() or None}))
+
+    return rows
+
+
+class MMDBIndex:
+
+    def __init__(self, path: str) -> None:
+        import maxminddb
+        self.reader = maxminddb.open_database(path)
+
+    def describe(self) -> str:
+        metadata = self.reader.metadata()
+        return f"{metadata.database_type} built at {metadata.build_epoch}, {metadata.node_count} search tree nodes"
+
+    def close(self) -> None:
+        self.reader.close()
+
+    def find(self, ip: str) -> Optional[dict]:
+        try:
+            record = self.reader.get(ip)
+        except ValueError:
+            return None
+
+        if record:
+            return {"country": record.get('country', {}).get('names', {}).get('en'),
+                    "city": record.get('city', {}).get('names', {}).get('en')}
+
+
+class GeoIPResolver:
+    """
+    Local replacement for the ip-api.com lookup. The dataset is loaded into
+    memory once and every lookup goes through an LRU cache keyed by IP.
+    """
+
+    def __init__(self, cache_size: int = 65536) -> None:
+        self.cache_size = cache_size
+        self.path = None
+        self.mtime = None
+        self.index = None
+        self.lookup = lru_cache(maxsize=cache_size)(self.__find)
+
+    def __find(self, ip: str) -> Optional[dict]:
+        if self.index is None:
+            return None
+        return self.index.find(ip)
+
+    @staticmethod
+    def build_index(path: str):
+        if path.endswith('.mmdb'):
+            return MMDBIndex(path)
+        return RangeIndex(read_csv_ranges(path))
+
+    def __swap(self, index, path: str, mtime: float) -> None:
+        previous, self.index, self.path, self.mtime = self.index, index, path, mtime
+        self.lookup = lru_cache(maxsize=self.cache_size)(self.__find)
+        # lookups are synchronous, nothing reads the previous index any more
+        if previous is not None:
+            previous.close()
+        logger.debug(f"GeoIP dataset {path} loaded: {index.describe()}")
+
+    def load(self, path: str) -> None:
+        mtime = os.path.getmtime(path)
+        self.__swap(self.build_index(path), path, mtime)
+
+    async def reload(self, path: Optional[str] = None) -> None:
+        path = path or self.path
+        mtime = os.path.getmtime(path)
+        loop = asyncio.get_event_loop()
+        index = await loop.run_in_executor(None, self.build_index, path)
+        self.__swap(index, path, mtime)
+
+    async def watch(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if self.path and os.path.getmtime(self.path) != self.mtime:
+                    await self.reload()
+            except Exception as e:
+                logger.warning("--- GEOIP RELOAD ERROR ---")
+                logger.warning(e)
+                logger.warning("--- GEOIP RELOAD ERROR ---")
+
+
+geoip = GeoIPResolver(cache_size=GEOIP_CACHE_SIZE)
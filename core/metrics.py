@@ -0,0 +1,201 @@
+"""
+Per-worker metrics in the Prometheus text format. Everything is updated
+from the worker's event loop, so metrics are plain numbers without locks:
+a counter increment is one addition, a histogram observation one bisect
+and three additions. Values that already live elsewhere are read by
+callbacks at scrape time instead of being mirrored on the hot path.
+"""
+import math
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+METRICS_PATH = '/metrics'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children: Dict[Tuple[str, ...], object] = {}
+        self.function: Optional[Callable] = None
+
+    def labels(self, *values: str):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self._child()
+        return child
+
+    def set_function(self, function: Callable) -> None:
+        """
+        Reads the value at scrape time: a number, or a dict of label value
+        tuples to numbers for labelled metrics.
+        """
+        self.function = function
+
+    def _child(self):
+        raise NotImplementedError
+
+    def samples(self) -> Iterable[Tuple[str, Tuple[str, ...], str, float]]:
+        """
+        (name suffix, label values, extra label, value) of every sample.
+        """
+        if self.function is not None:
+            values = self.function()
+            items = values.items() if isinstance(values, dict) else [((), values)]
+            for label_values, value in items:
+                if value is not None:
+                    yield '', label_values, '', value
+            return
+
+        for label_values, child in self.children.items():
+            yield '', label_values, '', child.value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, label_values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_labels(self.labelnames, label_values, extra)} {_number(value)}")
+        return lines
+
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _child(self) -> _Value:
+        return _Value()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _child(self) -> _Value:
+        return _Value()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self.labels().dec(amount)
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+
+class _Buckets:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: Tuple[float, ...]) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _child(self) -> _Buckets:
+        return _Buckets(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def samples(self):
+        for label_values, child in self.children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                yield '_bucket', label_values, f'le="{_number(bound)}"', cumulative
+            yield '_sum', label_values, '', child.sum
+            yield '_count', label_values, '', child.count
+
+
+class Registry:
+
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f"# {metric.name} failed: {_escape(e)}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+ws_connects = registry.register(Counter('chat_ws_connects_total', 'Websocket subscriptions accepted.'))
+ws_disconnects = registry.register(Counter('chat_ws_disconnects_total', 'Websocket subscriptions closed.'))
+ws_active = registry.register(Gauge('chat_ws_active', 'Open websocket subscriptions.'))
+messages_published = registry.register(Counter('chat_messages_published_total',
+                                               'Messages published to session channels.', ['shard']))
+messages_delivered = registry.register(Counter('chat_messages_delivered_total',
+                                               'Frames written to websockets.'))
+messages_dropped = registry.register(Counter('chat_messages_dropped_total',
+                                             'Frames dropped or coalesced for slow websockets.', ['reason']))
+http_latency = registry.register(Histogram('chat_http_request_duration_seconds',
+                                           'HTTP request latency by route.', ['method', 'route', 'status']))
+queue_depth = registry.register(Gauge('chat_queue_depth', 'Items waiting in the worker queues.', ['queue']))
+pool_connections = registry.register(Gauge('chat_pool_connections', 'Connections of the worker pools.',
+                                           ['pool', 'state']))
+db_query_latency = registry.register(Histogram('chat_db_query_duration_seconds',
+                                               'Database latency by named query.', ['query']))
+db_query_rows = registry.register(Counter('chat_db_query_rows_total', 'Rows returned by named query.', ['query']))
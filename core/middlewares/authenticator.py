@@ -2,6 +2,8 @@ from starlette.datastructures import Headers
 from starlette.responses import PlainTextResponse
 from starlette.types import ASGIApp, Receive, Scope, Send
 
+from core.metrics import METRICS_PATH
+
 
 class AuthenticateMiddleware:
     def __init__(self, app: ASGIApp) -> None:
@@ -10,7 +12,7 @@ class AuthenticateMiddleware:
     async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
         if scope["type"] not in (
             "http"
-        ):  # pragma: no cover
+        ) or scope["path"] == METRICS_PATH:  # pragma: no cover
             await self.app(scope, receive, send)
             return
 
@@ -3,6 +3,8 @@ from starlette.responses import PlainTextResponse
 from starlette.types import ASGIApp, Receive, Scope, Send
 from starlette.websockets import WebSocket
 
+from core.metrics import METRICS_PATH
+
 
 class BotBlockMiddleware:
     def __init__(self, app: ASGIApp) -> None:
@@ -12,7 +14,7 @@ class BotBlockMiddleware:
         if scope["type"] not in (
             "http",
             "websocket",
-        ):  # pragma: no cover
+        ) or scope["path"] == METRICS_PATH:  # pragma: no cover
             await self.app(scope, receive, send)
             return
 
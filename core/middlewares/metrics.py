@@ -0,0 +1,50 @@
+import time
+from typing import Callable, Dict
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from core.metrics import http_latency, METRICS_PATH
+
+
+class MetricsMiddleware:
+    """
+    Observes the latency of every HTTP request, labelled with the route
+    template rather than the path so session ids do not explode the series.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        self.routes: Dict[Callable, str] = {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"] == METRICS_PATH:
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_latency.labels(scope["method"], self.route(scope), str(status)) \
+                .observe(time.perf_counter() - started)
+
+    def route(self, scope: Scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return 'unmatched'
+
+        route = self.routes.get(endpoint)
+        if route is None:
+            app = scope.get("app")
+            for candidate in getattr(app, "routes", ()):
+                self.routes.setdefault(getattr(candidate, "endpoint", None), candidate.path)
+            route = self.routes.setdefault(endpoint, 'unmatched')
+        return route
@@ -0,0 +1,166 @@
+import time
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional, Tuple
+
+from loguru import logger
+from starlette.datastructures import Headers
+from starlette.responses import PlainTextResponse
+from starlette.status import HTTP_429_TOO_MANY_REQUESTS, WS_1008_POLICY_VIOLATION
+from starlette.types import ASGIApp, Receive, Scope, Send
+from starlette.websockets import WebSocket
+
+from core.config import RATE_LIMITS, RATE_LIMIT_CACHE_SIZE, RATE_LIMIT_IP_FACTOR
+
+
+class RateLimit(NamedTuple):
+    path: str
+    limit: int
+    window: int
+
+
+def parse_rate_limits(value: str) -> List[RateLimit]:
+    """
+    "/ws/api/user/publish=30/60,/ws/api/subscribe=20/60" -> path prefix,
+    requests allowed per window of seconds; longest prefixes match first.
+    """
+    limits = []
+    for rule in filter(None, map(str.strip, value.split(','))):
+        path, rate = rule.rsplit('=', 1)
+        limit, window = rate.split('/')
+        limits.append(RateLimit(path.strip(), int(limit), int(window)))
+    return sorted(limits, key=lambda rate_limit: len(rate_limit.path), reverse=True)
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated_at')
+
+    def __init__(self, tokens: float, updated_at: float) -> None:
+        self.tokens = tokens
+        self.updated_at = updated_at
+
+
+class RateLimitMiddleware:
+    """
+    Limits requests and websocket connects per session (x-session-id) and
+    per client IP. The client picks its session id, so the IP gets a budget
+    of ``ip_factor`` sessions and rotating session ids does not get around
+    it. A local token bucket turns floods away without a round trip, a Redis
+    sliding window counter keeps the limit across workers and nodes.
+    """
+
+    KEY_PREFIX = 'ratelimit'
+
+    def __init__(self, app: ASGIApp, limits: Optional[List[RateLimit]] = None,
+                 cache_size: int = RATE_LIMIT_CACHE_SIZE, ip_factor: int = RATE_LIMIT_IP_FACTOR) -> None:
+        self.app = app
+        self.limits = parse_rate_limits(RATE_LIMITS) if limits is None else limits
+        self.cache_size = cache_size
+        self.ip_factor = ip_factor
+        self.buckets: OrderedDict = OrderedDict()
+        self.limited = 0
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] not in (
+            "http",
+            "websocket",
+        ):  # pragma: no cover
+            await self.app(scope, receive, send)
+            return
+
+        rate_limit = self.__match(scope["path"])
+        if rate_limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        budgets = [(identity, rate_limit._replace(limit=rate_limit.limit * factor))
+                   for identity, factor in self.identities(scope)]
+        allowed, retry_after = True, 0
+        for identity, budget in budgets:
+            allowed, retry_after = self.__take(budget, identity)
+            if not allowed:
+                break
+        if allowed:
+            allowed, retry_after = await self.__check_window(scope, budgets)
+
+        if allowed:
+            await self.app(scope, receive, send)
+            return
+
+        self.limited += 1
+        if scope["type"] == 'websocket':
+            websocket = WebSocket(scope=scope, receive=receive, send=send)
+            await websocket.close(code=WS_1008_POLICY_VIOLATION)
+        else:
+            response = PlainTextResponse("Too many requests.", status_code=HTTP_429_TOO_MANY_REQUESTS,
+                                         headers={"Retry-After": str(retry_after)})
+            await response(scope, receive, send)
+
+    def identities(self, scope: Scope) -> List[Tuple[str, int]]:
+        """
+        (identity, limit factor) pairs the request counts against. The
+        client address is the one uvicorn resolved with --proxy-headers from
+        the proxies in --forwarded-allow-ips, forwarding headers sent by the
+        client itself are not trusted. Browsers cannot set headers on a
+        websocket handshake, connects count against their channel instead.
+        """
+        client = scope.get("client")
+        ip = (f"ip:{client[0] if client else '-'}", self.ip_factor)
+        session_id = Headers(scope=scope).get("x-session-id")
+        if session_id:
+            return [(f"session:{session_id}", 1), ip]
+        if scope["type"] == "websocket":
+            return [(f"channel:{scope['path'].rstrip('/').rsplit('/', 1)[-1]}", 1), ip]
+        return [(ip[0], 1)]
+
+    def __match(self, path: str) -> Optional[RateLimit]:
+        for rate_limit in self.limits:
+            if path.startswith(rate_limit.path):
+                return rate_limit
+
+    def __take(self, rate_limit: RateLimit, identity: str) -> Tuple[bool, int]:
+        now = time.monotonic()
+        key = (rate_limit.path, identity)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(rate_limit.limit, now)
+            if len(self.buckets) > self.cache_size:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            refill = (now - bucket.updated_at) * rate_limit.limit / rate_limit.window
+            bucket.tokens = min(rate_limit.limit, bucket.tokens + refill)
+            bucket.updated_at = now
+
+        if bucket.tokens < 1:
+            return False, max(1, int((1 - bucket.tokens) * rate_limit.window / rate_limit.limit))
+        bucket.tokens -= 1
+        return True, 0
+
+    async def __check_window(self, scope: Scope, budgets: List[Tuple[str, RateLimit]]) -> Tuple[bool, int]:
+        state = getattr(scope.get("app"), "state", None)
+        db = getattr(state, "db", None)
+        if db is None:
+            return True, 0
+
+        now = time.time()
+        try:
+            async with db.redis.pipeline(transaction=False) as pipe:
+                for identity, rate_limit in budgets:
+                    current = int(now // rate_limit.window)
+                    key = f"{self.KEY_PREFIX}:{rate_limit.path}:{identity}"
+                    pipe.incr(f"{key}:{current}").expire(f"{key}:{current}", rate_limit.window * 2) \
+                        .get(f"{key}:{current - 1}")
+                results = await pipe.execute()
+        except Exception as e:
+            logger.warning("--- RATE LIMIT ERROR ---")
+            logger.warning(e)
+            logger.warning("--- RATE LIMIT ERROR ---")
+            return True, 0
+
+        for i, (_, rate_limit) in enumerate(budgets):
+            hits, _, previous = results[i * 3:i * 3 + 3]
+            elapsed = now % rate_limit.window
+            weighted = int(previous or 0) * (1 - elapsed / rate_limit.window) + int(hits)
+            if weighted > rate_limit.limit:
+                return False, max(1, int(rate_limit.window - elapsed))
+        return True, 0
@@ -0,0 +1,206 @@
+import asyncio
+from collections import deque
+from typing import Iterable, Optional, Set, Tuple
+
+from fastapi import WebSocket
+from loguru import logger
+from starlette.status import WS_1013_TRY_AGAIN_LATER
+
+from core import serialization
+
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+
+SLOW_CONSUMER_POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+EVENT_ID_PREFIX = '{"event_id":"'
+
+
+def message_frame(channel: str, data: str) -> dict:
+    """
+    Wraps a payload the same way frames relayed from Redis pub/sub look.
+    """
+    return {"type": "message", "pattern": None, "channel": channel, "data": data}
+
+
+def tag_event(data: str, event_id: str) -> str:
+    """
+    Puts the stream id of an event first into its serialized payload, where
+    event_position() finds it without parsing the JSON.
+    """
+    if not isinstance(data, str) or not data.startswith('{') or data.startswith('{}'):
+        return data
+    return f'{EVENT_ID_PREFIX}{event_id}",{data[1:]}'
+
+
+def parse_event_id(event_id: str) -> Optional[Tuple[int, int]]:
+    try:
+        ms, seq = event_id.split('-')
+        return int(ms), int(seq)
+    except (AttributeError, ValueError):
+        return None
+
+
+def event_position(data) -> Optional[Tuple[int, int]]:
+    if not isinstance(data, str) or not data.startswith(EVENT_ID_PREFIX):
+        return None
+    return parse_event_id(data[len(EVENT_ID_PREFIX):data.find('"', len(EVENT_ID_PREFIX))])
+
+
+def coalesce_key(frame: dict) -> Optional[str]:
+    """
+    Frames describing chat state (SYS intro frames) supersede each other,
+    regular IN/OUT messages never do.
+    """
+    try:
+        data = serialization.loads(frame['data'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    if isinstance(data, dict) and data.get('direction') == 'SYS':
+        return 'SYS'
+
+
+class DeliveryStats:
+
+    def __init__(self) -> None:
+        self.connections: Set['SocketConnection'] = set()
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.disconnected = 0
+
+    def snapshot(self) -> dict:
+        depths = [connection.depth for connection in self.connections]
+        return {"connections": len(depths),
+                "queued": sum(depths),
+                "max_queue_depth": max(depths, default=0),
+                "delivered": self.delivered,
+                "dropped": self.dropped,
+                "coalesced": self.coalesced,
+                "disconnected": self.disconnected}
+
+
+delivery_stats = DeliveryStats()
+
+
+class SocketConnection:
+    """
+    Bounded outbound queue of a single websocket. Frames are pushed by the
+    subscription hub and written by a dedicated sender task, so a slow
+    browser only ever backs up its own queue.
+    """
+
+    def __init__(self, websocket: WebSocket, max_queue: int = 100, policy: str = DROP_OLDEST,
+                 stats: DeliveryStats = delivery_stats) -> None:
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.policy = policy
+        self.stats = stats
+        self.frames = deque()
+        self.dropped = 0
+        self.coalesced = 0
+        self.overflowed = False
+        self.held: Optional[list] = None
+        self.after: Optional[Tuple[int, int]] = None
+        self._wakeup = asyncio.Event()
+        self.stats.connections.add(self)
+
+    @property
+    def depth(self) -> int:
+        return len(self.frames)
+
+    def hold(self) -> None:
+        """
+        Keeps live frames back until resume() queued the replayed ones.
+        """
+        self.held = []
+
+    def resume(self, frames: Iterable[dict] = (), after: Optional[Tuple[int, int]] = None) -> None:
+        """
+        Queues the replayed ``frames``, then the held live frames. From then
+        on frames of events at or before ``after`` or the last replayed one
+        are duplicates and skipped.
+        """
+        held, self.held = self.held or [], None
+        for frame in frames:
+            self.push(frame)
+            position = event_position(frame['data'])
+            if position is not None and (after is None or position > after):
+                after = position
+        self.after = after
+        for frame in held:
+            self.push(frame)
+
+    def push(self, frame: dict) -> None:
+        if self.overflowed:
+            return
+
+        if self.held is not None:
+            self.held.append(frame)
+            return
+
+        if self.after is not None:
+            position = event_position(frame['data'])
+            if position is not None and position <= self.after:
+                return
+
+        if len(self.frames) >= self.max_queue and not self.__make_room(frame):
+            return
+
+        self.frames.append(frame)
+        self._wakeup.set()
+
+    def __make_room(self, frame: dict) -> bool:
+        if self.policy == DISCONNECT:
+            self.overflowed = True
+            self.stats.disconnected += 1
+            self._wakeup.set()
+            return False
+
+        if self.policy == COALESCE:
+            key = coalesce_key(frame)
+            if key is not None:
+                for i, pending in enumerate(self.frames):
+                    if coalesce_key(pending) == key:
+                        del self.frames[i]
+                        self.coalesced += 1
+                        self.stats.coalesced += 1
+                        return True
+
+        self.frames.popleft()
+        self.dropped += 1
+        self.stats.dropped += 1
+        return True
+
+    async def run(self) -> None:
+        try:
+            while True:
+                if not self.frames and not self.overflowed:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+
+                if self.overflowed:
+                    logger.debug("WS slow consumer disconnected")
+                    await self.websocket.close(code=WS_1013_TRY_AGAIN_LATER)
+                    return
+
+                # payloads are already serialized by the publisher, relay them as they are
+                data = self.frames.popleft()['data']
+                if isinstance(data, bytes):
+                    await self.websocket.send_bytes(data)
+                else:
+                    await self.websocket.send_text(data)
+                self.stats.delivered += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.debug(f"WS send failed: {e}")
+
+    def close(self) -> None:
+        self.frames.clear()
+        self.stats.connections.discard(self)
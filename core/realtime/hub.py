@@ -0,0 +1,162 @@
+import asyncio
+from collections import defaultdict
+from typing import Callable, Dict, Set
+
+from aioredis import Redis
+from loguru import logger
+
+from core.realtime.sharding import RedisShards
+
+
+class SubscriptionHub:
+    """
+    Owns the single pub/sub connection of a worker and fans every incoming
+    message out to the local listeners registered for its channel.
+    """
+
+    def __init__(self, redis: Redis, poll_timeout: float = 1.0, confirm_timeout: float = 5.0) -> None:
+        self.redis = redis
+        self.poll_timeout = poll_timeout
+        self.confirm_timeout = confirm_timeout
+        self.pubsub = redis.pubsub()
+        self.listeners: Dict[str, Set[Callable]] = defaultdict(set)
+        self.confirmations: Dict[str, asyncio.Future] = {}
+        self._lock = asyncio.Lock()
+        self._ready = asyncio.Event()
+        self._reader = None
+
+    async def start(self) -> None:
+        self._reader = asyncio.ensure_future(self.__read())
+
+    async def stop(self) -> None:
+        if self._reader:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+        self.listeners.clear()
+        await self.pubsub.reset()
+
+    async def subscribe(self, channel: str, listener: Callable) -> None:
+        """
+        Returns once Redis confirmed the subscription of the channel, so
+        nothing published afterwards can be missed by the listener.
+        """
+        async with self._lock:
+            listeners = self.listeners[channel]
+            listeners.add(listener)
+            if len(listeners) == 1:
+                self.confirmations[channel] = asyncio.get_event_loop().create_future()
+                try:
+                    await self.pubsub.subscribe(channel)
+                except Exception:
+                    del self.listeners[channel]
+                    self.confirmations.pop(channel).cancel()
+                    raise
+                self._ready.set()
+            confirmed = self.confirmations.get(channel)
+
+        if confirmed and not confirmed.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(confirmed), timeout=self.confirm_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Subscription of {channel} was not confirmed in {self.confirm_timeout}s")
+
+    async def unsubscribe(self, channel: str, listener: Callable) -> None:
+        async with self._lock:
+            listeners = self.listeners.get(channel)
+            if not listeners:
+                return
+
+            listeners.discard(listener)
+            if not listeners:
+                del self.listeners[channel]
+                confirmed = self.confirmations.pop(channel, None)
+                if confirmed:
+                    confirmed.cancel()
+                await self.pubsub.unsubscribe(channel)
+
+    def subscribers(self, channel: str) -> int:
+        return len(self.listeners.get(channel, ()))
+
+    def __confirm(self, message: dict) -> None:
+        confirmed = self.confirmations.pop(message['channel'], None)
+        if confirmed and not confirmed.done():
+            confirmed.set_result(True)
+
+    def __dispatch(self, message: dict) -> None:
+        for listener in tuple(self.listeners.get(message['channel'], ())):
+            try:
+                listener(message)
+            except Exception as e:
+                logger.exception(e)
+
+    async def __reconnect(self) -> None:
+        connection = self.pubsub.connection
+        if connection is None:
+            return
+        try:
+            # the pubsub on_connect callback re-subscribes every known channel
+            await connection.connect()
+        except Exception as e:
+            logger.warning(e)
+
+    async def __read(self) -> None:
+        while True:
+            await self._ready.wait()
+            try:
+                message = await self.pubsub.get_message(timeout=self.poll_timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("--- PUBSUB READ ERROR ---")
+                logger.warning(e)
+                logger.warning("--- PUBSUB READ ERROR ---")
+                await asyncio.sleep(self.poll_timeout)
+                await self.__reconnect()
+                continue
+
+            if not message:
+                continue
+            if message['type'] == 'subscribe':
+                self.__confirm(message)
+            elif message['type'] == 'message' and message.get('data'):
+                self.__dispatch(message)
+
+
+class ShardedSubscriptionHub:
+    """
+    One SubscriptionHub per Redis shard; every channel is subscribed on the
+    shard its publishers resolve it to.
+    """
+
+    def __init__(self, shards: RedisShards, poll_timeout: float = 1.0, confirm_timeout: float = 5.0) -> None:
+        self.shards = shards
+        self.hubs: Dict[str, SubscriptionHub] = {
+            name: SubscriptionHub(redis, poll_timeout=poll_timeout, confirm_timeout=confirm_timeout)
+            for name, redis in shards.items()
+        }
+
+    def hub(self, channel: str) -> SubscriptionHub:
+        return self.hubs[self.shards.name(channel)]
+
+    async def start(self) -> None:
+        for hub in self.hubs.values():
+            await hub.start()
+
+    async def stop(self) -> None:
+        for hub in self.hubs.values():
+            await hub.stop()
+
+    async def subscribe(self, channel: str, listener: Callable) -> None:
+        await self.hub(channel).subscribe(channel, listener)
+
+    async def unsubscribe(self, channel: str, listener: Callable) -> None:
+        await self.hub(channel).unsubscribe(channel, listener)
+
+    def subscribers(self, channel: str) -> int:
+        return self.hub(channel).subscribers(channel)
+
+    def snapshot(self) -> dict:
+        return {name: len(hub.listeners) for name, hub in self.hubs.items()}
@@ -0,0 +1,116 @@
+import asyncio
+import os
+import socket
+import time
+from collections import defaultdict
+from typing import Dict, Optional, Set
+
+from aioredis import Redis
+from loguru import logger
+
+from core.config import PRESENCE_HEARTBEAT_INTERVAL, PRESENCE_TTL
+
+NODES_KEY = 'chat:presence:nodes'
+NODE_PREFIX = 'chat:presence:node:'
+
+
+class PresenceRegistry:
+    """
+    Sockets of this worker grouped by session. Every worker keeps a sorted
+    set of its online sessions scored by last-seen time, refreshed by a
+    heartbeat, and registers itself in a sorted set of nodes; readers only
+    ever range over live entries, so queries cost O(online).
+    """
+
+    def __init__(self, node: Optional[str] = None, interval: float = 15.0, ttl: float = 45.0) -> None:
+        self.node = node or f"{socket.gethostname()}:{os.getpid()}"
+        self.interval = interval
+        self.ttl = ttl
+        self.redis: Optional[Redis] = None
+        self.connections: Dict[str, Set] = defaultdict(set)
+        self.heartbeat = None
+
+    @property
+    def key(self) -> str:
+        return f"{NODE_PREFIX}{self.node}"
+
+    async def start(self, redis: Redis) -> None:
+        self.redis = redis
+        self.heartbeat = asyncio.ensure_future(self.__run())
+
+    async def stop(self) -> None:
+        if self.heartbeat:
+            self.heartbeat.cancel()
+            try:
+                await self.heartbeat
+            except asyncio.CancelledError:
+                pass
+        if self.redis is not None:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                await pipe.zrem(NODES_KEY, self.node).delete(self.key).execute()
+
+    async def join(self, session_id: str, connection) -> None:
+        first = not self.connections[session_id]
+        self.connections[session_id].add(connection)
+        if first:
+            now = time.time()
+            await self.__write(lambda pipe: pipe.zadd(self.key, {session_id: now}).zadd(NODES_KEY, {self.node: now}))
+
+    async def leave(self, session_id: str, connection) -> None:
+        connections = self.connections.get(session_id)
+        if not connections:
+            return
+
+        connections.discard(connection)
+        if not connections:
+            del self.connections[session_id]
+            await self.__write(lambda pipe: pipe.zrem(self.key, session_id))
+
+    async def beat(self) -> None:
+        now = time.time()
+
+        def refresh(pipe):
+            if self.connections:
+                pipe.zadd(self.key, {session_id: now for session_id in self.connections})
+            return pipe.zremrangebyscore(self.key, '-inf', now - self.ttl) \
+                .expire(self.key, int(self.ttl * 2)) \
+                .zadd(NODES_KEY, {self.node: now}) \
+                .zremrangebyscore(NODES_KEY, '-inf', now - self.ttl)
+
+        await self.__write(refresh)
+
+    async def online(self) -> dict:
+        since = time.time() - self.ttl
+        nodes = await self.redis.zrangebyscore(NODES_KEY, since, '+inf')
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for node in nodes:
+                pipe.zrangebyscore(f"{NODE_PREFIX}{node}", since, '+inf')
+            sessions = await pipe.execute() if nodes else []
+
+        return {"online": len(set().union(*sessions)),
+                "sessions": sorted(set().union(*sessions)),
+                "nodes": {node: len(node_sessions) for node, node_sessions in zip(nodes, sessions)}}
+
+    def snapshot(self) -> dict:
+        return {"node": self.node,
+                "sessions": len(self.connections),
+                "connections": sum(map(len, self.connections.values()))}
+
+    async def __write(self, commands) -> None:
+        if self.redis is None:
+            return
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                await commands(pipe).execute()
+        except Exception as e:
+            logger.warning("--- PRESENCE ERROR ---")
+            logger.warning(e)
+            logger.warning("--- PRESENCE ERROR ---")
+
+    async def __run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.beat()
+
+
+presence = PresenceRegistry(interval=PRESENCE_HEARTBEAT_INTERVAL, ttl=PRESENCE_TTL)
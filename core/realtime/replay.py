@@ -0,0 +1,129 @@
+import asyncio
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from core.realtime.delivery import message_frame, tag_event, parse_event_id
+from core.realtime.sharding import RedisShards
+
+MAX_SEQUENCE = 2 ** 64 - 1
+
+
+class ReplayBuffer:
+    """
+    Short-lived durable copy of the session channels. Every published event
+    is also added to a Redis Stream of its channel, on the channel's shard,
+    capped at about ``maxlen`` entries and expiring ``ttl`` seconds after
+    the last event. The stream id is the ``event_id`` of the frame, a socket
+    reconnecting with it gets the events it missed before the live ones.
+    """
+
+    STREAM_KEY = 'chat:stream:'
+
+    def __init__(self, shards: RedisShards, maxlen: int = 100, ttl: int = 600) -> None:
+        self.shards = shards
+        self.maxlen = maxlen
+        self.ttl = ttl
+        self.recorded = 0
+        self.failures = 0
+        self.resumed = 0
+        self.replayed = 0
+        self.resynced = 0
+
+    def key(self, channel: str) -> str:
+        return f"{self.STREAM_KEY}{channel}"
+
+    @staticmethod
+    def position(last_event_id: Optional[str] = None, since: Optional[int] = None) -> Optional[Tuple[int, int]]:
+        """
+        Last event seen by a client, given as its event id or as the
+        ``created_at`` second of its last message.
+        """
+        if last_event_id:
+            return parse_event_id(last_event_id)
+        if since:
+            # events of that second may not have been seen yet
+            return since * 1000 - 1, MAX_SEQUENCE
+        return None
+
+    async def record(self, messages: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """
+        Adds the (channel, payload) pairs to their streams, one pipeline per
+        shard, and returns them with payloads tagged by their event id. On a
+        failing shard the payloads go out untagged and cannot be replayed.
+        """
+        tagged = list(messages)
+        shards: Dict[str, List[int]] = defaultdict(list)
+        for i, (channel, _) in enumerate(messages):
+            shards[self.shards.name(channel)].append(i)
+
+        async def add(name: str, indexes: List[int]) -> None:
+            try:
+                async with self.shards.client(messages[indexes[0]][0]).pipeline(transaction=False) as pipe:
+                    for i in indexes:
+                        channel, payload = messages[i]
+                        pipe.xadd(self.key(channel), {'data': payload}, maxlen=self.maxlen, approximate=True)
+                        pipe.expire(self.key(channel), self.ttl)
+                    results = await pipe.execute()
+                for i, event_id in zip(indexes, results[::2]):
+                    tagged[i] = (messages[i][0], tag_event(messages[i][1], event_id))
+                self.recorded += len(indexes)
+            except Exception as e:
+                self.failures += len(indexes)
+                logger.warning("--- REPLAY BUFFER RECORD ERROR ---")
+                logger.warning(f"{name}: {e}")
+                logger.warning("--- REPLAY BUFFER RECORD ERROR ---")
+
+        await asyncio.gather(*(add(name, indexes) for name, indexes in shards.items()))
+        return tagged
+
+    async def publish(self, channel: str, message: str) -> int:
+        [(channel, message)] = await self.record([(channel, message)])
+        return await self.shards.publish(channel, message)
+
+    async def publish_many(self, messages: List[Tuple[str, str]]) -> List[Optional[int]]:
+        return await self.shards.publish_many(await self.record(messages))
+
+    async def since(self, channel: str, position: Tuple[int, int]) -> Optional[List[dict]]:
+        """
+        Frames of the events after ``position`` in publishing order, or None
+        when the stream was trimmed or expired past it and some may be gone.
+        """
+        key = self.key(channel)
+        start = f"{position[0]}-{position[1]}" if position[1] < MAX_SEQUENCE else f"{position[0] + 1}-0"
+        try:
+            async with self.shards.client(channel).pipeline(transaction=False) as pipe:
+                pipe.xlen(key)
+                pipe.xrange(key, '-', '+', count=1)
+                pipe.xrange(key, start, '+')
+                length, oldest, entries = await pipe.execute()
+        except Exception as e:
+            logger.warning("--- REPLAY BUFFER READ ERROR ---")
+            logger.warning(e)
+            logger.warning("--- REPLAY BUFFER READ ERROR ---")
+            self.resynced += 1
+            return None
+
+        # the stream covers the position unless it expired or was trimmed since
+        expired = time.time() * 1000 - position[0] >= self.ttl * 1000
+        trimmed = bool(oldest) and length >= self.maxlen and parse_event_id(oldest[0][0]) > position
+        if expired or trimmed:
+            self.resynced += 1
+            return None
+
+        frames = [message_frame(channel, tag_event(fields['data'], event_id))
+                  for event_id, fields in entries if parse_event_id(event_id) > position]
+        self.resumed += 1
+        self.replayed += len(frames)
+        return frames
+
+    def snapshot(self) -> dict:
+        return {"maxlen": self.maxlen,
+                "ttl": self.ttl,
+                "recorded": self.recorded,
+                "failures": self.failures,
+                "resumed": self.resumed,
+                "replayed": self.replayed,
+                "resynced": self.resynced}
@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+from bisect import bisect, insort
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from aioredis import Redis
+from loguru import logger
+
+from core.metrics import messages_published
+
+PRIMARY = 'primary'
+
+
+def shard_name(url: str) -> str:
+    """
+    redis://:secret@redis-2:6379/8 -> redis-2:6379/8; the name places the
+    node on the ring, so it must not change with credentials.
+    """
+    parts = urlsplit(url)
+    return f"{parts.hostname}:{parts.port or 6379}{parts.path or '/0'}"
+
+
+class HashRing:
+    """
+    Consistent hash ring. Every node owns `replicas` points, adding or
+    removing a node only moves the keys that land next to its points, about
+    1/N of them. Hashes are md5 based so every worker agrees on the ring.
+    """
+
+    def __init__(self, nodes: Iterable[str] = (), replicas: int = 160) -> None:
+        self.replicas = replicas
+        self.points: List[Tuple[int, str]] = []
+        self.keys: List[int] = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    @property
+    def nodes(self) -> List[str]:
+        return sorted({node for _, node in self.points})
+
+    def add(self, node: str) -> None:
+        if node in self.nodes:
+            return
+        for replica in range(self.replicas):
+            insort(self.points, (self.hash(f"{node}#{replica}"), node))
+        self.keys = [point for point, _ in self.points]
+
+    def remove(self, node: str) -> None:
+        self.points = [(point, owner) for point, owner in self.points if owner != node]
+        self.keys = [point for point, _ in self.points]
+
+    def node(self, key: str) -> str:
+        if not self.points:
+            raise LookupError("Hash ring is empty")
+        return self.points[bisect(self.keys, self.hash(key)) % len(self.points)][1]
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+
+class RedisShards:
+    """
+    Redis connections carrying the chat pub/sub traffic. A session channel
+    always resolves to the same shard, for publishers and the subscription
+    hub alike. Pinned channels stay on the primary connection, they are
+    published together with writes to it.
+    """
+
+    def __init__(self, clients: Dict[str, Redis], primary: Optional[Redis] = None,
+                 pinned: Iterable[str] = (), replicas: int = 160) -> None:
+        self.clients = clients
+        self.primary = primary
+        self.pinned = frozenset(pinned) if primary is not None else frozenset()
+        self.primary_name = next((name for name, client in clients.items() if client is primary), PRIMARY)
+        self.ring = HashRing(clients, replicas=replicas)
+
+    def name(self, channel: str) -> str:
+        if channel in self.pinned:
+            return self.primary_name
+        return self.ring.node(channel)
+
+    def client(self, channel: str) -> Redis:
+        name = self.name(channel)
+        return self.primary if name == PRIMARY else self.clients[name]
+
+    def items(self) -> List[Tuple[str, Redis]]:
+        items = list(self.clients.items())
+        if self.pinned and self.primary_name == PRIMARY:
+            items.append((PRIMARY, self.primary))
+        return items
+
+    async def publish(self, channel: str, message) -> int:
+        receivers = await self.client(channel).publish(channel, message)
+        messages_published.labels(self.name(channel)).inc()
+        return receivers
+
+    async def publish_many(self, messages: List[Tuple[str, str]]) -> List[Optional[int]]:
+        """
+        One pipeline per shard, all shards at once. Returns the receivers of
+        every message, None where its shard could not be reached.
+        """
+        batches: Dict[str, List[int]] = defaultdict(list)
+        for i, (channel, _) in enumerate(messages):
+            batches[self.name(channel)].append(i)
+
+        receivers: List[Optional[int]] = [None] * len(messages)
+
+        async def send(name: str, indexes: List[int]) -> None:
+            try:
+                async with self.client(messages[indexes[0]][0]).pipeline(transaction=False) as pipe:
+                    for i in indexes:
+                        pipe.publish(*messages[i])
+                    for i, count in zip(indexes, await pipe.execute()):
+                        receivers[i] = count
+                messages_published.labels(name).inc(len(indexes))
+            except Exception as e:
+                logger.warning("--- REDIS SHARD PUBLISH ERROR ---")
+                logger.warning(f"{name}: {e}")
+                logger.warning("--- REDIS SHARD PUBLISH ERROR ---")
+
+        await asyncio.gather(*(send(name, indexes) for name, indexes in batches.items()))
+        return receivers
+
+    async def close(self) -> None:
+        for name, client in self.clients.items():
+            if client is self.primary:
+                continue
+            try:
+                await client.close()
+            except Exception as e:
+                logger.warning("--- REDIS SHARD CLOSE ERROR ---")
+                logger.warning(f"{name}: {e}")
+                logger.warning("--- REDIS SHARD CLOSE ERROR ---")
+
+    def snapshot(self) -> dict:
+        return {"shards": self.ring.nodes, "replicas": self.ring.replicas, "pinned": sorted(self.pinned)}
@@ -0,0 +1,49 @@
+"""
+JSON backend for payloads published to the chat channels. Events are
+serialized once at publish time and relayed to the websockets untouched, so
+this is the only place that decides how fast that happens.
+"""
+import json
+from typing import Any, Callable, Tuple
+
+from loguru import logger
+
+from core.config import JSON_BACKEND
+
+BACKENDS = ('orjson', 'ujson', 'json')
+
+
+def _orjson() -> Tuple[Callable[[Any], str], Callable]:
+    import orjson
+
+    return lambda obj: orjson.dumps(obj).decode(), orjson.loads
+
+
+def _ujson() -> Tuple[Callable[[Any], str], Callable]:
+    import ujson
+
+    return lambda obj: ujson.dumps(obj, ensure_ascii=False), ujson.loads
+
+
+def _json() -> Tuple[Callable[[Any], str], Callable]:
+    return lambda obj: json.dumps(obj, ensure_ascii=False, separators=(',', ':')), json.loads
+
+
+_FACTORIES = {'orjson': _orjson, 'ujson': _ujson, 'json': _json}
+
+
+def load_backend(name: str = 'auto') -> Tuple[str, Callable[[Any], str], Callable]:
+    if name != 'auto' and name not in _FACTORIES:
+        raise ValueError(f"Unknown JSON backend: {name}")
+
+    for candidate in BACKENDS if name == 'auto' else (name,):
+        try:
+            return (candidate, *_FACTORIES[candidate]())
+        except ImportError:
+            continue
+
+    logger.warning(f"JSON backend {name} is not installed, falling back to json")
+    return ('json', *_json())
+
+
+backend, dumps, loads = load_backend(JSON_BACKEND)
@@ -1,20 +1,240 @@
+import asyncio
+import os
 from typing import Callable
 
 from fastapi import FastAPI
+from loguru import logger
 
+from core.clients.crm import crm_outbox
+from core.clients.queue_services import rabbit_publisher
+from core.config import GEOIP_DATASET, GEOIP_RELOAD_INTERVAL, CONTENT_REFRESH_INTERVAL, WS_SLOW_CONSUMER_POLICY
+from core.geoip import geoip
+from core.metrics import messages_delivered, messages_dropped, queue_depth, pool_connections
+from core.realtime.delivery import SLOW_CONSUMER_POLICIES, delivery_stats
+from core.realtime.hub import ShardedSubscriptionHub
+from core.realtime.presence import presence
+from db.repositories.cache import SESSION_INVALIDATE_CHANNEL
+from db.repositories.content import CONTENT_INVALIDATE_CHANNEL
 from db.tasks import connect_to_db, close_db_connection
 
 
+def check_delivery_settings() -> None:
+    # fails the startup instead of every websocket handshake
+    if WS_SLOW_CONSUMER_POLICY not in SLOW_CONSUMER_POLICIES:
+        raise ValueError(f"WS_SLOW_CONSUMER_POLICY must be one of {', '.join(SLOW_CONSUMER_POLICIES)}, "
+                         f"got {WS_SLOW_CONSUMER_POLICY!r}")
+
+
+async def start_subscription_hub(app: FastAPI) -> None:
+    try:
+        app.state.hub = ShardedSubscriptionHub(app.state.db.pubsub)
+        await app.state.hub.start()
+        await app.state.hub.subscribe(SESSION_INVALIDATE_CHANNEL, app.state.db.sessions.on_invalidate)
+        await app.state.hub.subscribe(CONTENT_INVALIDATE_CHANNEL, app.state.db.content.on_invalidate)
+    except Exception as e:
+        logger.warning("--- SUBSCRIPTION HUB START ERROR ---")
+        logger.warning(e)
+        logger.warning("--- SUBSCRIPTION HUB START ERROR ---")
+
+
+async def stop_subscription_hub(app: FastAPI) -> None:
+    try:
+        await app.state.hub.stop()
+    except Exception as e:
+        logger.warning("--- SUBSCRIPTION HUB STOP ERROR ---")
+        logger.warning(e)
+        logger.warning("--- SUBSCRIPTION HUB STOP ERROR ---")
+
+
+async def start_presence_registry(app: FastAPI) -> None:
+    try:
+        await presence.start(app.state.db.redis)
+    except Exception as e:
+        logger.warning("--- PRESENCE START ERROR ---")
+        logger.warning(e)
+        logger.warning("--- PRESENCE START ERROR ---")
+
+
+async def stop_presence_registry(app: FastAPI) -> None:
+    try:
+        await presence.stop()
+    except Exception as e:
+        logger.warning("--- PRESENCE STOP ERROR ---")
+        logger.warning(e)
+        logger.warning("--- PRESENCE STOP ERROR ---")
+
+
+async def load_geoip_dataset(app: FastAPI) -> None:
+    app.state.geoip_watcher = None
+    if not GEOIP_DATASET or not os.path.exists(GEOIP_DATASET):
+        logger.warning("--- GEOIP DATASET MISSING ---")
+        logger.warning(f"GEOIP_DATASET={GEOIP_DATASET!r} is not a file, visitors will be created as 'nowhere'")
+        logger.warning("--- GEOIP DATASET MISSING ---")
+        return
+
+    try:
+        await geoip.reload(GEOIP_DATASET)
+        app.state.geoip_watcher = asyncio.ensure_future(geoip.watch(GEOIP_RELOAD_INTERVAL))
+    except Exception as e:
+        logger.warning("--- GEOIP LOAD ERROR ---")
+        logger.warning(e)
+        logger.warning("--- GEOIP LOAD ERROR ---")
+
+
+async def stop_geoip_watcher(app: FastAPI) -> None:
+    if app.state.geoip_watcher:
+        app.state.geoip_watcher.cancel()
+
+
+async def load_chat_content(app: FastAPI) -> None:
+    app.state.content_watcher = None
+    try:
+        await app.state.db.content.load()
+        app.state.content_watcher = asyncio.ensure_future(app.state.db.content.watch(CONTENT_REFRESH_INTERVAL))
+    except Exception as e:
+        logger.warning("--- CHAT CONTENT LOAD ERROR ---")
+        logger.warning(e)
+        logger.warning("--- CHAT CONTENT LOAD ERROR ---")
+
+
+async def stop_content_watcher(app: FastAPI) -> None:
+    if app.state.content_watcher:
+        app.state.content_watcher.cancel()
+
+
+async def start_crm_outbox(app: FastAPI) -> None:
+    try:
+        await crm_outbox.start(app.state.db.redis)
+    except Exception as e:
+        logger.warning("--- CRM OUTBOX START ERROR ---")
+        logger.warning(e)
+        logger.warning("--- CRM OUTBOX START ERROR ---")
+
+
+async def stop_crm_outbox(app: FastAPI) -> None:
+    try:
+        await crm_outbox.stop()
+    except Exception as e:
+        logger.warning("--- CRM OUTBOX STOP ERROR ---")
+        logger.warning(e)
+        logger.warning("--- CRM OUTBOX STOP ERROR ---")
+
+
+async def start_rabbit_publisher(app: FastAPI) -> None:
+    try:
+        await rabbit_publisher.start()
+    except Exception as e:
+        logger.warning("--- RABBITMQ PUBLISHER START ERROR ---")
+        logger.warning(e)
+        logger.warning("--- RABBITMQ PUBLISHER START ERROR ---")
+
+
+async def stop_rabbit_publisher(app: FastAPI) -> None:
+    try:
+        await rabbit_publisher.stop()
+    except Exception as e:
+        logger.warning("--- RABBITMQ PUBLISHER STOP ERROR ---")
+        logger.warning(e)
+        logger.warning("--- RABBITMQ PUBLISHER STOP ERROR ---")
+
+
+async def start_message_writer(app: FastAPI) -> None:
+    try:
+        await app.state.db.messages.start()
+    except Exception as e:
+        logger.warning("--- MESSAGE WRITER START ERROR ---")
+        logger.warning(e)
+        logger.warning("--- MESSAGE WRITER START ERROR ---")
+
+
+async def stop_message_writer(app: FastAPI) -> None:
+    try:
+        await app.state.db.messages.stop()
+    except Exception as e:
+        logger.warning("--- MESSAGE WRITER STOP ERROR ---")
+        logger.warning(e)
+        logger.warning("--- MESSAGE WRITER STOP ERROR ---")
+
+
+async def start_message_archiver(app: FastAPI) -> None:
+    try:
+        await app.state.db.archiver.start()
+    except Exception as e:
+        logger.warning("--- MESSAGE ARCHIVER START ERROR ---")
+        logger.warning(e)
+        logger.warning("--- MESSAGE ARCHIVER START ERROR ---")
+
+
+async def stop_message_archiver(app: FastAPI) -> None:
+    try:
+        await app.state.db.archiver.stop()
+    except Exception as e:
+        logger.warning("--- MESSAGE ARCHIVER STOP ERROR ---")
+        logger.warning(e)
+        logger.warning("--- MESSAGE ARCHIVER STOP ERROR ---")
+
+
+def _pool_connections(app: FastAPI) -> dict:
+    connections = {}
+    redis_pool = getattr(app.state.db.redis, 'connection_pool', None)
+    if hasattr(redis_pool, '_in_use_connections'):
+        connections[('redis', 'in_use')] = len(redis_pool._in_use_connections)
+        connections[('redis', 'idle')] = len(redis_pool._available_connections)
+
+    # asyncpg pool of the databases backend, absent on SQLite
+    db_pool = getattr(app.state.db.db._backend, '_pool', None)
+    if hasattr(db_pool, 'get_idle_size'):
+        idle = db_pool.get_idle_size()
+        connections[('postgres', 'in_use')] = db_pool.get_size() - idle
+        connections[('postgres', 'idle')] = idle
+    return connections
+
+
+async def register_metrics(app: FastAPI) -> None:
+    try:
+        messages_delivered.set_function(lambda: delivery_stats.delivered)
+        messages_dropped.set_function(lambda: {('dropped',): delivery_stats.dropped,
+                                               ('coalesced',): delivery_stats.coalesced})
+        queue_depth.set_function(lambda: {
+            ('ws_send',): sum(connection.depth for connection in delivery_stats.connections),
+            ('crm_outbox',): crm_outbox.queue.qsize() if crm_outbox.queue else 0,
+            ('rabbit_buffer',): len(rabbit_publisher.buffer),
+            ('message_journal',): app.state.db.messages.pending,
+        })
+        pool_connections.set_function(lambda: _pool_connections(app))
+    except Exception as e:
+        logger.warning("--- METRICS REGISTRATION ERROR ---")
+        logger.warning(e)
+        logger.warning("--- METRICS REGISTRATION ERROR ---")
+
+
 def create_start_app_handler(app: FastAPI) -> Callable:
     async def start_app() -> None:
+        check_delivery_settings()
         await connect_to_db(app)
+        await start_subscription_hub(app)
+        await start_presence_registry(app)
+        await load_geoip_dataset(app)
+        await start_crm_outbox(app)
+        await start_rabbit_publisher(app)
+        await load_chat_content(app)
+        await start_message_writer(app)
+        await start_message_archiver(app)
+        await register_metrics(app)
 
     return start_app
 
 
 def create_stop_app_handler(app: FastAPI) -> Callable:
     async def stop_app() -> None:
+        await stop_message_archiver(app)
+        await stop_message_writer(app)
+        await stop_content_watcher(app)
+        await stop_rabbit_publisher(app)
+        await stop_crm_outbox(app)
+        await stop_geoip_watcher(app)
+        await stop_presence_registry(app)
+        await stop_subscription_hub(app)
         await close_db_connection(app)
 
     return stop_app
-
@@ -0,0 +1,273 @@
+"""
+Schema of the chat tables. Migrations are applied in version order and
+recorded in ``schema_migrations``; run ``python -m db.migrations`` before
+starting the workers. Every index is matched to the named queries it
+serves in QUERY_INDEXES, tests/test_migrations.py checks their plans.
+"""
+import asyncio
+import re
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from databases import Database
+from loguru import logger
+
+from core.config import DATABASE_URL
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    statements: Tuple[str, ...]
+    transactional: bool = True
+    # dialect -> query; any row means the schema already has what the migration builds
+    skip_if: Optional[Dict[str, str]] = None
+
+
+DIALECTS = {
+    'postgresql': {'serial': 'SERIAL PRIMARY KEY', 'concurrently': 'CONCURRENTLY '},
+    'sqlite': {'serial': 'INTEGER PRIMARY KEY', 'concurrently': ''},
+}
+
+CREATE_MIGRATIONS_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+LIST_APPLIED_MIGRATIONS = """
+    SELECT version FROM schema_migrations ORDER BY version;
+"""
+
+RECORD_MIGRATION = """
+    INSERT INTO schema_migrations (version, name) VALUES (:version, :name);
+"""
+
+# session level, so the key must be taken and released on the same connection; polled with
+# try rather than waited on, since CREATE INDEX CONCURRENTLY would wait for a blocked waiter
+MIGRATION_LOCK_KEY = 7_318_204_551
+MIGRATION_LOCK_INTERVAL = 1.0
+
+TRY_LOCK_MIGRATIONS = """
+    SELECT pg_try_advisory_lock(:key) AS locked;
+"""
+
+UNLOCK_MIGRATIONS = """
+    SELECT pg_advisory_unlock(:key);
+"""
+
+# a failed CREATE INDEX CONCURRENTLY leaves an INVALID index that IF NOT EXISTS would keep
+GET_INVALID_INDEX = """
+    SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE c.relname = :name AND NOT i.indisvalid;
+"""
+
+DROP_INVALID_INDEX = """
+    DROP INDEX CONCURRENTLY IF EXISTS {name};
+"""
+
+CONCURRENT_INDEX = re.compile(r'INDEX CONCURRENTLY IF NOT EXISTS (\w+)')
+
+# any valid single column unique index or constraint on tropico_chat.session_id
+SESSION_UNIQUE_INDEX = {
+    'postgresql': """
+        SELECT c.relname FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_class t ON t.oid = i.indrelid
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+        WHERE t.relname = 'tropico_chat' AND a.attname = 'session_id'
+          AND i.indisunique AND i.indisvalid AND i.indnatts = 1;
+    """,
+    'sqlite': """
+        SELECT l.name FROM pragma_index_list('tropico_chat') l JOIN pragma_index_info(l.name) c
+        WHERE l."unique" = 1
+        GROUP BY l.name HAVING COUNT(*) = 1 AND MAX(c.name) = 'session_id';
+    """,
+}
+
+MIGRATIONS = [
+    Migration(1, 'chat_tables', (
+        """
+        CREATE TABLE IF NOT EXISTS tropico_chat (
+            id {serial},
+            name TEXT,
+            city TEXT,
+            lang VARCHAR(8),
+            session_id TEXT NOT NULL,
+            email TEXT,
+            phone TEXT,
+            context TEXT,
+            is_default BOOLEAN DEFAULT TRUE,
+            ip TEXT,
+            country TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS tropico_messages (
+            id {serial},
+            name TEXT,
+            message TEXT,
+            chat_id INTEGER NOT NULL REFERENCES tropico_chat (id),
+            direction VARCHAR(8) DEFAULT 'IN',
+            status VARCHAR(16) DEFAULT 'APPROVED',
+            created_at INTEGER NOT NULL,
+            avatar TEXT
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS tropico_welcomes (
+            id {serial},
+            name TEXT,
+            message TEXT,
+            lang VARCHAR(8),
+            created_at INTEGER
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS tropico_intro (
+            id {serial},
+            message TEXT,
+            quick_replies TEXT,
+            lang VARCHAR(8)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS tropico_operators (
+            id {serial},
+            name TEXT,
+            chat_id TEXT,
+            status INTEGER DEFAULT 0
+        );
+        """,
+    )),
+    # built without locking writes on Postgres, which rules out a transaction
+    Migration(2, 'message_indexes', (
+        """
+        CREATE INDEX {concurrently}IF NOT EXISTS tropico_messages_approved_idx
+        ON tropico_messages (chat_id, id) WHERE status = 'APPROVED';
+        """,
+        """
+        CREATE INDEX {concurrently}IF NOT EXISTS tropico_messages_agent_idx
+        ON tropico_messages (chat_id, id) WHERE status = 'APPROVED' AND direction = 'OUT';
+        """,
+    ), transactional=False),
+    Migration(3, 'messages_archive', (
+        """
+        CREATE TABLE IF NOT EXISTS tropico_messages_archive (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            message TEXT,
+            chat_id INTEGER NOT NULL,
+            direction VARCHAR(8),
+            status VARCHAR(16),
+            created_at INTEGER NOT NULL,
+            avatar TEXT,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS tropico_messages_archive_chat_idx ON tropico_messages_archive (chat_id, id);
+        """,
+    )),
+    # ON CONFLICT (session_id) of CREATE_USER_CHAT needs it unique; tables that
+    # already carry a unique session_id index or constraint keep theirs
+    Migration(4, 'chat_session_index', (
+        """
+        CREATE UNIQUE INDEX {concurrently}IF NOT EXISTS tropico_chat_session_idx ON tropico_chat (session_id);
+        """,
+    ), transactional=False, skip_if=SESSION_UNIQUE_INDEX),
+]
+
+# named query of db/repositories/models.py -> index its plan has to use
+QUERY_INDEXES = {
+    'GET_USER_CHAT_ID': 'tropico_chat_session_idx',
+    'GET_CHAT_IDS_QUERY': 'tropico_chat_session_idx',
+    'UPDATE_USER_UTM': 'tropico_chat_session_idx',
+    'GET_CHAT_BOOTSTRAP_QUERY': 'tropico_messages_approved_idx',
+    'GET_USER_CHATS_PAGE_QUERY': 'tropico_messages_approved_idx',
+    'GET_USER_CHATS_BEFORE_QUERY': 'tropico_messages_approved_idx',
+    'GET_USER_CHATS_AFTER_QUERY': 'tropico_messages_approved_idx',
+    'GET_AGENT_LAST_CHAT_QUERY': 'tropico_messages_agent_idx',
+    'GET_CHAT_HISTORY_VERSION_QUERY': 'tropico_messages_approved_idx',
+}
+
+
+def render(migration: Migration, dialect: str) -> List[str]:
+    return [statement.format(**DIALECTS[dialect]) for statement in migration.statements]
+
+
+async def drop_invalid_indexes(db: Database, statements: List[str]) -> None:
+    for statement in statements:
+        for name in CONCURRENT_INDEX.findall(statement):
+            if await db.fetch_one(query=GET_INVALID_INDEX, values={"name": name}):
+                logger.warning(f"Dropping invalid index {name}")
+                await db.execute(query=DROP_INVALID_INDEX.format(name=name))
+
+
+async def apply(db: Database, migration: Migration, dialect: str) -> None:
+    statements = render(migration, dialect)
+    if dialect == 'postgresql' and not migration.transactional:
+        await drop_invalid_indexes(db, statements)
+
+    skip_if = (migration.skip_if or {}).get(dialect)
+    if skip_if and await db.fetch_one(query=skip_if):
+        logger.info(f"Skipping migration {migration.version} {migration.name}, already in place")
+        statements = []
+
+    for statement in statements:
+        await db.execute(query=statement)
+    await db.execute(query=RECORD_MIGRATION, values={"version": migration.version, "name": migration.name})
+
+
+async def lock(db: Database) -> None:
+    while not (await db.fetch_one(query=TRY_LOCK_MIGRATIONS, values={"key": MIGRATION_LOCK_KEY}))['locked']:
+        logger.info("Waiting for another migration run to finish")
+        await asyncio.sleep(MIGRATION_LOCK_INTERVAL)
+
+
+async def migrate(db: Database, migrations: List[Migration] = MIGRATIONS) -> List[int]:
+    if db.url.dialect != 'postgresql':
+        return await apply_pending(db, migrations)
+
+    async with db.connection():
+        await lock(db)
+        try:
+            return await apply_pending(db, migrations)
+        finally:
+            await db.execute(query=UNLOCK_MIGRATIONS, values={"key": MIGRATION_LOCK_KEY})
+
+
+async def apply_pending(db: Database, migrations: List[Migration]) -> List[int]:
+    dialect = db.url.dialect
+    await db.execute(query=CREATE_MIGRATIONS_TABLE)
+    applied = {row['version'] for row in await db.fetch_all(query=LIST_APPLIED_MIGRATIONS)}
+
+    versions = []
+    for migration in sorted(migrations):
+        if migration.version in applied:
+            continue
+
+        logger.info(f"Applying migration {migration.version} {migration.name}")
+        if migration.transactional:
+            async with db.transaction():
+                await apply(db, migration, dialect)
+        else:
+            await apply(db, migration, dialect)
+        versions.append(migration.version)
+    return versions
+
+
+async def main() -> None:
+    database = Database(DATABASE_URL, min_size=1, max_size=1)
+    await database.connect()
+    try:
+        applied = await migrate(database)
+        logger.info(f"Applied migrations: {applied or 'none'}")
+    finally:
+        await database.disconnect()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Optional
+from typing import Optional, List
 
 from pydantic import BaseModel, EmailStr
 
@@ -42,6 +42,15 @@ class UserChat(IDModelMixin):
     created_at: int
 
 
+class ChatBootstrap(BaseModel):
+    channel_id: str
+    direction: str = 'BOOTSTRAP'
+    chat: UserInfo
+    intro: IntroChat
+    last_agent: UserChat
+    history: List[UserChat]
+
+
 class UserForm(BaseModel):
     name: str
     email: Optional[EmailStr] = None
@@ -53,3 +62,17 @@ class OperatorTG(BaseModel):
     chat_id: str
 
 
+
+
+class AgentBroadcast(BaseModel):
+    name: str
+    message: str
+    avatar: Optional[str] = None
+    session_ids: Optional[List[str]] = None
+    online: bool = False
+
+
+class BroadcastResult(BaseModel):
+    session_id: str
+    status: str
+    receivers: int = 0
@@ -0,0 +1,150 @@
+import asyncio
+import math
+import time
+import uuid
+from typing import Optional, Tuple
+
+from aioredis import Redis
+from databases import Database
+from loguru import logger
+
+from core.config import DATABASE_URL, ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE, ARCHIVE_BATCH_PAUSE
+from db.repositories.history import HistoryBuffer
+
+LIST_ARCHIVE_CANDIDATES_QUERY = """
+    SELECT id, chat_id, created_at FROM tropico_messages WHERE id > :after_id ORDER BY id LIMIT :limit;
+"""
+
+COPY_TO_ARCHIVE = """
+    INSERT INTO tropico_messages_archive (id, name, message, chat_id, direction, status, created_at, avatar)
+    SELECT id, name, message, chat_id, direction, status, created_at, avatar
+    FROM tropico_messages WHERE id >= :first_id AND id <= :last_id AND created_at < :cutoff
+    ON CONFLICT (id) DO NOTHING;
+"""
+
+DELETE_ARCHIVED = """
+    DELETE FROM tropico_messages WHERE id >= :first_id AND id <= :last_id AND created_at < :cutoff;
+"""
+
+
+class MessageArchiver:
+    """
+    Moves ``tropico_messages`` rows older than ``max_age`` seconds to
+    ``tropico_messages_archive``. Rows are walked in id order, which is also
+    age order, in batches of ``batch_size``; every batch is its own short
+    transaction followed by a ``pause``, so the live table never sees long
+    locks or a burst of dead tuples. One worker per round holds the lock.
+    """
+
+    LOCK_KEY = 'chat:messages:archiver'
+
+    def __init__(self, db: Database, redis: Redis, max_age: int = 30 * 86400, batch_size: int = 1000,
+                 pause: float = 0.2, interval: float = 3600.0, history: Optional[HistoryBuffer] = None) -> None:
+        self.db = db
+        self.redis = redis
+        self.history = history
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+        self.token = uuid.uuid4().hex
+        self.archived = 0
+        self.rounds = 0
+        self.last_round_at = None
+        self.last_round_duration = None
+        self.runner = None
+
+    async def start(self) -> None:
+        if self.max_age > 0:
+            self.runner = asyncio.ensure_future(self.__run())
+
+    async def stop(self) -> None:
+        if self.runner:
+            self.runner.cancel()
+            try:
+                await self.runner
+            except asyncio.CancelledError:
+                pass
+            self.runner = None
+
+    async def archive(self) -> int:
+        """
+        Archives everything past the cutoff, batch by batch. Returns the
+        number of rows moved.
+        """
+        cutoff = int(time.time()) - self.max_age
+        started = time.monotonic()
+        moved, after_id = 0, 0
+        while True:
+            batch, after_id, done = await self.__batch(cutoff, after_id)
+            moved += batch
+            if done:
+                break
+            await asyncio.sleep(self.pause)
+
+        self.archived += moved
+        self.rounds += 1
+        self.last_round_at = int(time.time())
+        self.last_round_duration = round(time.monotonic() - started, 3)
+        if moved:
+            logger.info(f"Archived {moved} messages older than {cutoff}")
+        return moved
+
+    def snapshot(self) -> dict:
+        return {"archived": self.archived,
+                "rounds": self.rounds,
+                "last_round_at": self.last_round_at,
+                "last_round_duration": self.last_round_duration,
+                "running": self.runner is not None}
+
+    async def __batch(self, cutoff: int, after_id: int) -> Tuple[int, int, bool]:
+        rows = await self.db.fetch_all(query=LIST_ARCHIVE_CANDIDATES_QUERY,
+                                       values={"after_id": after_id, "limit": self.batch_size})
+        expired = [row for row in rows if row['created_at'] < cutoff]
+        if not expired:
+            return 0, after_id, True
+
+        values = {"first_id": expired[0]['id'], "last_id": expired[-1]['id'], "cutoff": cutoff}
+        async with self.db.transaction():
+            await self.db.execute(query=COPY_TO_ARCHIVE, values=values)
+            await self.db.execute(query=DELETE_ARCHIVED, values=values)
+        if self.history:
+            await self.history.bump({row['chat_id'] for row in expired})
+
+        # ids grow with created_at, the first recent row ends the round
+        return len(expired), expired[-1]['id'], len(expired) < len(rows) or len(rows) < self.batch_size
+
+    async def __acquire(self) -> bool:
+        try:
+            return bool(await self.redis.set(self.LOCK_KEY, self.token, ex=math.ceil(self.interval), nx=True))
+        except Exception as e:
+            logger.warning(e)
+            return False
+
+    async def __run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                if await self.__acquire():
+                    await self.archive()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("--- MESSAGE ARCHIVER ERROR ---")
+                logger.warning(e)
+                logger.warning("--- MESSAGE ARCHIVER ERROR ---")
+
+
+async def main() -> None:
+    database = Database(DATABASE_URL, min_size=1, max_size=1)
+    await database.connect()
+    try:
+        archiver = MessageArchiver(database, None, max_age=ARCHIVE_AFTER_DAYS * 86400,
+                                   batch_size=ARCHIVE_BATCH_SIZE, pause=ARCHIVE_BATCH_PAUSE)
+        await archiver.archive()
+    finally:
+        await database.disconnect()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
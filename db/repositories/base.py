@@ -1,18 +1,58 @@
+from typing import Dict, Optional
+
 from aioredis import Redis
 from databases import Database
 
+from core.config import SESSION_CACHE_SIZE, SESSION_CACHE_TTL, SESSION_CACHE_REDIS_TTL, MESSAGE_FLUSH_SIZE, \
+    MESSAGE_FLUSH_INTERVAL, HISTORY_BUFFER_SIZE, HISTORY_BUFFER_TTL, REDIS_PUBSUB_REPLICAS, ARCHIVE_AFTER_DAYS, \
+    ARCHIVE_BATCH_SIZE, ARCHIVE_BATCH_PAUSE, ARCHIVE_INTERVAL, SLOW_QUERY_MS, SLOW_QUERY_LOG_SIZE, SLOW_QUERY_REDACT, \
+    WS_REPLAY_MAXLEN, WS_REPLAY_TTL, HISTORY_VERSION_TTL
+from core.realtime.replay import ReplayBuffer
+from core.realtime.sharding import RedisShards
+from db.repositories.archive import MessageArchiver
+from db.repositories.cache import SessionCache, SESSION_INVALIDATE_CHANNEL
+from db.repositories.content import ContentStore, CONTENT_INVALIDATE_CHANNEL
+from db.repositories.history import HistoryBuffer
+from db.repositories.instrumented import InstrumentedDatabase
+from db.repositories.writer import MessageWriter
+
 
 class BaseDatabase:
     redis: Redis = None
-    db: Database = None
+    db: InstrumentedDatabase = None
+    sessions: SessionCache = None
+    content: ContentStore = None
+    messages: MessageWriter = None
+    history: HistoryBuffer = None
+    archiver: MessageArchiver = None
+    pubsub: RedisShards = None
+    replay: ReplayBuffer = None
 
-    def __init__(self, redis: Redis, db: Database) -> None:
+    def __init__(self, redis: Redis, db: Database, shards: Optional[Dict[str, Redis]] = None) -> None:
         self.redis = redis
-        self.db = db
+        self.db = db = InstrumentedDatabase(db, slow_threshold=SLOW_QUERY_MS / 1000, redact=SLOW_QUERY_REDACT,
+                                            slow_log_size=SLOW_QUERY_LOG_SIZE)
+        self.pubsub = RedisShards(shards or {'redis': redis}, primary=redis, replicas=REDIS_PUBSUB_REPLICAS,
+                                  pinned=(SESSION_INVALIDATE_CHANNEL, CONTENT_INVALIDATE_CHANNEL))
+        self.replay = ReplayBuffer(self.pubsub, maxlen=WS_REPLAY_MAXLEN, ttl=WS_REPLAY_TTL)
+        self.sessions = SessionCache(redis, maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL,
+                                     redis_ttl=SESSION_CACHE_REDIS_TTL)
+        self.content = ContentStore(db, redis)
+        self.history = HistoryBuffer(redis, size=HISTORY_BUFFER_SIZE, ttl=HISTORY_BUFFER_TTL,
+                                     version_ttl=HISTORY_VERSION_TTL)
+        self.messages = MessageWriter(db, redis, batch_size=MESSAGE_FLUSH_SIZE, interval=MESSAGE_FLUSH_INTERVAL,
+                                      history=self.history)
+        self.archiver = MessageArchiver(db, redis, max_age=ARCHIVE_AFTER_DAYS * 86400,
+                                        batch_size=ARCHIVE_BATCH_SIZE, pause=ARCHIVE_BATCH_PAUSE,
+                                        interval=ARCHIVE_INTERVAL, history=self.history)
 
 
 class BaseRepository:
     def __init__(self, bsd: BaseDatabase) -> None:
         self.redis = bsd.redis
+        self.pubsub = bsd.pubsub
+        self.replay = bsd.replay
         self.db = bsd.db
-
+        self.sessions = bsd.sessions
+        self.messages = bsd.messages
+        self.history = bsd.history
@@ -0,0 +1,138 @@
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
+from aioredis import Redis
+from loguru import logger
+
+from db.models import UserInfo
+
+SESSION_INVALIDATE_CHANNEL = 'chat:session:invalidate'
+
+# HSET + EXPIRE only when the hash is absent, so a miss fill never clobbers a newer write.
+FILL_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+class SessionCache:
+    """
+    Two-tier ``session_id -> UserInfo`` cache: a per-worker LRU with a short
+    TTL in front of a Redis hash per session. Writes refresh the Redis hash
+    and tell the other workers to drop their local copy; miss fills only
+    populate an absent hash and publish nothing.
+    """
+
+    KEY_PREFIX = 'chat:session:'
+
+    def __init__(self, redis: Redis, maxsize: int = 10000, ttl: float = 60.0, redis_ttl: int = 86400) -> None:
+        self.redis = redis
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.redis_ttl = redis_ttl
+        self.token = uuid.uuid4().hex
+        self.local: OrderedDict = OrderedDict()
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __key(self, session_id: str) -> str:
+        return f"{self.KEY_PREFIX}{session_id}"
+
+    @staticmethod
+    def encode(info: UserInfo) -> dict:
+        data = {}
+        for field, value in info.dict().items():
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = int(value)
+            elif hasattr(value, 'isoformat'):
+                value = value.isoformat()
+            data[field] = value
+        return data
+
+    def __remember(self, info: UserInfo) -> None:
+        self.local[info.session_id] = (time.monotonic() + self.ttl, info)
+        self.local.move_to_end(info.session_id)
+        if len(self.local) > self.maxsize:
+            self.local.popitem(last=False)
+
+    def evict_local(self, session_id: str) -> None:
+        if self.local.pop(session_id, None):
+            self.invalidations += 1
+
+    def on_invalidate(self, message: dict) -> None:
+        token, _, session_id = message['data'].partition(':')
+        if token != self.token:
+            self.evict_local(session_id)
+
+    async def get(self, session_id: str) -> Optional[UserInfo]:
+        cached = self.local.get(session_id)
+        if cached:
+            expires_at, info = cached
+            if expires_at > time.monotonic():
+                self.local.move_to_end(session_id)
+                self.local_hits += 1
+                return info
+            del self.local[session_id]
+
+        try:
+            data = await self.redis.hgetall(self.__key(session_id))
+        except Exception as e:
+            logger.warning(e)
+            data = None
+
+        if data:
+            info = UserInfo(**data)
+            self.__remember(info)
+            self.redis_hits += 1
+            return info
+
+        self.misses += 1
+
+    async def set(self, info: UserInfo) -> None:
+        self.__remember(info)
+        key = self.__key(info.session_id)
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                await pipe.delete(key).hset(key, mapping=self.encode(info)).expire(key, self.redis_ttl) \
+                    .publish(SESSION_INVALIDATE_CHANNEL, f"{self.token}:{info.session_id}").execute()
+        except Exception as e:
+            logger.warning(e)
+
+    async def fill(self, info: UserInfo) -> None:
+        key = self.__key(info.session_id)
+        args = [item for field in self.encode(info).items() for item in field]
+        try:
+            filled = await self.redis.eval(FILL_SCRIPT, 1, key, self.redis_ttl, *args)
+        except Exception as e:
+            logger.warning(e)
+            return
+        if filled:
+            self.__remember(info)
+
+    async def invalidate(self, session_id: str) -> None:
+        self.evict_local(session_id)
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                await pipe.delete(self.__key(session_id)) \
+                    .publish(SESSION_INVALIDATE_CHANNEL, f"{self.token}:{session_id}").execute()
+        except Exception as e:
+            logger.warning(e)
+
+    def snapshot(self) -> dict:
+        lookups = self.local_hits + self.redis_hits + self.misses
+        return {"size": len(self.local),
+                "local_hits": self.local_hits,
+                "redis_hits": self.redis_hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_ratio": round((self.local_hits + self.redis_hits) / lookups, 4) if lookups else 0.0}
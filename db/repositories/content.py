@@ -0,0 +1,128 @@
+import asyncio
+import json
+from typing import Dict, Optional, Tuple
+
+from aioredis import Redis
+from databases import Database
+from loguru import logger
+
+from core import serialization
+from core.config import MEDIA_URL
+from db.models import WelcomeChat, IntroChat
+
+CONTENT_INVALIDATE_CHANNEL = 'chat:content:invalidate'
+CONTENT_VERSION_KEY = 'chat:content:version'
+
+LIST_CHAT_INTRO_QUERY = """
+    SELECT id, message, quick_replies, lang
+    FROM tropico_intro ORDER BY id;
+"""
+
+LIST_WELCOME_CHAT_QUERY = """
+    SELECT id, name, created_at, message, lang
+    FROM tropico_welcomes ORDER BY id;
+"""
+
+DEFAULT_LANG = 'en'
+DEFAULT_AGENT_NAME = 'Anna'
+DEFAULT_AGENT_AVATAR = f"{MEDIA_URL}agent/anna.jpg"
+
+
+class ContentStore:
+    """
+    Welcome and intro copy per language, loaded once and kept in memory with
+    quick replies already parsed. Intros are also kept serialized, per
+    language and agent, for the frames that embed them. Operators refresh it
+    by publishing on ``chat:content:invalidate`` or bumping
+    ``chat:content:version``.
+    """
+
+    MAX_SERIALIZED = 1024
+
+    def __init__(self, db: Database, redis: Redis) -> None:
+        self.db = db
+        self.redis = redis
+        self.welcomes: Dict[str, WelcomeChat] = {}
+        self.intros: Dict[str, IntroChat] = {}
+        self.serialized: Dict[Tuple[str, str, Optional[str]], str] = {}
+        self.version = None
+        self.loaded = False
+        self._lock = asyncio.Lock()
+
+    async def load(self) -> None:
+        async with self._lock:
+            version = await self.__remote_version()
+            welcome_rows = await self.db.fetch_all(query=LIST_WELCOME_CHAT_QUERY)
+            intro_rows = await self.db.fetch_all(query=LIST_CHAT_INTRO_QUERY)
+
+            welcomes = {}
+            for row in welcome_rows:
+                welcomes.setdefault(row['lang'], WelcomeChat(**row))
+
+            intros = {}
+            for row in intro_rows:
+                quick_replies = json.loads(row['quick_replies']) if row['quick_replies'] else None
+                intros.setdefault(row['lang'], IntroChat(**{"message": row['message'],
+                                                            "quick_replies": quick_replies,
+                                                            "lang": row['lang'],
+                                                            "name": DEFAULT_AGENT_NAME,
+                                                            "avatar": DEFAULT_AGENT_AVATAR}))
+
+            self.welcomes, self.intros, self.version = welcomes, intros, version
+            self.serialized = {(lang, intro.name, intro.avatar): serialization.dumps(intro.dict())
+                               for lang, intro in intros.items()}
+            self.loaded = True
+            logger.debug(f"Chat content loaded: {sorted(welcomes)} welcomes, {sorted(intros)} intros")
+
+    async def __remote_version(self) -> Optional[str]:
+        try:
+            return await self.redis.get(CONTENT_VERSION_KEY)
+        except Exception as e:
+            logger.warning(e)
+            return self.version
+
+    async def __ensure_loaded(self) -> None:
+        if not self.loaded:
+            await self.load()
+
+    @staticmethod
+    def __pick(content: dict, lang: str):
+        return content.get(lang) or content.get(DEFAULT_LANG)
+
+    async def welcome(self, lang: str) -> WelcomeChat:
+        await self.__ensure_loaded()
+        return self.__pick(self.welcomes, lang)
+
+    async def intro(self, lang: str, name: str, avatar: Optional[str]) -> IntroChat:
+        await self.__ensure_loaded()
+        intro = self.__pick(self.intros, lang)
+        if intro.name == name and intro.avatar == avatar:
+            return intro
+        return intro.copy(update={"name": name, "avatar": avatar})
+
+    async def intro_json(self, lang: str, name: str, avatar: Optional[str]) -> str:
+        key = (lang, name, avatar)
+        serialized = self.serialized.get(key)
+        if serialized is None:
+            serialized = serialization.dumps((await self.intro(lang, name=name, avatar=avatar)).dict())
+            if len(self.serialized) >= self.MAX_SERIALIZED:
+                self.serialized.clear()
+            self.serialized[key] = serialized
+        return serialized
+
+    def on_invalidate(self, message: dict) -> None:
+        asyncio.ensure_future(self.refresh())
+
+    async def refresh(self) -> None:
+        try:
+            await self.load()
+        except Exception as e:
+            logger.warning("--- CONTENT REFRESH ERROR ---")
+            logger.warning(e)
+            logger.warning("--- CONTENT REFRESH ERROR ---")
+
+    async def watch(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            if await self.__remote_version() != self.version:
+                await self.refresh()
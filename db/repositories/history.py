@@ -0,0 +1,145 @@
+import json
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional
+
+from aioredis import Redis
+from loguru import logger
+
+EMPTY_MARKER = '-'
+
+
+class HistoryBuffer:
+    """
+    Capped per-chat list of the latest messages, oldest first. A buffer is
+    only appended to once it has been seeded from Postgres. Rows written
+    before a seed can still sit in the write-behind journal, the seed then
+    misses them; the writer drops such buffers with forget_stale() once the
+    rows are in Postgres, and the next read seeds them again. The seed time
+    lives in its own key, trimming the list never loses it.
+
+    The buffer also keeps the version of each chat's persisted history that
+    the history ETags are built from. Writers bump it once their rows are in
+    Postgres; a missing version is derived from Postgres and cached for
+    ``version_ttl`` seconds, which bounds how long changes made outside the
+    service go unnoticed.
+    """
+
+    KEY_PREFIX = 'chat:history:'
+
+    def __init__(self, redis: Redis, size: int = 15, ttl: int = 86400, version_ttl: int = 3600) -> None:
+        self.redis = redis
+        self.size = size
+        self.ttl = ttl
+        self.version_ttl = version_ttl
+        self.hits = 0
+        self.misses = 0
+
+    def __key(self, chat_id: int) -> str:
+        return f"{self.KEY_PREFIX}{chat_id}"
+
+    def __seed_key(self, chat_id: int) -> str:
+        return f"{self.KEY_PREFIX}{chat_id}:seeded"
+
+    def __version_key(self, chat_id: int) -> str:
+        return f"{self.KEY_PREFIX}{chat_id}:version"
+
+    async def get(self, chat_id: int) -> Optional[List[dict]]:
+        try:
+            buffered = await self.redis.lrange(self.__key(chat_id), 0, -1)
+        except Exception as e:
+            logger.warning(e)
+            buffered = None
+
+        if not buffered:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        since = int(time.time()) - self.ttl
+        rows = [json.loads(row) for row in buffered if not row.startswith(EMPTY_MARKER)]
+        return [row for row in reversed(rows) if row['created_at'] >= since]
+
+    async def fill(self, chat_id: int, rows: List[dict]) -> None:
+        key = self.__key(chat_id)
+        # the marker keeps the buffer alive when empty
+        entries = [EMPTY_MARKER] + [json.dumps(row) for row in reversed(rows)]
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                await pipe.delete(key).rpush(key, *entries).ltrim(key, -self.size - 1, -1) \
+                    .expire(key, self.ttl).set(self.__seed_key(chat_id), repr(time.time()), ex=self.ttl).execute()
+        except Exception as e:
+            logger.warning(e)
+
+    async def append(self, chat_id: int, row: dict) -> None:
+        key = self.__key(chat_id)
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                await pipe.rpushx(key, json.dumps(row)).ltrim(key, -self.size, -1) \
+                    .expire(key, self.ttl).expire(self.__seed_key(chat_id), self.ttl).execute()
+        except Exception as e:
+            logger.warning(e)
+
+    async def extend(self, rows: List[dict]) -> None:
+        """
+        append() for many chats in one round trip, rows carry their chat_id.
+        """
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for row in rows:
+                    key = self.__key(row['chat_id'])
+                    pipe.rpushx(key, json.dumps(row)).ltrim(key, -self.size, -1).expire(key, self.ttl) \
+                        .expire(self.__seed_key(row['chat_id']), self.ttl)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(e)
+
+    async def forget_stale(self, created: Dict[int, int]) -> None:
+        """
+        Drops the buffers of the chats seeded since the given ``created_at``
+        of their oldest just persisted row, the seed may have missed it. A
+        buffer without a seed time is dropped too.
+        """
+        chat_ids = list(created)
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for chat_id in chat_ids:
+                    pipe.get(self.__seed_key(chat_id))
+                seeds = await pipe.execute()
+
+            stale = [key for chat_id, seeded in zip(chat_ids, seeds)
+                     if seeded is None or float(seeded) >= created[chat_id]
+                     for key in (self.__key(chat_id), self.__seed_key(chat_id))]
+            if stale:
+                await self.redis.delete(*stale)
+        except Exception as e:
+            logger.warning(e)
+
+    async def version(self, chat_id: int) -> Optional[str]:
+        try:
+            return await self.redis.get(self.__version_key(chat_id))
+        except Exception as e:
+            logger.warning(e)
+
+    async def set_version(self, chat_id: int, version: str) -> str:
+        """
+        Caches a version derived from Postgres unless a writer bumped it in
+        the meantime, returns the one that is current.
+        """
+        key = self.__version_key(chat_id)
+        try:
+            if not await self.redis.set(key, version, ex=self.version_ttl, nx=True):
+                return await self.redis.get(key) or version
+        except Exception as e:
+            logger.warning(e)
+        return version
+
+    async def bump(self, chat_ids: Iterable[int]) -> None:
+        # a fresh random version never matches an ETag handed out before
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for chat_id in chat_ids:
+                    pipe.set(self.__version_key(chat_id), uuid.uuid4().hex, ex=self.version_ttl)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(e)
@@ -0,0 +1,174 @@
+import importlib
+import re
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Sequence, Tuple
+
+from databases import Database
+from loguru import logger
+
+from core.metrics import db_query_latency, db_query_rows
+
+# modules holding the named queries, read on first use as they import this one
+QUERY_MODULES = ('db.repositories.models', 'db.repositories.writer', 'db.repositories.archive',
+                 'db.repositories.content')
+
+REDACTED = '***'
+UNNAMED = 'unnamed'
+
+
+class QueryStats:
+    __slots__ = ('calls', 'errors', 'rows', 'total', 'max')
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def snapshot(self) -> dict:
+        return {"calls": self.calls,
+                "errors": self.errors,
+                "rows": self.rows,
+                "total_ms": round(self.total * 1000, 3),
+                "mean_ms": round(self.total * 1000 / self.calls, 3) if self.calls else 0.0,
+                "max_ms": round(self.max * 1000, 3)}
+
+
+class InstrumentedDatabase:
+    """
+    Wraps ``databases.Database`` and tags every statement with the name of
+    its constant, e.g. ``GET_USER_CHAT_ID``. Latency and row counts are kept
+    per name; statements slower than ``slow_threshold`` seconds are logged
+    with their values, fields listed in ``redact`` masked.
+    """
+
+    def __init__(self, db: Database, slow_threshold: float = 0.2, redact: Sequence[str] = (),
+                 slow_log_size: int = 100, modules: Sequence[str] = QUERY_MODULES) -> None:
+        self.db = db
+        self.slow_threshold = slow_threshold
+        self.redact = frozenset(field.lower() for field in redact)
+        self.modules = modules
+        self.stats: Dict[str, QueryStats] = {}
+        self.slow: Deque[dict] = deque(maxlen=slow_log_size)
+        self._names: Optional[Dict[str, str]] = None
+        self._templates: List[Tuple[str, str]] = []
+
+    def __getattr__(self, item: str) -> Any:
+        # connect, disconnect, transaction, url and the backend stay untouched
+        return getattr(self.db, item)
+
+    async def fetch_all(self, query, values: Optional[dict] = None) -> list:
+        started = time.perf_counter()
+        try:
+            rows = await self.db.fetch_all(query=query, values=values)
+        except Exception:
+            self.__record(query, values, started, 0, failed=True)
+            raise
+        self.__record(query, values, started, len(rows))
+        return rows
+
+    async def fetch_one(self, query, values: Optional[dict] = None):
+        started = time.perf_counter()
+        try:
+            row = await self.db.fetch_one(query=query, values=values)
+        except Exception:
+            self.__record(query, values, started, 0, failed=True)
+            raise
+        self.__record(query, values, started, 0 if row is None else 1)
+        return row
+
+    async def fetch_val(self, query, values: Optional[dict] = None, column: Any = 0):
+        started = time.perf_counter()
+        try:
+            value = await self.db.fetch_val(query=query, values=values, column=column)
+        except Exception:
+            self.__record(query, values, started, 0, failed=True)
+            raise
+        self.__record(query, values, started, 0 if value is None else 1)
+        return value
+
+    async def execute(self, query, values: Optional[dict] = None):
+        # the row count of a write is not returned by the backends
+        started = time.perf_counter()
+        try:
+            result = await self.db.execute(query=query, values=values)
+        except Exception:
+            self.__record(query, values, started, 0, failed=True)
+            raise
+        self.__record(query, values, started, 0)
+        return result
+
+    async def execute_many(self, query, values: list) -> None:
+        started = time.perf_counter()
+        try:
+            await self.db.execute_many(query=query, values=values)
+        except Exception:
+            self.__record(query, values, started, 0, failed=True)
+            raise
+        self.__record(query, values, started, len(values))
+
+    def name(self, query) -> str:
+        if not isinstance(query, str):
+            return UNNAMED
+        if self._names is None:
+            self.__load_names()
+
+        name = self._names.get(query)
+        if name is None:
+            # templates formatted with a variable number of placeholders
+            name = next((name for prefix, name in self._templates if query.startswith(prefix)), UNNAMED)
+        return name
+
+    def redacted(self, values) -> Any:
+        if isinstance(values, list):
+            return [self.redacted(item) for item in values]
+        if not isinstance(values, dict):
+            return values
+        return {key: REDACTED if re.sub(r'_\d+$', '', key).lower() in self.redact else value
+                for key, value in values.items()}
+
+    def snapshot(self) -> dict:
+        queries = sorted(self.stats.items(), key=lambda item: item[1].total, reverse=True)
+        return {"slow_threshold_ms": round(self.slow_threshold * 1000, 3),
+                "queries": {name: stats.snapshot() for name, stats in queries},
+                "slow": list(self.slow)}
+
+    def __record(self, query, values, started: float, rows: int, failed: bool = False) -> None:
+        elapsed = time.perf_counter() - started
+        name = self.name(query)
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = QueryStats()
+        stats.calls += 1
+        stats.rows += rows
+        stats.total += elapsed
+        if elapsed > stats.max:
+            stats.max = elapsed
+        if failed:
+            stats.errors += 1
+        db_query_latency.labels(name).observe(elapsed)
+        if rows:
+            db_query_rows.labels(name).inc(rows)
+
+        if elapsed >= self.slow_threshold:
+            entry = {"query": name, "ms": round(elapsed * 1000, 3), "rows": rows,
+                     "values": self.redacted(values), "at": int(time.time())}
+            self.slow.append(entry)
+            logger.warning(f"Slow query {name} {entry['ms']} ms, {rows} rows, values {entry['values']}")
+
+    def __load_names(self) -> None:
+        names, templates = {}, []
+        for module_name in self.modules:
+            module = importlib.import_module(module_name)
+            for attr, value in vars(module).items():
+                if not attr.isupper() or not isinstance(value, str) or not value.lstrip().startswith(
+                        ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')):
+                    continue
+                names[value] = attr
+                if '{' in value:
+                    templates.append((value[:value.index('{')], attr))
+        # the longest prefix wins when templates share their start
+        self._templates = sorted(templates, key=lambda item: len(item[0]), reverse=True)
+        self._names = names
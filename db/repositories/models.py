@@ -1,36 +1,57 @@
-import asyncio
+import hashlib
 import json
 import math
 import time
-from typing import Optional, List
+from typing import Dict, Optional, List
 
-import requests
+from databases import Database
 from loguru import logger
 
 from api.tools import get_ip_info
-from core.config import MEDIA_URL
-from db.models import UserChat, UserInfo, WelcomeChat, IntroChat, OperatorTG
+from core import serialization
+from core.clients.crm import crm_outbox
+from core.config import MEDIA_URL, BROADCAST_BATCH_SIZE
+from db.models import UserChat, UserInfo, WelcomeChat, IntroChat, OperatorTG, ChatBootstrap, BroadcastResult
 from db.repositories.base import BaseRepository, BaseDatabase
+from db.repositories.cache import SessionCache
 
 GET_USER_CHAT_ID = """
     SELECT id, name, created_at, email, phone, city, lang, session_id, context, is_default
     FROM tropico_chat WHERE session_id = :session_id LIMIT 1;
 """
 
-GET_USER_LAST_CHATS_QUERY = """
+GET_CHAT_BOOTSTRAP_QUERY = """
+    WITH recent AS (
+        SELECT id, name, created_at, message, direction, chat_id, avatar
+        FROM tropico_messages WHERE chat_id = :chat_id AND status='APPROVED' AND created_at >= :timedelta
+        ORDER BY id DESC LIMIT 15
+    ), last_agent AS (
+        SELECT id, name, created_at, message, direction, chat_id, avatar
+        FROM tropico_messages WHERE chat_id = :agent_chat_id AND status='APPROVED' AND direction='OUT'
+        AND EXISTS (SELECT 1 FROM recent)
+        ORDER BY id DESC LIMIT 1
+    )
+    SELECT 'history' AS kind, recent.* FROM recent
+    UNION ALL
+    SELECT 'agent' AS kind, last_agent.* FROM last_agent;
+"""
+
+GET_USER_CHATS_PAGE_QUERY = """
     SELECT id, name, created_at, message, direction, chat_id, avatar
-    FROM tropico_messages WHERE chat_id = :chat_id AND status='APPROVED' AND created_at >= :timedelta 
-    ORDER BY id DESC LIMIT 15;
+    FROM tropico_messages WHERE chat_id = :chat_id AND status='APPROVED'
+    ORDER BY id DESC LIMIT :limit;
 """
 
-GET_USER_LAST_CHATS_EXISTS = """
-    SELECT id
-    FROM tropico_messages WHERE chat_id = :chat_id AND status='APPROVED' AND created_at >= :timedelta LIMIT 1;
+GET_USER_CHATS_BEFORE_QUERY = """
+    SELECT id, name, created_at, message, direction, chat_id, avatar
+    FROM tropico_messages WHERE chat_id = :chat_id AND status='APPROVED' AND id < :before_id
+    ORDER BY id DESC LIMIT :limit;
 """
 
-GET_CHAT_INTRO_QUERY = """
-    SELECT id, message, quick_replies, lang
-    FROM tropico_intro WHERE lang=:lang LIMIT 1;
+GET_USER_CHATS_AFTER_QUERY = """
+    SELECT id, name, created_at, message, direction, chat_id, avatar
+    FROM tropico_messages WHERE chat_id = :chat_id AND status='APPROVED' AND id > :after_id
+    ORDER BY id ASC LIMIT :limit;
 """
 
 GET_AGENT_LAST_CHAT_QUERY = """
@@ -38,11 +59,6 @@ GET_AGENT_LAST_CHAT_QUERY = """
     FROM tropico_messages WHERE chat_id = :chat_id AND status='APPROVED' AND direction='OUT' ORDER BY id DESC LIMIT 1;
 """
 
-GET_WELCOME_CHAT_QUERY = """
-    SELECT id, name, created_at, message, lang
-    FROM tropico_welcomes WHERE lang = :lang LIMIT 1;
-"""
-
 CREATE_USER_CHAT = """
     INSERT INTO tropico_chat (name, city, lang, session_id, email, phone, context, is_default, ip, country)
     VALUES (:name, :city, :lang, :session_id, :email, :phone, :context, :is_default, :ip, :country) 
@@ -55,20 +71,16 @@ CREATE_USER_CHAT = """
     RETURNING id, name, created_at, email, phone, city, lang, session_id, context, is_default;
 """
 
-UPDATE_USER_UTM = """
-    UPDATE tropico_chat SET context=:context WHERE session_id=:session_id;
+GET_CHAT_IDS_QUERY = """
+    SELECT id, session_id FROM tropico_chat WHERE session_id IN ({session_ids});
 """
 
-CREATE_CHAT_MESSAGE = """
-    INSERT INTO tropico_messages (name, message, chat_id, created_at, avatar)
-    VALUES (:name, :message, :chat_id, :created_at, :avatar)
-    RETURNING id, name, created_at, message, direction, chat_id, avatar;
+GET_CHAT_HISTORY_VERSION_QUERY = """
+    SELECT COUNT(*) AS count, MAX(id) AS max_id FROM tropico_messages WHERE chat_id = :chat_id AND status = 'APPROVED';
 """
 
-CREATE_CHAT_OUT_MESSAGE = """
-    INSERT INTO tropico_messages (name, message, chat_id, direction, created_at, avatar)
-    VALUES (:name, :message, :chat_id, :direction, :created_at, :avatar)
-    RETURNING id, name, created_at, message, direction, chat_id, avatar;
+UPDATE_USER_UTM = """
+    UPDATE tropico_chat SET context=:context WHERE session_id=:session_id;
 """
 
 CREATE_OPERATOR_TG = """
@@ -82,6 +94,18 @@ LIST_OPERATOR_TG = """
 """
 
 
+async def fetch_chat_info(db: Database, sessions: SessionCache, session_id: str) -> Optional[UserInfo]:
+    chat_info = await sessions.get(session_id)
+    if chat_info:
+        return chat_info
+
+    chat_db = await db.fetch_one(query=GET_USER_CHAT_ID, values={"session_id": session_id})
+    if chat_db:
+        chat_info = UserInfo(**chat_db)
+        await sessions.fill(chat_info)
+        return chat_info
+
+
 class CouchRepository(BaseRepository):
 
     def __init__(self, db: BaseDatabase) -> None:
@@ -104,6 +128,12 @@ class UserRepository(object):
         self.dbs = dbs
         self.db = dbs.db
         self.redis = dbs.redis
+        self.pubsub = dbs.pubsub
+        self.replay = dbs.replay
+        self.sessions = dbs.sessions
+        self.content = dbs.content
+        self.messages = dbs.messages
+        self.history = dbs.history
         self.query_params = query_params
 
         if lang and len(lang.split(',')) > 1:
@@ -121,21 +151,20 @@ class UserRepository(object):
             self.ip_ = '82.215.106.137'
 
     async def __chat_info(self) -> UserInfo:
-        chat_db = await self.db.fetch_one(query=GET_USER_CHAT_ID, values={"session_id": self.session_id_})
+        chat_info = await fetch_chat_info(self.db, self.sessions, self.session_id_)
 
-        if chat_db:
-            if self.query_params and not chat_db['context']:
+        if chat_info:
+            if self.query_params and not chat_info.context:
                 qp = str(self.query_params)
                 context_ = '{"utm": "' + qp + '"}'
                 await self.db.fetch_one(query=UPDATE_USER_UTM, values={"session_id": self.session_id_,
                                                                        "context": context_})
-            return UserInfo(**chat_db)
+                chat_info.context = context_
+                await self.sessions.set(chat_info)
+            return chat_info
 
     async def __check_info(self) -> UserInfo:
-        chat_db = await self.db.fetch_one(query=GET_USER_CHAT_ID, values={"session_id": self.session_id_})
-
-        if chat_db:
-            return UserInfo(**chat_db)
+        return await fetch_chat_info(self.db, self.sessions, self.session_id_)
 
     async def __create_info(self, email_: Optional[str], phone_: Optional[str], name: str = None) -> UserInfo:
         ip_info = get_ip_info(self.ip_)
@@ -167,7 +196,9 @@ class UserRepository(object):
                                                   "country": country,
                                                   "is_default": is_default})
 
-        return UserInfo(**chat_db)
+        chat_info = UserInfo(**chat_db)
+        await self.sessions.set(chat_info)
+        return chat_info
 
     async def __get_chat_id(self) -> UserInfo:
         ch_info = await self.__chat_info()
@@ -176,11 +207,31 @@ class UserRepository(object):
 
         return ch_info
 
-    async def __chat_history(self):
-        ch_info = await self.__get_chat_id()
-        chat_record = await self.db.fetch_all(query=GET_USER_LAST_CHATS_QUERY,
-                                              values={"chat_id": ch_info.id, "timedelta": int(time.time())-86400})
-
+    async def __recent_chats(self, chat_info: UserInfo, with_agent: bool = False):
+        chat_record = await self.history.get(chat_info.id)
+        if chat_record is not None:
+            last_agent = next((chat_db for chat_db in chat_record if chat_db['direction'] == 'OUT'), None)
+            if with_agent and chat_record and not last_agent:
+                last_agent = await self.db.fetch_one(query=GET_AGENT_LAST_CHAT_QUERY,
+                                                     values={"chat_id": chat_info.id})
+            return chat_record, last_agent
+
+        chat_record, last_agent = [], None
+        for chat_db in await self.db.fetch_all(query=GET_CHAT_BOOTSTRAP_QUERY,
+                                               values={"chat_id": chat_info.id,
+                                                       "agent_chat_id": chat_info.id,
+                                                       "timedelta": int(time.time()) - 86400}):
+            chat_db = dict(chat_db)
+            if chat_db.pop('kind') == 'agent':
+                last_agent = chat_db
+            else:
+                chat_record.append(chat_db)
+        chat_record.sort(key=lambda chat_db: chat_db['id'], reverse=True)
+        await self.history.fill(chat_info.id, chat_record)
+
+        return chat_record, last_agent
+
+    async def __with_welcome(self, chat_record: List[dict]) -> List[UserChat]:
         if not chat_record or len(chat_record) == 0:
             welcome_chat = await self.__get_chat_welcome()
             chat_record = [{"id": 1,
@@ -193,67 +244,106 @@ class UserRepository(object):
 
         return [UserChat(**chat_db) for chat_db in chat_record]
 
-    async def __chat_intro(self, chat_info: UserInfo) -> IntroChat:
-        chat_intro = await self.db.fetch_one(query=GET_CHAT_INTRO_QUERY, values={"lang": self.lang_})
-        chat_record = await self.db.fetch_one(query=GET_USER_LAST_CHATS_EXISTS,
-                                              values={"chat_id": chat_info.id, "timedelta": int(time.time()) - 86400})
-        if chat_record:
-            last_agent_db = await self.db.fetch_one(query=GET_AGENT_LAST_CHAT_QUERY,
-                                                    values={"chat_id": chat_info.id})
-        else:
-            last_agent_db = None
+    async def __chat_history(self):
+        ch_info = await self.__get_chat_id()
+        chat_record, _ = await self.__recent_chats(ch_info)
+        return await self.__with_welcome(chat_record)
 
-        if last_agent_db:
-            last_agent = UserChat(**last_agent_db)
+    async def __chat_history_page(self, before_id: Optional[int], after_id: Optional[int],
+                                  limit: int) -> List[UserChat]:
+        ch_info = await self.__get_chat_id()
+        values = {"chat_id": ch_info.id, "limit": limit}
+        if after_id:
+            chat_record = await self.db.fetch_all(query=GET_USER_CHATS_AFTER_QUERY,
+                                                  values={**values, "after_id": after_id})
+            chat_record = reversed(chat_record)
+        elif before_id:
+            chat_record = await self.db.fetch_all(query=GET_USER_CHATS_BEFORE_QUERY,
+                                                  values={**values, "before_id": before_id})
         else:
-            last_agent = UserChat(**{"id": 1,
-                                     "name": "Anna",
-                                     "chat_id": 0,
-                                     "message": "",
-                                     "avatar": f"{MEDIA_URL}agent/anna.jpg",
-                                     "created_at": int(time.time())})
+            chat_record = await self.db.fetch_all(query=GET_USER_CHATS_PAGE_QUERY, values=values)
 
-        quick_reps = json.loads(chat_intro['quick_replies'])
-        intro_ch = IntroChat(**{"message": chat_intro['message'],
-                                "quick_replies": quick_reps,
-                                "lang": chat_intro['lang'],
-                                "name": last_agent.name,
-                                "avatar": last_agent.avatar})
-        return intro_ch
+        return [UserChat(**chat_db) for chat_db in chat_record]
+
+    async def __history_etag(self, before_id: Optional[int], after_id: Optional[int], limit: int) -> str:
+        ch_info = await self.__get_chat_id()
+        version = await self.history.version(ch_info.id)
+        if version is None:
+            # new, moderated and archived messages all change the count or the last id
+            row = await self.db.fetch_one(query=GET_CHAT_HISTORY_VERSION_QUERY, values={"chat_id": ch_info.id})
+            version = await self.history.set_version(ch_info.id, f"{row['count']}:{row['max_id']}")
+        digest = hashlib.blake2b(f"{ch_info.id}:{version}:{before_id}:{after_id}:{limit}".encode(),
+                                 digest_size=12).hexdigest()
+        return f'W/"{digest}"'
+
+    @staticmethod
+    def __last_agent(last_agent_db: Optional[dict]) -> UserChat:
+        if last_agent_db:
+            return UserChat(**last_agent_db)
+
+        return UserChat(**{"id": 1,
+                           "name": "Anna",
+                           "chat_id": 0,
+                           "message": "",
+                           "avatar": f"{MEDIA_URL}agent/anna.jpg",
+                           "created_at": int(time.time())})
+
+    async def __chat_intro(self, last_agent: UserChat) -> IntroChat:
+        return await self.content.intro(self.lang_, name=last_agent.name, avatar=last_agent.avatar)
+
+    async def __bootstrap(self, chat_info: UserInfo) -> ChatBootstrap:
+        chat_record, last_agent_db = await self.__recent_chats(chat_info, with_agent=True)
+        last_agent = self.__last_agent(last_agent_db)
+        return ChatBootstrap(channel_id=self.session_id_,
+                             chat=chat_info,
+                             intro=await self.__chat_intro(last_agent),
+                             last_agent=last_agent,
+                             history=await self.__with_welcome(chat_record))
 
     async def __get_chat_welcome(self) -> WelcomeChat:
-        chat_record = await self.db.fetch_one(query=GET_WELCOME_CHAT_QUERY, values={"lang": self.lang_})
-        return WelcomeChat(**chat_record)
+        return await self.content.welcome(self.lang_)
 
     async def __create_message(self, name_, message_, chat_info: UserInfo, avatar: Optional[str] = None):
         created_at = int(time.time())
-        await self.redis.publish(self.session_id_, json.dumps({"channel_id": self.session_id_,
-                                                               "name": name_, "message": message_,
-                                                               "direction": "IN", "avatar": None,
-                                                               "created_at": created_at}))
-        await self.db.fetch_one(query=CREATE_CHAT_MESSAGE,
-                                values={"name": name_, "chat_id": chat_info.id,
-                                        "message": message_, "created_at": created_at,
-                                        "avatar": avatar})
-
-    async def __pass_chat_info(self, chat_info: UserInfo) -> None:
-        created_at = int(time.time())
-        is_default = chat_info.is_default
-        chat_intro = await self.__chat_intro(chat_info)
-        await asyncio.sleep(1)
-        await self.redis.publish(self.session_id_, json.dumps({"channel_id": self.session_id_,
-                                                               "name": "-", "message": '',
-                                                               "direction": "SYS",
-                                                               "is_default": is_default,
-                                                               "intro": chat_intro.dict(),
-                                                               "created_at": created_at}))
-
-    async def initial_pass_chat_info(self, ch_info):
-        await self.__pass_chat_info(chat_info=ch_info)
+        await self.replay.publish(self.session_id_, serialization.dumps({"channel_id": self.session_id_,
+                                                                         "name": name_, "message": message_,
+                                                                         "direction": "IN", "avatar": None,
+                                                                         "created_at": created_at}))
+        row = {"name": name_, "chat_id": chat_info.id, "message": message_, "direction": "IN",
+               "created_at": created_at, "avatar": avatar}
+        await self.messages.write(row)
+        await self.history.append(chat_info.id, {"id": 0, **row})
+
+    async def __pass_chat_info(self, chat_info: UserInfo, chat_intro: Optional[IntroChat] = None) -> str:
+        if not chat_intro:
+            _, last_agent_db = await self.__recent_chats(chat_info, with_agent=True)
+            chat_intro = await self.__chat_intro(self.__last_agent(last_agent_db))
+        intro = await self.content.intro_json(self.lang_, name=chat_intro.name, avatar=chat_intro.avatar)
+        frame = serialization.dumps({"channel_id": self.session_id_,
+                                     "name": "-", "message": '',
+                                     "direction": "SYS",
+                                     "is_default": chat_info.is_default,
+                                     "created_at": int(time.time())})
+        # the intro is spliced in already serialized
+        return f'{frame[:-1]},"intro":{intro}}}'
+
+    async def initial_pass_chat_info(self, ch_info, intro: Optional[IntroChat] = None) -> str:
+        return await self.__pass_chat_info(chat_info=ch_info, chat_intro=intro)
+
+    async def get_bootstrap(self, ch_info: Optional[UserInfo] = None) -> ChatBootstrap:
+        return await self.__bootstrap(ch_info or await self.__get_chat_id())
 
     async def get_last_chat_history(self) -> List[UserChat]:
         return await self.__chat_history()
 
+    async def get_chat_history_page(self, *, before_id: Optional[int] = None, after_id: Optional[int] = None,
+                                    limit: int = 15) -> List[UserChat]:
+        return await self.__chat_history_page(before_id, after_id, limit)
+
+    async def get_history_etag(self, *, before_id: Optional[int] = None, after_id: Optional[int] = None,
+                               limit: int = 15) -> str:
+        return await self.__history_etag(before_id, after_id, limit)
+
     async def get_chat_info(self) -> UserInfo:
         return await self.__chat_info()
 
@@ -262,7 +352,7 @@ class UserRepository(object):
 
     async def set_chat_info(self, *, email: str, phone: str, name: str) -> UserInfo:
         data_to_send = {"channel_id": self.session_id_, "name": name, "phone": phone, "email": email}
-        requests.post("http://bitrix_chat:8000/bitrix/deal", json=data_to_send)
+        crm_outbox.enqueue('deal', data_to_send)
 
         return await self.__create_info(email, phone, name=name)
 
@@ -278,7 +368,7 @@ class UserRepository(object):
             utm_ctx = ''
 
         data_to_send = {"channel_id": self.session_id_, "lang": self.lang_, "message": message, "url": utm_ctx}
-        requests.post("http://bitrix_chat:8000/bitrix/publish", json=data_to_send)
+        crm_outbox.enqueue('publish', data_to_send)
 
     async def set_wp_chat_message(self, *, message: str, name: str, phone: str) -> None:
         chat_info = await self.__get_chat_id()
@@ -293,28 +383,68 @@ class AgentRepository(BaseRepository):
         super().__init__(db)
 
     async def _chat_info(self, session_id) -> UserInfo:
-        chat_db = await self.db.fetch_one(query=GET_USER_CHAT_ID, values={"session_id": session_id})
-
-        if chat_db:
-            return UserInfo(**chat_db)
+        return await fetch_chat_info(self.db, self.sessions, session_id)
 
     async def set_chat_message(self, *, name, message, channel, avatar: Optional[str] = None) -> None:
         ch_info = await self._chat_info(session_id=channel)
 
         if ch_info:
-            chat_db = await self.db.fetch_one(query=CREATE_CHAT_OUT_MESSAGE,
-                                              values={"name": name,
-                                                      "chat_id": ch_info.id,
-                                                      "message": message,
-                                                      "avatar": avatar,
-                                                      "created_at": int(time.time()),
-                                                      "direction": 'OUT'})
-            chm = UserChat(**chat_db)
-            await self.redis.publish(channel, json.dumps({"channel_id": channel,
-                                                          "name": name, "message": message,
-                                                          "direction": 'OUT',
-                                                          "avatar": avatar,
-                                                          "created_at": chm.created_at}))
+            created_at = int(time.time())
+            await self.replay.publish(channel, serialization.dumps({"channel_id": channel,
+                                                                    "name": name, "message": message,
+                                                                    "direction": 'OUT',
+                                                                    "avatar": avatar,
+                                                                    "created_at": created_at}))
+            row = {"name": name, "chat_id": ch_info.id, "message": message, "direction": 'OUT',
+                   "created_at": created_at, "avatar": avatar}
+            await self.messages.write(row)
+            await self.history.append(ch_info.id, {"id": 0, **row})
+
+    async def _chat_ids(self, session_ids: List[str]) -> Dict[str, int]:
+        values = {f"session_id_{i}": session_id for i, session_id in enumerate(session_ids)}
+        query = GET_CHAT_IDS_QUERY.format(session_ids=", ".join(f":{key}" for key in values))
+        return {row['session_id']: row['id'] for row in await self.db.fetch_all(query=query, values=values)}
+
+    async def _broadcast_batch(self, name, message, avatar, session_ids: List[str]) -> List[BroadcastResult]:
+        chat_ids = await self._chat_ids(session_ids)
+        found = [session_id for session_id in session_ids if session_id in chat_ids]
+        created_at = int(time.time())
+        if found:
+            rows = [{"name": name, "chat_id": chat_ids[session_id], "message": message, "direction": 'OUT',
+                     "created_at": created_at, "avatar": avatar} for session_id in found]
+            await self.messages.insert(rows)
+            await self.history.extend([{"id": 0, **row} for row in rows])
+
+        receivers = dict(zip(found, await self.replay.publish_many([
+            (session_id, serialization.dumps({"channel_id": session_id, "name": name, "message": message,
+                                              "direction": 'OUT', "avatar": avatar, "created_at": created_at}))
+            for session_id in found
+        ])))
+
+        results = []
+        for session_id in session_ids:
+            if session_id not in receivers:
+                results.append(BroadcastResult(session_id=session_id, status='not_found'))
+            elif receivers[session_id] is None:
+                # persisted, the chat picks it up with its history
+                results.append(BroadcastResult(session_id=session_id, status='stored'))
+            else:
+                results.append(BroadcastResult(session_id=session_id, status='sent',
+                                               receivers=receivers[session_id]))
+        return results
+
+    async def broadcast(self, *, name, message, session_ids: List[str],
+                        avatar: Optional[str] = None) -> List[BroadcastResult]:
+        """
+        set_chat_message() for many chats: per batch one lookup, one
+        multi-row insert and one publish pipeline per Redis shard.
+        """
+        session_ids = list(dict.fromkeys(session_ids))
+        results = []
+        for start in range(0, len(session_ids), BROADCAST_BATCH_SIZE):
+            results.extend(await self._broadcast_batch(name, message, avatar,
+                                                       session_ids[start:start + BROADCAST_BATCH_SIZE]))
+        return results
 
 
 class OperatorsRepository(BaseRepository):
@@ -0,0 +1,269 @@
+import asyncio
+import json
+import uuid
+from typing import List, Optional
+
+from aioredis import Redis, from_url
+from databases import Database
+from loguru import logger
+
+from core.config import DATABASE_URL, REDIS_URL
+from db.repositories.history import HistoryBuffer
+
+CREATE_CHAT_MESSAGES = """
+    INSERT INTO tropico_messages (name, message, chat_id, direction, created_at, avatar)
+    VALUES {rows};
+"""
+
+MESSAGE_FIELDS = ("name", "message", "chat_id", "direction", "created_at", "avatar")
+
+# SQLSTATE classes of errors caused by the row itself: data exception, integrity violation
+ROW_ERROR_CLASSES = ('22', '23')
+ROW_ERROR_TYPES = ('DataError', 'IntegrityError')
+
+
+def is_row_error(e: Exception) -> bool:
+    """
+    True when retrying the same row cannot succeed, as opposed to connection
+    or operational errors which go away with the outage.
+    """
+    sqlstate = getattr(e, 'sqlstate', None)
+    if sqlstate:
+        return sqlstate[:2] in ROW_ERROR_CLASSES
+    return any(cls.__name__ in ROW_ERROR_TYPES for cls in type(e).__mro__)
+
+
+class MessageWriter:
+    """
+    Write-behind persistence for ``tropico_messages``. Rows are journaled to a
+    per-worker Redis list and flushed as multi-row inserts once ``batch_size``
+    rows are pending or ``interval`` seconds passed. A flush first claims the
+    whole journal by renaming it to a processing list only its owner trims.
+    Journals of workers that died without flushing are adopted by the
+    survivors on their next heartbeat, which runs on its own timer so an
+    outage does not make live workers look dead. A failing flush is retried
+    with backoff, only rows rejected for their data are moved to the dead
+    letter list; requeue_dead_letters() brings them back.
+    """
+
+    JOURNAL_KEY = 'chat:messages:journal:'
+    JOURNALS_KEY = 'chat:messages:journals'
+    DEAD_LETTER_KEY = 'chat:messages:dead'
+
+    def __init__(self, db: Database, redis: Redis, batch_size: int = 100, interval: float = 0.5,
+                 heartbeat_ttl: int = 120, max_backoff: float = 30.0, history: Optional[HistoryBuffer] = None) -> None:
+        self.db = db
+        self.redis = redis
+        self.history = history
+        self.batch_size = batch_size
+        self.interval = interval
+        self.heartbeat_ttl = heartbeat_ttl
+        self.max_backoff = max_backoff
+        self.token = uuid.uuid4().hex
+        self.journal = f"{self.JOURNAL_KEY}{self.token}"
+        self.processing = f"{self.journal}:processing"
+        self.pending = 0
+        self.flushed = 0
+        self.failures = 0
+        self.dead_lettered = 0
+        self.flusher = None
+        self.heartbeater = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    @staticmethod
+    def build_insert(rows: List[dict]):
+        placeholders, values = [], {}
+        for i, row in enumerate(rows):
+            placeholders.append("(" + ", ".join(f":{field}_{i}" for field in MESSAGE_FIELDS) + ")")
+            for field in MESSAGE_FIELDS:
+                values[f"{field}_{i}"] = row.get(field)
+
+        return CREATE_CHAT_MESSAGES.format(rows=",\n           ".join(placeholders)), values
+
+    async def insert(self, rows: List[dict]) -> None:
+        query, values = self.build_insert(rows)
+        await self.db.execute(query=query, values=values)
+        if self.history:
+            created = {}
+            for row in rows:
+                created[row['chat_id']] = min(row['created_at'], created.get(row['chat_id'], row['created_at']))
+            await self.history.forget_stale(created)
+            await self.history.bump(created)
+
+    async def write(self, row: dict) -> None:
+        if self.flusher is None:
+            await self.insert([row])
+            return
+
+        try:
+            self.pending = await self.redis.rpush(self.journal, json.dumps(row))
+        except Exception as e:
+            logger.warning(e)
+            await self.insert([row])
+            return
+
+        if self.pending >= self.batch_size:
+            self._wakeup.set()
+
+    async def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        await self.__heartbeat()
+        self.flusher = asyncio.ensure_future(self.__run())
+        self.heartbeater = asyncio.ensure_future(self.__beat())
+
+    async def stop(self) -> None:
+        for task in (self.flusher, self.heartbeater):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.flusher = self.heartbeater = None
+
+        try:
+            while await self.flush():
+                pass
+            async with self.redis.pipeline(transaction=True) as pipe:
+                await pipe.srem(self.JOURNALS_KEY, self.token).delete(f"{self.journal}:alive").execute()
+        except Exception as e:
+            logger.warning("--- MESSAGE WRITER FLUSH ERROR ---")
+            logger.warning(e)
+            logger.warning(f"Unflushed messages are kept in {self.journal} and {self.processing}")
+            logger.warning("--- MESSAGE WRITER FLUSH ERROR ---")
+
+    async def flush(self) -> int:
+        async with self._lock:
+            if not await self.redis.exists(self.processing):
+                if not await self.redis.exists(self.journal):
+                    self.pending = 0
+                    return 0
+                # writes go on into a fresh journal, the claimed rows are only trimmed once inserted
+                await self.redis.rename(self.journal, self.processing)
+
+            journaled = await self.redis.lrange(self.processing, 0, self.batch_size - 1)
+            if not journaled:
+                self.pending = 0
+                return 0
+
+            rows = [json.loads(row) for row in journaled]
+            try:
+                await self.insert(rows)
+            except Exception as e:
+                if not is_row_error(e):
+                    raise
+                rows = await self.__isolate(rows)
+
+            await self.__done(rows)
+            return len(rows)
+
+    async def requeue_dead_letters(self) -> int:
+        """
+        Moves the dead letters back to the journal of this writer, e.g. once
+        the schema or the data that rejected them was fixed.
+        """
+        dead = await self.redis.lrange(self.DEAD_LETTER_KEY, 0, -1)
+        if dead:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                await pipe.rpush(self.journal, *dead).ltrim(self.DEAD_LETTER_KEY, len(dead), -1).execute()
+            self.pending += len(dead)
+            logger.info(f"Requeued {len(dead)} messages from {self.DEAD_LETTER_KEY}")
+        return len(dead)
+
+    async def __done(self, rows: List[dict]) -> None:
+        await self.redis.ltrim(self.processing, len(rows), -1)
+        self.flushed += len(rows)
+        self.pending = max(self.pending - len(rows), 0)
+
+    async def __isolate(self, rows: List[dict]) -> List[dict]:
+        """
+        Inserts the rows one by one, dead-lettering the rejected ones. An
+        operational error stops it, the rows handled so far leave the processing list.
+        """
+        for i, row in enumerate(rows):
+            try:
+                await self.insert([row])
+            except Exception as e:
+                if not is_row_error(e):
+                    await self.__done(rows[:i])
+                    raise
+                logger.warning(f"Message moved to {self.DEAD_LETTER_KEY}: {e}")
+                await self.redis.rpush(self.DEAD_LETTER_KEY, json.dumps(row))
+                self.dead_lettered += 1
+        return rows
+
+    async def __heartbeat(self) -> None:
+        async with self.redis.pipeline(transaction=True) as pipe:
+            await pipe.sadd(self.JOURNALS_KEY, self.token) \
+                .set(f"{self.journal}:alive", 1, ex=self.heartbeat_ttl).execute()
+        await self.recover()
+
+    async def recover(self) -> None:
+        for token in await self.redis.smembers(self.JOURNALS_KEY):
+            if token == self.token or await self.redis.exists(f"{self.JOURNAL_KEY}{token}:alive"):
+                continue
+
+            orphan = f"{self.JOURNAL_KEY}{token}"
+            adopted = 0
+            # the claimed rows are older, they end up first
+            for source in (orphan, f"{orphan}:processing"):
+                while await self.redis.rpoplpush(source, self.journal):
+                    adopted += 1
+            await self.redis.srem(self.JOURNALS_KEY, token)
+            if adopted:
+                logger.warning(f"Adopted {adopted} unflushed messages from {orphan}")
+                self._wakeup.set()
+
+    async def __beat(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat_ttl / 3)
+            try:
+                await self.__heartbeat()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("--- MESSAGE WRITER HEARTBEAT ERROR ---")
+                logger.warning(e)
+                logger.warning("--- MESSAGE WRITER HEARTBEAT ERROR ---")
+
+    async def __run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                while await self.flush() == self.batch_size:
+                    pass
+                self.failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # the journal keeps the rows, retry them until the database is back
+                self.failures += 1
+                logger.warning("--- MESSAGE WRITER FLUSH ERROR ---")
+                logger.warning(e)
+                logger.warning("--- MESSAGE WRITER FLUSH ERROR ---")
+                await asyncio.sleep(min(self.interval * 2 ** self.failures, self.max_backoff))
+
+
+async def main() -> None:
+    database = Database(DATABASE_URL, min_size=1, max_size=1)
+    redis = await from_url(REDIS_URL, encoding="utf-8", decode_responses=True)
+    await database.connect()
+    try:
+        writer = MessageWriter(database, redis)
+        await writer.start()
+        await writer.requeue_dead_letters()
+        await writer.stop()
+    finally:
+        await database.disconnect()
+        await redis.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -5,16 +5,16 @@ from databases import Database
 from fastapi import FastAPI
 from loguru import logger
 
-from core.config import DATABASE_URL, DATABASE_URL_TEST
+from core.config import DATABASE_URL, DATABASE_URL_TEST, REDIS_URL, REDIS_PUBSUB_URLS
+from core.realtime.sharding import shard_name
 from db.repositories.base import BaseDatabase
 
 
 async def init_redis_pool(app: FastAPI) -> None:
     try:
         redis = await from_url(
-            f'redis://redis',
+            REDIS_URL,
             encoding="utf-8",
-            db="8",
             decode_responses=True,
         )
         app.state.redis = redis
@@ -36,20 +36,23 @@ async def close_redis_pool(app: FastAPI) -> None:
 async def connect_to_db(app: FastAPI) -> None:
     try:
         redis = await from_url(
-            f'redis://redis',
+            REDIS_URL,
             encoding="utf-8",
-            db="8",
             decode_responses=True,
         )
+        shards = {shard_name(url): await from_url(url, encoding="utf-8", decode_responses=True)
+                  for url in REDIS_PUBSUB_URLS}
 
         if not os.environ.get("TESTING"):
             database = Database(DATABASE_URL, min_size=2, max_size=10)
             await database.connect()
         else:
-            database = Database(DATABASE_URL_TEST, min_size=2, max_size=10)
+            # the sqlite backend of the tests takes no pool sizes
+            pool = {"min_size": 2, "max_size": 10} if DATABASE_URL_TEST.dialect == 'postgresql' else {}
+            database = Database(DATABASE_URL_TEST, **pool)
             await database.connect()
 
-        app.state.db = BaseDatabase(redis, database)
+        app.state.db = BaseDatabase(redis, database, shards)
 
     except Exception as e:
         logger.warning("--- DB CONNECTION ERROR ---")
@@ -66,6 +69,7 @@ async def close_db_connection(app: FastAPI) -> None:
         logger.warning("--- DB DISCONNECT ERROR ---")
 
     try:
+        await app.state.db.pubsub.close()
         await app.state.db.redis.close()
     except Exception as e:
         logger.warning("--- REDIS CLOSE ERROR ---")
@@ -1,6 +1,11 @@
 #!/bin/sh
+# Apply schema migrations once, before the workers start
+echo "Applying migrations."
+python -m db.migrations || exit 1
+
 # Start Uvicorn processes
 echo "Starting Uvicorn."
 
-# Running Uvicorn server
-exec uvicorn api.server:app --workers 2 --host 0.0.0.0 --port 8000 --ws websockets --ws-ping-interval 2.0 --proxy-headers
+# Running Uvicorn server, FORWARDED_ALLOW_IPS lists the proxies whose X-Forwarded-For is trusted
+exec uvicorn api.server:app --workers 2 --host 0.0.0.0 --port 8000 --ws websockets --ws-ping-interval 2.0 --proxy-headers \
+    --forwarded-allow-ips "${FORWARDED_ALLOW_IPS:-127.0.0.1}"
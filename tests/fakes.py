@@ -0,0 +1,271 @@
+import asyncio
+import time
+from collections import defaultdict
+
+
+class FakePubSub:
+    def __init__(self, redis):
+        self.redis = redis
+        self.channels = set()
+        self.commands = []
+        self.connection = None
+        self.messages = asyncio.Queue()
+
+    async def subscribe(self, channel):
+        self.commands.append(('SUBSCRIBE', channel))
+        self.channels.add(channel)
+        self.messages.put_nowait({"type": "subscribe", "pattern": None, "channel": channel,
+                                  "data": len(self.channels)})
+
+    async def unsubscribe(self, channel):
+        self.commands.append(('UNSUBSCRIBE', channel))
+        self.channels.discard(channel)
+        self.messages.put_nowait({"type": "unsubscribe", "pattern": None, "channel": channel,
+                                  "data": len(self.channels)})
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        if self.messages.empty():
+            await asyncio.sleep(timeout)
+        if self.messages.empty():
+            return None
+        message = self.messages.get_nowait()
+        if ignore_subscribe_messages and message['type'] != 'message':
+            return None
+        return message
+
+    async def reset(self):
+        self.channels.clear()
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.stack = []
+
+    def __getattr__(self, name):
+        command = getattr(self.redis, name)
+
+        def queue(*args, **kwargs):
+            self.stack.append((command, args, kwargs))
+            return self
+
+        return queue
+
+    async def execute(self):
+        stack, self.stack = self.stack, []
+        return [await command(*args, **kwargs) for command, args, kwargs in stack]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.stack = []
+
+
+class FakeRedis:
+    """
+    In-process stand-in for the subset of aioredis used by the service.
+    """
+
+    def __init__(self):
+        self.pubsubs = []
+        self.lists = defaultdict(list)
+        self.hashes = defaultdict(dict)
+        self.strings = {}
+        self.sets = defaultdict(set)
+        self.zsets = defaultdict(dict)
+        self.streams = defaultdict(list)
+        self.expirations = {}
+
+    def pubsub(self):
+        pubsub = FakePubSub(self)
+        self.pubsubs.append(pubsub)
+        return pubsub
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def publish(self, channel, data):
+        receivers = 0
+        for pubsub in self.pubsubs:
+            if channel in pubsub.channels:
+                receivers += 1
+                pubsub.messages.put_nowait({"type": "message", "pattern": None,
+                                            "channel": channel, "data": data})
+        return receivers
+
+    async def rpush(self, key, *values):
+        self.lists[key].extend(values)
+        return len(self.lists[key])
+
+    async def rpushx(self, key, *values):
+        if not self.lists.get(key):
+            return 0
+        return await self.rpush(key, *values)
+
+    @staticmethod
+    def _slice(values, start, end):
+        end = len(values) if end == -1 else (end + 1 if end >= 0 else len(values) + end + 1)
+        start = max(len(values) + start, 0) if start < 0 else start
+        return values[start:end]
+
+    async def lrange(self, key, start, end):
+        return self._slice(self.lists.get(key, []), start, end)
+
+    async def lindex(self, key, index):
+        values = self.lists.get(key, [])
+        return values[index] if -len(values) <= index < len(values) else None
+
+    async def ltrim(self, key, start, end):
+        self.lists[key] = self._slice(self.lists[key], start, end)
+        if not self.lists[key]:
+            del self.lists[key]
+        return True
+
+    async def llen(self, key):
+        return len(self.lists[key])
+
+    async def hset(self, key, field=None, value=None, mapping=None):
+        values = dict(mapping or {})
+        if field is not None:
+            values[field] = value
+        self.hashes[key].update({k: str(v) for k, v in values.items()})
+        return len(values)
+
+    async def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    async def expire(self, key, seconds):
+        self.expirations[key] = seconds
+        return True
+
+    async def delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            for store in (self.lists, self.hashes, self.strings, self.sets, self.zsets, self.streams):
+                if key in store:
+                    del store[key]
+                    deleted += 1
+        return deleted
+
+    async def get(self, key):
+        return self.strings.get(key)
+
+    async def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.strings:
+            return None
+        self.strings[key] = str(value)
+        return True
+
+    async def incr(self, key, amount=1):
+        self.strings[key] = str(int(self.strings.get(key, 0)) + amount)
+        return int(self.strings[key])
+
+    async def eval(self, script, numkeys, *keys_and_args):
+        # Only the session cache fill script is evaluated by the service.
+        key, ttl, *args = keys_and_args
+        if await self.exists(key):
+            return 0
+        await self.hset(key, mapping=dict(zip(args[::2], args[1::2])))
+        await self.expire(key, int(ttl))
+        return 1
+
+    async def exists(self, *keys):
+        return sum(1 for key in keys if any(key in store for store in (self.lists, self.hashes, self.strings,
+                                                                        self.sets, self.zsets, self.streams)))
+
+    async def sadd(self, key, *members):
+        before = len(self.sets[key])
+        self.sets[key].update(members)
+        return len(self.sets[key]) - before
+
+    async def srem(self, key, *members):
+        before = len(self.sets[key])
+        self.sets[key].difference_update(members)
+        return before - len(self.sets[key])
+
+    async def smembers(self, key):
+        return set(self.sets.get(key, set()))
+
+    async def zadd(self, key, mapping):
+        added = len(set(mapping) - set(self.zsets[key]))
+        self.zsets[key].update({member: float(score) for member, score in mapping.items()})
+        return added
+
+    async def zrem(self, key, *members):
+        removed = [self.zsets[key].pop(member) for member in members if member in self.zsets[key]]
+        return len(removed)
+
+    async def zrangebyscore(self, key, min, max):
+        low, high = float(min), float(max)
+        members = sorted(self.zsets.get(key, {}).items(), key=lambda item: (item[1], item[0]))
+        return [member for member, score in members if low <= score <= high]
+
+    async def zremrangebyscore(self, key, min, max):
+        removed = await self.zrangebyscore(key, min, max)
+        return await self.zrem(key, *removed)
+
+    async def xadd(self, name, fields, id='*', maxlen=None, approximate=True):
+        entries = self.streams[name]
+        ms = int(time.time() * 1000)
+        if entries:
+            last_ms, last_seq = map(int, entries[-1][0].split('-'))
+            event_id = f"{last_ms}-{last_seq + 1}" if ms <= last_ms else f"{ms}-0"
+        else:
+            event_id = f"{ms}-0"
+        entries.append((event_id, dict(fields)))
+        if maxlen is not None:
+            del entries[:-maxlen]
+        return event_id
+
+    async def xlen(self, name):
+        return len(self.streams.get(name, []))
+
+    async def xrange(self, name, min='-', max='+', count=None):
+        def position(event_id, default):
+            if event_id in ('-', '+'):
+                return default
+            ms, _, seq = event_id.partition('-')
+            return int(ms), int(seq or 0)
+
+        low, high = position(min, (0, 0)), position(max, (float('inf'), 0))
+        entries = [(event_id, fields) for event_id, fields in self.streams.get(name, [])
+                   if low <= position(event_id, None) <= high]
+        return entries[:count] if count else entries
+
+    async def rename(self, source, destination):
+        for store in (self.lists, self.hashes, self.strings, self.sets, self.zsets, self.streams):
+            if source in store:
+                store[destination] = store.pop(source)
+                return True
+        raise ValueError("no such key")
+
+    async def rpoplpush(self, source, destination):
+        if not self.lists.get(source):
+            return None
+        value = self.lists[source].pop()
+        if not self.lists[source]:
+            del self.lists[source]
+        self.lists[destination].insert(0, value)
+        return value
+
+
+class FakeDatabase:
+    """
+    Answers ``databases.Database`` calls with canned rows keyed by query.
+    """
+
+    def __init__(self, rows=None):
+        self.rows = rows or {}
+        self.calls = []
+
+    async def fetch_all(self, query, values=None):
+        self.calls.append((query, values))
+        return list(self.rows.get(query, []))
+
+    async def fetch_one(self, query, values=None):
+        rows = await self.fetch_all(query, values)
+        return rows[0] if rows else None
+
+    async def execute(self, query, values=None):
+        self.calls.append((query, values))
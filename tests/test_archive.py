@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+import pytest
+from databases import Database
+
+from db.migrations import migrate
+from db.repositories.archive import MessageArchiver
+from tests.fakes import FakeRedis
+
+DAY = 86400
+
+
+@pytest.fixture
+async def database(tmp_path):
+    database = Database(f"sqlite:///{tmp_path}/chat.db")
+    await database.connect()
+    await migrate(database)
+    await database.execute("INSERT INTO tropico_chat (name, session_id) VALUES ('London-1', 's1')")
+    await database.execute("INSERT INTO tropico_chat (name, session_id) VALUES ('Dubai-1', 's2')")
+    yield database
+    await database.disconnect()
+
+
+async def add_messages(database, *ages):
+    now = int(time.time())
+    for i, age in enumerate(ages):
+        await database.execute("INSERT INTO tropico_messages (name, message, chat_id, created_at) "
+                               "VALUES ('-', :message, :chat_id, :created_at)",
+                               {"message": f"m{i}", "chat_id": i % 2 + 1, "created_at": now - age * DAY})
+
+
+class TestMessageArchiver:
+
+    @pytest.mark.asyncio
+    async def test_archive_in_batches(self, database):
+        await add_messages(database, 40, 39, 35, 31, 10, 1, 0)
+        archiver = MessageArchiver(database, FakeRedis(), max_age=30 * DAY, batch_size=3, pause=0)
+
+        assert await archiver.archive() == 4
+        live = await database.fetch_all("SELECT message FROM tropico_messages ORDER BY id")
+        archived = await database.fetch_all("SELECT message, chat_id FROM tropico_messages_archive ORDER BY id")
+        assert [row['message'] for row in live] == ["m4", "m5", "m6"]
+        assert [(row['message'], row['chat_id']) for row in archived] == [("m0", 1), ("m1", 2), ("m2", 1), ("m3", 2)]
+
+        assert await archiver.archive() == 0
+        assert archiver.snapshot()["archived"] == 4
+        assert archiver.snapshot()["rounds"] == 2
+
+    @pytest.mark.asyncio
+    async def test_one_worker_per_round(self, database):
+        await add_messages(database, 40, 0)
+        redis = FakeRedis()
+        first = MessageArchiver(database, redis, max_age=30 * DAY, pause=0, interval=0.05)
+        second = MessageArchiver(database, redis, max_age=30 * DAY, pause=0, interval=0.05)
+
+        await first.start()
+        await second.start()
+        for _ in range(100):
+            if first.rounds + second.rounds:
+                break
+            await asyncio.sleep(0.01)
+        await first.stop()
+        await second.stop()
+
+        assert first.rounds + second.rounds == 1
+        assert first.archived + second.archived == 1
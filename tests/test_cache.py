@@ -0,0 +1,80 @@
+import pytest
+
+from db.models import UserInfo
+from db.repositories.cache import SessionCache, SESSION_INVALIDATE_CHANNEL
+from tests.fakes import FakeRedis
+
+SESSION_ID = "f9eb7ff2-eed0-4c0a-83ba-b0503b59a5cc"
+
+
+def user_info(**kwargs):
+    data = {"id": 1, "name": "FooBar", "created_at": "2022-04-01 09:15:12", "email": None,
+            "phone": "+123456789", "city": "London", "lang": "en", "session_id": SESSION_ID,
+            "is_default": False}
+    data.update(kwargs)
+    return UserInfo(**data)
+
+
+class TestSessionCache:
+
+    @pytest.mark.asyncio
+    async def test_read_through_tiers(self):
+        redis = FakeRedis()
+        cache = SessionCache(redis, ttl=60)
+
+        assert await cache.get(SESSION_ID) is None
+        await cache.set(user_info())
+        assert await cache.get(SESSION_ID) == user_info()
+
+        other_worker = SessionCache(redis, ttl=60)
+        assert await other_worker.get(SESSION_ID) == user_info()
+        assert (cache.misses, cache.local_hits, other_worker.redis_hits) == (1, 1, 1)
+
+    @pytest.mark.asyncio
+    async def test_local_ttl(self):
+        cache = SessionCache(FakeRedis(), ttl=0)
+        await cache.set(user_info())
+
+        assert await cache.get(SESSION_ID) == user_info()
+        assert cache.local_hits == 0 and cache.redis_hits == 1
+
+    @pytest.mark.asyncio
+    async def test_cross_worker_invalidation(self):
+        redis = FakeRedis()
+        first, second = SessionCache(redis), SessionCache(redis)
+        await first.set(user_info())
+        await second.get(SESSION_ID)
+
+        await first.set(user_info(name="Bob"))
+        message = {"channel": SESSION_INVALIDATE_CHANNEL, "data": f"{first.token}:{SESSION_ID}"}
+        first.on_invalidate(message)
+        second.on_invalidate(message)
+
+        assert SESSION_ID in first.local
+        assert (await second.get(SESSION_ID)).name == "Bob"
+
+    @pytest.mark.asyncio
+    async def test_lru_eviction(self):
+        cache = SessionCache(FakeRedis(), maxsize=1)
+        await cache.set(user_info())
+        await cache.set(user_info(id=2, session_id="other"))
+
+        assert list(cache.local) == ["other"]
+
+    @pytest.mark.asyncio
+    async def test_fill_keeps_newer_write(self):
+        redis = FakeRedis()
+        pubsub = redis.pubsub()
+        await pubsub.subscribe(SESSION_INVALIDATE_CHANNEL)
+        pubsub.messages.get_nowait()
+
+        await SessionCache(redis).fill(user_info())
+        assert pubsub.messages.empty()
+        assert await SessionCache(redis).get(SESSION_ID) == user_info()
+
+        await SessionCache(redis).set(user_info(name="Bob"))
+        pubsub.messages.get_nowait()
+        await SessionCache(redis).fill(user_info())
+
+        assert pubsub.messages.empty()
+        assert (await SessionCache(redis).get(SESSION_ID)).name == "Bob"
@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+from db.repositories.content import ContentStore, LIST_CHAT_INTRO_QUERY, LIST_WELCOME_CHAT_QUERY, \
+    CONTENT_VERSION_KEY, DEFAULT_AGENT_AVATAR
+from tests.fakes import FakeRedis, FakeDatabase
+
+
+def content_db(welcome="Hello!"):
+    return FakeDatabase({
+        LIST_WELCOME_CHAT_QUERY: [{"id": 1, "name": "Anna", "created_at": 1650000000, "message": welcome,
+                                   "lang": "en"},
+                                  {"id": 2, "name": "Анна", "created_at": 1650000000, "message": "Привет!",
+                                   "lang": "ru"}],
+        LIST_CHAT_INTRO_QUERY: [{"id": 1, "message": "How can we help?", "quick_replies": '["Buy", "Rent"]',
+                                 "lang": "en"}],
+    })
+
+
+class TestContentStore:
+
+    @pytest.mark.asyncio
+    async def test_preloaded_content(self):
+        db = content_db()
+        store = ContentStore(db, FakeRedis())
+        await store.load()
+
+        assert (await store.welcome('ru')).message == "Привет!"
+        assert (await store.welcome('de')).message == "Hello!"
+        intro = await store.intro('ru', name="Bob", avatar=None)
+        assert intro.quick_replies == ["Buy", "Rent"]
+        assert intro.name == "Bob"
+        assert len(db.calls) == 2
+
+    @pytest.mark.asyncio
+    async def test_version_refresh(self):
+        redis = FakeRedis()
+        store = ContentStore(content_db(), redis)
+        await store.load()
+
+        store.db = content_db(welcome="Welcome back!")
+        await redis.incr(CONTENT_VERSION_KEY)
+        assert await redis.get(CONTENT_VERSION_KEY) != store.version
+        await store.refresh()
+
+        assert (await store.welcome('en')).message == "Welcome back!"
+        assert store.version == "1"
+
+    @pytest.mark.asyncio
+    async def test_serialized_intro(self):
+        store = ContentStore(content_db(), FakeRedis())
+        await store.load()
+
+        serialized = await store.intro_json('en', name="Anna", avatar=DEFAULT_AGENT_AVATAR)
+        assert serialized is store.serialized[('en', "Anna", DEFAULT_AGENT_AVATAR)]
+        assert json.loads(serialized) == (await store.intro('en', name="Anna", avatar=DEFAULT_AGENT_AVATAR)).dict()
+
+        bob = await store.intro_json('en', name="Bob", avatar=None)
+        assert json.loads(bob)["name"] == "Bob"
+        assert await store.intro_json('en', name="Bob", avatar=None) is bob
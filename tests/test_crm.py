@@ -0,0 +1,98 @@
+import asyncio
+import json
+
+import pytest
+
+from core.clients.crm import CRMOutbox
+from tests.fakes import FakeRedis
+
+
+class MockCRMOutbox(CRMOutbox):
+    def __init__(self, available=True, **kwargs):
+        super().__init__("http://bitrix/", backoff=0.001, replay_interval=0.05, **kwargs)
+        self.available = available
+        self.delivered = []
+
+    async def send(self, event):
+        if not self.available:
+            raise ConnectionError("CRM is down")
+        self.delivered.append(event)
+        return True
+
+
+class TestCRMOutbox:
+
+    @pytest.mark.asyncio
+    async def test_enqueue_is_delivered(self):
+        outbox = MockCRMOutbox()
+        await outbox.start(FakeRedis())
+
+        outbox.enqueue('publish', {"channel_id": "s1", "message": "hi"})
+        outbox.enqueue('deal', {"channel_id": "s1", "name": "Bob"})
+        await asyncio.sleep(0.05)
+
+        assert [event['path'] for event in outbox.delivered] == ['publish', 'deal']
+        assert outbox.sent == 2
+        await outbox.stop()
+
+    @pytest.mark.asyncio
+    async def test_spill_and_replay(self):
+        redis = FakeRedis()
+        outbox = MockCRMOutbox(available=False, max_retries=1)
+        await outbox.start(redis)
+
+        outbox.enqueue('publish', {"channel_id": "s1", "message": "hi"})
+        await asyncio.sleep(0.05)
+        assert [json.loads(e)['path'] for e in redis.lists[CRMOutbox.SPILL_KEY]] == ['publish']
+
+        outbox.available = True
+        await asyncio.sleep(0.2)
+        assert redis.lists[CRMOutbox.SPILL_KEY] == []
+        assert outbox.delivered == [{"path": "publish", "payload": {"channel_id": "s1", "message": "hi"}}]
+        await outbox.stop()
+
+    @pytest.mark.asyncio
+    async def test_stop_spills_pending(self):
+        redis = FakeRedis()
+        outbox = MockCRMOutbox()
+        await outbox.start(redis)
+        outbox.worker.cancel()
+
+        outbox.enqueue('deal', {"channel_id": "s1"})
+        await outbox.stop()
+        assert len(redis.lists[CRMOutbox.SPILL_KEY]) == 1
+
+    @pytest.mark.asyncio
+    async def test_stop_spills_batch_in_flight(self):
+        redis = FakeRedis()
+        outbox = MockCRMOutbox(available=False, max_retries=3)
+        outbox.backoff = 10
+        await outbox.start(redis)
+
+        outbox.enqueue('deal', {"channel_id": "s1"})
+        await asyncio.sleep(0.01)
+        # sleeping in the retry backoff
+        await outbox.stop()
+        assert [json.loads(e)['path'] for e in redis.lists[CRMOutbox.SPILL_KEY]] == ['deal']
+
+    @pytest.mark.asyncio
+    async def test_interrupted_replay_keeps_events(self):
+        redis = FakeRedis()
+        await redis.rpush(CRMOutbox.SPILL_KEY, json.dumps({"path": "deal", "payload": {"channel_id": "s1"}}))
+        crashed = MockCRMOutbox(available=False, max_retries=3)
+        crashed.backoff = 10
+        await crashed.start(redis)
+        await asyncio.sleep(0.1)
+
+        # dies mid-replay without stop()
+        crashed.worker.cancel()
+        assert CRMOutbox.SPILL_KEY not in redis.lists
+        assert len(redis.lists[crashed.processing]) == 1
+
+        survivor = MockCRMOutbox(claim_ttl=0)
+        await survivor.start(redis)
+        await asyncio.sleep(0.1)
+        assert survivor.delivered == [{"path": "deal", "payload": {"channel_id": "s1"}}]
+        assert crashed.processing not in redis.lists
+        await survivor.stop()
+        await crashed.session.close()
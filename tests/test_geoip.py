@@ -0,0 +1,80 @@
+from types import SimpleNamespace
+
+import pytest
+from loguru import logger
+
+from core import tasks
+from core.geoip import GeoIPResolver
+
+DATASET = """start,end,country,city
+1.0.0.0,1.0.0.255,Australia,Sydney
+82.215.106.0,82.215.106.255,Uzbekistan,Tashkent
+1385960192,1385960207,United Arab Emirates,Dubai
+2001:db8::/32,Nowhere,Testville
+"""
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    path = tmp_path / "geoip.csv"
+    path.write_text(DATASET)
+    return path
+
+
+class TestGeoIPResolver:
+
+    def test_lookup(self, dataset):
+        resolver = GeoIPResolver(cache_size=16)
+        resolver.load(str(dataset))
+
+        assert resolver.lookup('82.215.106.137') == {"country": "Uzbekistan", "city": "Tashkent"}
+        assert resolver.lookup('82.156.19.5') == {"country": "United Arab Emirates", "city": "Dubai"}
+        assert resolver.lookup('2001:db8::1')['city'] == 'Testville'
+        assert resolver.lookup('8.8.8.8') is None
+        assert resolver.lookup('not-an-ip') is None
+
+    def test_lookup_is_cached(self, dataset):
+        resolver = GeoIPResolver(cache_size=16)
+        resolver.load(str(dataset))
+
+        resolver.lookup('1.0.0.1')
+        resolver.lookup('1.0.0.1')
+        assert resolver.lookup.cache_info().hits == 1
+
+    @pytest.mark.asyncio
+    async def test_reload(self, dataset):
+        resolver = GeoIPResolver(cache_size=16)
+        resolver.load(str(dataset))
+        assert resolver.lookup('1.0.0.1')['city'] == 'Sydney'
+
+        dataset.write_text("1.0.0.0,1.0.0.255,Australia,Melbourne\n")
+        await resolver.reload()
+        assert resolver.lookup('1.0.0.1')['city'] == 'Melbourne'
+
+    def test_without_dataset(self):
+        assert GeoIPResolver().lookup('1.0.0.1') is None
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("path", ["", "/nonexistent/geoip.mmdb"])
+    async def test_missing_dataset_warns_at_startup(self, monkeypatch, path):
+        monkeypatch.setattr(tasks, "GEOIP_DATASET", path)
+        app = SimpleNamespace(state=SimpleNamespace())
+        warnings = []
+        sink = logger.add(warnings.append, level="WARNING")
+        try:
+            await tasks.load_geoip_dataset(app)
+        finally:
+            logger.remove(sink)
+
+        assert app.state.geoip_watcher is None
+        assert any("GEOIP DATASET MISSING" in message for message in warnings)
+
+    def test_reload_closes_previous_index(self, dataset, monkeypatch):
+        resolver = GeoIPResolver(cache_size=16)
+        resolver.load(str(dataset))
+        closed = []
+        monkeypatch.setattr(resolver.index, "close", lambda: closed.append(True))
+
+        resolver.load(str(dataset))
+        assert closed == [True]
+        assert resolver.index.describe() == "4 ranges"
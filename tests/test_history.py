@@ -0,0 +1,102 @@
+import time
+
+import pytest
+
+from db.repositories.history import HistoryBuffer
+from db.repositories.writer import MessageWriter
+from tests.fakes import FakeRedis, FakeDatabase
+
+
+def message(i, created_at=None):
+    return {"id": i, "name": "-", "chat_id": 1, "message": f"message {i}", "direction": "IN",
+            "created_at": created_at or int(time.time()), "avatar": None}
+
+
+class TestHistoryBuffer:
+
+    @pytest.mark.asyncio
+    async def test_miss_then_fill(self):
+        buffer = HistoryBuffer(FakeRedis(), size=3)
+        assert await buffer.get(1) is None
+
+        await buffer.fill(1, [message(2), message(1)])
+        assert [row['id'] for row in await buffer.get(1)] == [2, 1]
+        assert (buffer.hits, buffer.misses) == (1, 1)
+
+    @pytest.mark.asyncio
+    async def test_empty_chat_is_cached(self):
+        buffer = HistoryBuffer(FakeRedis())
+        await buffer.fill(1, [])
+
+        assert await buffer.get(1) == []
+
+    @pytest.mark.asyncio
+    async def test_append_is_capped(self):
+        buffer = HistoryBuffer(FakeRedis(), size=3)
+        await buffer.append(1, message(0))
+        assert await buffer.get(1) is None
+
+        await buffer.fill(1, [])
+        for i in range(1, 6):
+            await buffer.append(1, message(i))
+        assert [row['id'] for row in await buffer.get(1)] == [5, 4, 3]
+
+    @pytest.mark.asyncio
+    async def test_expired_messages_are_hidden(self):
+        buffer = HistoryBuffer(FakeRedis(), ttl=86400)
+        await buffer.fill(1, [message(2), message(1, created_at=int(time.time()) - 90000)])
+
+        assert [row['id'] for row in await buffer.get(1)] == [2]
+
+    @pytest.mark.asyncio
+    async def test_miss_while_journaled(self):
+        redis = FakeRedis()
+        buffer = HistoryBuffer(redis)
+        writer = MessageWriter(FakeDatabase(), redis, history=buffer)
+        await writer.start()
+        writer.flusher.cancel()
+
+        row = message(0)
+        await writer.write(row)
+        await buffer.append(1, row)
+        # seeded from Postgres before the flush, without the journaled row
+        await buffer.fill(1, [])
+        assert await buffer.get(1) == []
+
+        await writer.flush()
+        assert await buffer.get(1) is None
+        await writer.stop()
+
+    @pytest.mark.asyncio
+    async def test_older_seed_is_kept(self):
+        redis = FakeRedis()
+        buffer = HistoryBuffer(redis)
+        await buffer.fill(1, [])
+
+        await buffer.append(1, message(1))
+        await buffer.forget_stale({1: int(time.time()) + 1})
+        assert [row['id'] for row in await buffer.get(1)] == [1]
+
+    @pytest.mark.asyncio
+    async def test_full_buffer_keeps_its_seed(self):
+        redis = FakeRedis()
+        buffer = HistoryBuffer(redis, size=3)
+        await buffer.fill(1, [message(3), message(2), message(1)])
+
+        await buffer.append(1, message(4))
+        await buffer.extend([message(5)])
+        # rows persisted after the seed keep it
+        await buffer.forget_stale({1: int(time.time()) + 1})
+        assert [row['id'] for row in await buffer.get(1)] == [5, 4, 3]
+
+    @pytest.mark.asyncio
+    async def test_bump_wins_over_derived_version(self):
+        buffer = HistoryBuffer(FakeRedis())
+        assert await buffer.version(1) is None
+
+        # derived from Postgres before the writer's rows landed
+        await buffer.bump([1])
+        bumped = await buffer.version(1)
+        assert await buffer.set_version(1, "3:42") == bumped
+        await buffer.bump([1])
+        assert await buffer.version(1) != bumped
@@ -0,0 +1,62 @@
+import pytest
+from databases import Database
+
+from db.migrations import migrate
+from db.repositories.instrumented import InstrumentedDatabase, REDACTED, UNNAMED
+from db.repositories.models import GET_USER_CHAT_ID, GET_CHAT_IDS_QUERY
+from db.repositories.writer import CREATE_CHAT_MESSAGES
+
+
+@pytest.fixture
+async def database(tmp_path):
+    database = Database(f"sqlite:///{tmp_path}/chat.db")
+    await database.connect()
+    await migrate(database)
+    yield database
+    await database.disconnect()
+
+
+class TestInstrumentedDatabase:
+
+    def test_names(self):
+        db = InstrumentedDatabase(None)
+
+        assert db.name(GET_USER_CHAT_ID) == 'GET_USER_CHAT_ID'
+        assert db.name(GET_CHAT_IDS_QUERY.format(session_ids=":a, :b")) == 'GET_CHAT_IDS_QUERY'
+        assert db.name(CREATE_CHAT_MESSAGES.format(rows="(:name_0)")) == 'CREATE_CHAT_MESSAGES'
+        assert db.name("SELECT 1") == UNNAMED
+
+    def test_redacted(self):
+        db = InstrumentedDatabase(None, redact=["email", "message"])
+
+        assert db.redacted({"email": "foo@bar.com", "message_3": "hi", "chat_id_3": 1}) == \
+            {"email": REDACTED, "message_3": REDACTED, "chat_id_3": 1}
+        assert db.redacted(None) is None
+
+    @pytest.mark.asyncio
+    async def test_stats(self, database):
+        db = InstrumentedDatabase(database, slow_threshold=60)
+        await database.execute("INSERT INTO tropico_chat (name, session_id) VALUES ('Bob', 's1')")
+
+        assert await db.fetch_one(query=GET_USER_CHAT_ID, values={"session_id": "s1"})
+        assert await db.fetch_one(query=GET_USER_CHAT_ID, values={"session_id": "s2"}) is None
+        with pytest.raises(Exception):
+            await db.fetch_all(query="SELECT * FROM missing_table")
+
+        stats = db.snapshot()
+        assert stats["queries"]["GET_USER_CHAT_ID"]["calls"] == 2
+        assert stats["queries"]["GET_USER_CHAT_ID"]["rows"] == 1
+        assert stats["queries"][UNNAMED]["errors"] == 1
+        assert stats["slow"] == []
+
+    @pytest.mark.asyncio
+    async def test_slow_log(self, database):
+        db = InstrumentedDatabase(database, slow_threshold=0, redact=["session_id"], slow_log_size=1)
+
+        await db.fetch_one(query=GET_USER_CHAT_ID, values={"session_id": "s1"})
+        await db.fetch_one(query=GET_USER_CHAT_ID, values={"session_id": "s2"})
+
+        [entry] = db.snapshot()["slow"]
+        assert entry["query"] == 'GET_USER_CHAT_ID'
+        assert entry["values"] == {"session_id": REDACTED}
+        assert db.url.dialect == 'sqlite'
@@ -0,0 +1,75 @@
+import pytest
+
+from core.metrics import Counter, Gauge, Histogram, Registry, METRICS_PATH
+from db.repositories.models import UserRepository
+from tests.test_views import MockUserRepository
+
+
+class TestRegistry:
+
+    def test_counter_and_gauge(self):
+        registry = Registry()
+        connects = registry.register(Counter('connects_total', 'Connects.'))
+        published = registry.register(Counter('published_total', 'Published.', ['shard']))
+        active = registry.register(Gauge('active', 'Active.'))
+
+        connects.inc()
+        connects.inc(2)
+        published.labels('redis-a:6379/0').inc(5)
+        active.inc()
+        active.dec()
+        output = registry.render()
+
+        assert "# TYPE connects_total counter" in output
+        assert "connects_total 3" in output
+        assert 'published_total{shard="redis-a:6379/0"} 5' in output
+        assert "active 0" in output
+
+    def test_histogram_buckets(self):
+        registry = Registry()
+        latency = registry.register(Histogram('latency_seconds', 'Latency.', ['route'], buckets=(0.1, 1.0)))
+
+        for value in (0.05, 0.1, 0.5, 3.0):
+            latency.labels('/a').observe(value)
+        lines = registry.render().splitlines()
+
+        assert 'latency_seconds_bucket{route="/a",le="0.1"} 2' in lines
+        assert 'latency_seconds_bucket{route="/a",le="1.0"} 3' in lines
+        assert 'latency_seconds_bucket{route="/a",le="+Inf"} 4' in lines
+        assert 'latency_seconds_sum{route="/a"} 3.65' in lines
+        assert 'latency_seconds_count{route="/a"} 4' in lines
+
+    def test_function_values(self):
+        registry = Registry()
+        depth = registry.register(Gauge('depth', 'Depth.', ['queue']))
+        broken = registry.register(Gauge('broken', 'Broken.'))
+
+        depth.set_function(lambda: {('crm',): 4, ('rabbit',): None})
+        broken.set_function(lambda: 1 / 0)
+        output = registry.render()
+
+        assert 'depth{queue="crm"} 4' in output
+        assert 'rabbit' not in output
+        assert "# broken failed" in output
+
+
+class TestMetricsEndpoint:
+
+    @pytest.mark.asyncio
+    async def test_route_latency(self, app, client, monkeypatch):
+        async def mock_get_last_chat_history(*args, **kwargs):
+            return await MockUserRepository()._chat_history()
+
+        monkeypatch.setattr(UserRepository, 'get_last_chat_history', mock_get_last_chat_history)
+
+        await client.get(app.url_path_for("chat-history"),
+                         headers={"x-session-id": "f9eb7ff2-eed0-4c0a-83ba-b0503b59a5cc",
+                                  "user-agent": "Mozilla/5.0"})
+        response = await client.get(METRICS_PATH)
+
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        route = app.router.url_path_for("chat-history")
+        assert f'method="GET",route="{route}",status="200",le="+Inf"' in response.text
+        assert "chat_ws_active " in response.text
+        assert 'chat_queue_depth{queue="crm_outbox"}' in response.text
@@ -0,0 +1,137 @@
+import asyncio
+import os
+
+import pytest
+from databases import Database
+
+from db.migrations import migrate, MIGRATIONS, QUERY_INDEXES
+from db.repositories import models
+
+POSTGRES_URL = os.environ.get("EXPLAIN_DATABASE_URL")
+
+SAMPLE_VALUES = {
+    'GET_USER_CHAT_ID': {"session_id": "s1"},
+    'GET_CHAT_IDS_QUERY': {"session_id_0": "s1"},
+    'UPDATE_USER_UTM': {"context": "", "session_id": "s1"},
+    'GET_CHAT_BOOTSTRAP_QUERY': {"chat_id": 1, "timedelta": 0, "agent_chat_id": 1},
+    'GET_USER_CHATS_PAGE_QUERY': {"chat_id": 1, "limit": 15},
+    'GET_USER_CHATS_BEFORE_QUERY': {"chat_id": 1, "before_id": 100, "limit": 15},
+    'GET_USER_CHATS_AFTER_QUERY': {"chat_id": 1, "after_id": 100, "limit": 15},
+    'GET_AGENT_LAST_CHAT_QUERY': {"chat_id": 1},
+    'GET_CHAT_HISTORY_VERSION_QUERY': {"chat_id": 1},
+}
+
+
+def hot_query(name):
+    return getattr(models, name).format(session_ids=":session_id_0")
+
+
+@pytest.fixture
+async def sqlite(tmp_path):
+    database = Database(f"sqlite:///{tmp_path}/chat.db")
+    await database.connect()
+    await migrate(database)
+    yield database
+    await database.disconnect()
+
+
+@pytest.fixture
+async def postgres():
+    if not POSTGRES_URL:
+        pytest.skip("EXPLAIN_DATABASE_URL is not set")
+    database = Database(POSTGRES_URL, min_size=1, max_size=1)
+    await database.connect()
+    await migrate(database)
+    yield database
+    await database.disconnect()
+
+
+class TestMigrations:
+
+    @pytest.mark.asyncio
+    async def test_applied_once(self, sqlite):
+        assert await migrate(sqlite) == []
+        rows = await sqlite.fetch_all("SELECT version FROM schema_migrations ORDER BY version")
+        assert [row['version'] for row in rows] == [migration.version for migration in MIGRATIONS]
+
+    @pytest.mark.asyncio
+    async def test_existing_unique_session_is_kept(self, tmp_path):
+        database = Database(f"sqlite:///{tmp_path}/legacy.db")
+        await database.connect()
+        try:
+            await database.execute("CREATE TABLE tropico_chat (id INTEGER PRIMARY KEY, session_id TEXT UNIQUE)")
+            await migrate(database)
+
+            indexes = await database.fetch_all("SELECT name FROM pragma_index_list('tropico_chat')")
+            rows = await database.fetch_all("SELECT version FROM schema_migrations ORDER BY version")
+        finally:
+            await database.disconnect()
+
+        assert [row['name'] for row in indexes] == ["sqlite_autoindex_tropico_chat_1"]
+        assert [row['version'] for row in rows] == [migration.version for migration in MIGRATIONS]
+
+    @pytest.mark.asyncio
+    async def test_invalid_index_is_rebuilt(self, postgres):
+        await postgres.execute("DROP INDEX tropico_chat_session_idx")
+        await postgres.execute("DELETE FROM schema_migrations WHERE version = 4")
+        await postgres.execute("INSERT INTO tropico_chat (session_id) VALUES ('invalid-idx'), ('invalid-idx')")
+        with pytest.raises(Exception):
+            await postgres.execute("CREATE UNIQUE INDEX CONCURRENTLY tropico_chat_session_idx "
+                                   "ON tropico_chat (session_id)")
+        await postgres.execute("DELETE FROM tropico_chat WHERE session_id = 'invalid-idx'")
+
+        assert await migrate(postgres) == [4]
+        row = await postgres.fetch_one("SELECT i.indisvalid FROM pg_index i JOIN pg_class c "
+                                       "ON c.oid = i.indexrelid WHERE c.relname = 'tropico_chat_session_idx'")
+        assert row['indisvalid']
+
+    @pytest.mark.asyncio
+    async def test_concurrent_runs_apply_once(self, postgres):
+        await postgres.execute("DROP INDEX tropico_chat_session_idx")
+        await postgres.execute("DELETE FROM schema_migrations WHERE version = 4")
+        other = Database(POSTGRES_URL, min_size=1, max_size=1)
+        await other.connect()
+        try:
+            results = await asyncio.gather(migrate(postgres), migrate(other))
+        finally:
+            await other.disconnect()
+        assert sorted(results) == [[], [4]]
+
+    def test_every_index_is_matched(self):
+        assert set(SAMPLE_VALUES) == set(QUERY_INDEXES)
+        assert all(hasattr(models, name) for name in QUERY_INDEXES)
+
+
+class TestQueryPlans:
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("name", sorted(QUERY_INDEXES))
+    async def test_sqlite_plan(self, sqlite, name):
+        rows = await sqlite.fetch_all("EXPLAIN QUERY PLAN " + hot_query(name), SAMPLE_VALUES[name])
+        plan = [row['detail'] for row in rows]
+
+        assert not [step for step in plan if step.startswith("SCAN tropico_")], plan
+        assert not [step for step in plan if "TEMP B-TREE" in step], plan
+        assert any(QUERY_INDEXES[name] in step for step in plan), plan
+
+    @pytest.mark.asyncio
+    async def test_sqlite_plan_without_index(self, sqlite):
+        await sqlite.execute("DROP INDEX tropico_messages_approved_idx")
+        rows = await sqlite.fetch_all("EXPLAIN QUERY PLAN " + hot_query('GET_USER_CHATS_PAGE_QUERY'),
+                                      SAMPLE_VALUES['GET_USER_CHATS_PAGE_QUERY'])
+
+        assert [row['detail'] for row in rows][0].startswith("SCAN tropico_messages")
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("name", sorted(QUERY_INDEXES))
+    async def test_postgres_plan(self, postgres, name):
+        # an empty table is always cheaper to scan, only refuse what no index can serve
+        async with postgres.transaction():
+            await postgres.execute("SET LOCAL enable_seqscan = off")
+            await postgres.execute("SET LOCAL enable_sort = off")
+            rows = await postgres.fetch_all("EXPLAIN " + hot_query(name), SAMPLE_VALUES[name])
+        plan = "\n".join(row[0] for row in rows)
+
+        assert "Seq Scan on tropico_" not in plan, plan
+        assert "Sort" not in plan, plan
+        assert QUERY_INDEXES[name] in plan, plan
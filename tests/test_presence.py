@@ -0,0 +1,51 @@
+import time
+
+import pytest
+
+from core.realtime.presence import PresenceRegistry, NODES_KEY
+from tests.fakes import FakeRedis
+
+
+class TestPresenceRegistry:
+
+    @pytest.mark.asyncio
+    async def test_online_sessions_per_node(self):
+        redis = FakeRedis()
+        first, second = PresenceRegistry(node="ws-1", interval=60), PresenceRegistry(node="ws-2", interval=60)
+        await first.start(redis)
+        await second.start(redis)
+
+        await first.join("s1", "tab-1")
+        await first.join("s1", "tab-2")
+        await first.join("s2", "tab-1")
+        await second.join("s1", "tab-3")
+
+        online = await first.online()
+        assert online == {"online": 2, "sessions": ["s1", "s2"], "nodes": {"ws-1": 2, "ws-2": 1}}
+        assert first.snapshot() == {"node": "ws-1", "sessions": 2, "connections": 3}
+
+        # the session stays online until its last tab on the node is gone
+        await first.leave("s2", "tab-1")
+        await first.leave("s1", "tab-1")
+        assert (await first.online())["nodes"] == {"ws-1": 1, "ws-2": 1}
+        await first.leave("s1", "tab-2")
+        assert (await first.online())["nodes"] == {"ws-1": 0, "ws-2": 1}
+
+        await first.stop()
+        await second.stop()
+
+    @pytest.mark.asyncio
+    async def test_dead_nodes_are_ignored(self):
+        redis = FakeRedis()
+        registry = PresenceRegistry(node="ws-1", interval=60, ttl=30)
+        await registry.start(redis)
+        await registry.join("s1", "tab-1")
+
+        await redis.zadd(NODES_KEY, {"ws-gone": time.time() - 60})
+        await redis.zadd("chat:presence:node:ws-gone", {"s9": time.time() - 60})
+
+        assert await registry.online() == {"online": 1, "sessions": ["s1"], "nodes": {"ws-1": 1}}
+
+        await registry.beat()
+        assert await redis.zrangebyscore(NODES_KEY, '-inf', '+inf') == ["ws-1"]
+        await registry.stop()
@@ -0,0 +1,105 @@
+from types import SimpleNamespace
+
+import pytest
+from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
+
+from core.middlewares.ratelimit import RateLimitMiddleware, RateLimit, parse_rate_limits
+from tests.fakes import FakeRedis
+
+
+async def downstream(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+def scope_for(path, app=None, scope_type="http", **headers):
+    return {"type": scope_type, "path": path, "app": app, "client": ("10.0.0.1", 5000),
+            "headers": [(name.replace('_', '-').encode(), value.encode()) for name, value in headers.items()]}
+
+
+async def call(middleware, scope):
+    sent = []
+
+    async def receive():
+        return {"type": "websocket.connect"}
+
+    async def send(message):
+        sent.append(message)
+
+    await middleware(scope, receive, send)
+    return sent
+
+
+class TestRateLimitMiddleware:
+
+    def test_parse_rate_limits(self):
+        limits = parse_rate_limits("/ws/api=100/60, /ws/api/user/publish=5/10")
+
+        assert limits == [RateLimit("/ws/api/user/publish", 5, 10), RateLimit("/ws/api", 100, 60)]
+
+    @pytest.mark.asyncio
+    async def test_local_bucket(self):
+        middleware = RateLimitMiddleware(downstream, limits=[RateLimit("/ws/api/user/publish", 2, 60)])
+
+        statuses = [(await call(middleware, scope_for("/ws/api/user/publish", x_session_id="s1")))[0]["status"]
+                    for _ in range(3)]
+        assert statuses == [200, 200, 429]
+
+        # other sessions and routes have their own budget
+        assert (await call(middleware, scope_for("/ws/api/user/publish", x_session_id="s2")))[0]["status"] == 200
+        assert (await call(middleware, scope_for("/ws/api/history", x_session_id="s1")))[0]["status"] == 200
+        assert middleware.limited == 1
+
+    @pytest.mark.asyncio
+    async def test_shared_window(self):
+        app = SimpleNamespace(state=SimpleNamespace(db=SimpleNamespace(redis=FakeRedis())))
+        limits = [RateLimit("/ws/api/user/publish", 2, 60)]
+        first, second = RateLimitMiddleware(downstream, limits=limits), RateLimitMiddleware(downstream, limits=limits)
+
+        scope = scope_for("/ws/api/user/publish", app=app, x_session_id="s1")
+        assert (await call(first, scope))[0]["status"] == 200
+        assert (await call(second, scope))[0]["status"] == 200
+        response = await call(first, scope)
+        assert response[0]["status"] == 429
+        assert dict(response[0]["headers"])[b"retry-after"].isdigit()
+
+    @pytest.mark.asyncio
+    async def test_rotating_sessions_share_ip_budget(self):
+        app = SimpleNamespace(state=SimpleNamespace(db=SimpleNamespace(redis=FakeRedis())))
+        limits = [RateLimit("/ws/api/user/publish", 2, 60)]
+        middleware = RateLimitMiddleware(downstream, limits=limits, ip_factor=2)
+
+        statuses = [(await call(middleware, scope_for("/ws/api/user/publish", app=app, x_session_id=f"s{i}",
+                                                      x_forwarded_for=f"1.1.1.{i}")))[0]["status"]
+                    for i in range(6)]
+        assert statuses == [200, 200, 200, 200, 429, 429]
+
+        # the shared window holds on a worker without the local buckets
+        fresh = RateLimitMiddleware(downstream, limits=limits, ip_factor=2)
+        assert (await call(fresh, scope_for("/ws/api/user/publish", app=app, x_session_id="s9")))[0]["status"] == 429
+
+    @pytest.mark.asyncio
+    async def test_websocket_closed(self):
+        middleware = RateLimitMiddleware(downstream, limits=[RateLimit("/ws/api/subscribe", 1, 60)])
+
+        await call(middleware, scope_for("/ws/api/subscribe/s1", scope_type="websocket", x_forwarded_for="1.2.3.4"))
+        sent = await call(middleware, scope_for("/ws/api/subscribe/s1", scope_type="websocket",
+                                                x_forwarded_for="1.2.3.4, 10.0.0.1"))
+        assert sent == [{"type": "websocket.close", "code": 1008}]
+
+    @pytest.mark.asyncio
+    async def test_proxied_websocket_connects(self):
+        limits = [RateLimit("/ws/api/subscribe", 1, 60)]
+        # what uvicorn --proxy-headers --forwarded-allow-ips=10.0.0.1 runs in front of the app
+        middleware = ProxyHeadersMiddleware(RateLimitMiddleware(downstream, limits=limits, ip_factor=2),
+                                            trusted_hosts="10.0.0.1")
+
+        def connect(channel, visitor):
+            return call(middleware, scope_for(f"/ws/api/subscribe/{channel}", scope_type="websocket",
+                                              x_forwarded_for=visitor))
+
+        # visitors behind the same proxy do not share a budget
+        assert [(await connect(f"s{i}", f"1.1.1.{i}"))[0]["status"] for i in range(5)] == [200] * 5
+        assert (await connect("s0", "1.1.1.9"))[0] == {"type": "websocket.close", "code": 1008}
+        assert (await connect("s8", "1.1.1.1"))[0]["status"] == 200
+        assert (await connect("s9", "1.1.1.1"))[0] == {"type": "websocket.close", "code": 1008}
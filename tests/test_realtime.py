@@ -0,0 +1,184 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from api.routes import views
+from core import tasks
+from core.realtime.delivery import SocketConnection, DeliveryStats, DROP_OLDEST, COALESCE, DISCONNECT, \
+    delivery_stats
+from core.realtime.hub import SubscriptionHub
+from tests.fakes import FakeRedis
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+
+    async def send_text(self, data):
+        self.sent.append(data)
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+def frame(**data):
+    return {"type": "message", "pattern": None, "channel": "session", "data": json.dumps(data)}
+
+
+class TestSubscriptionHub:
+
+    @pytest.mark.asyncio
+    async def test_shared_subscription(self):
+        redis = FakeRedis()
+        hub = SubscriptionHub(redis, poll_timeout=0.05)
+        await hub.start()
+        first, second = asyncio.Queue(), asyncio.Queue()
+
+        await hub.subscribe('session', first.put_nowait)
+        await hub.subscribe('session', second.put_nowait)
+        await redis.publish('session', '{"message": "hi"}')
+
+        assert len(redis.pubsubs) == 1
+        assert redis.pubsubs[0].commands == [('SUBSCRIBE', 'session')]
+        assert (await asyncio.wait_for(first.get(), 1))['data'] == '{"message": "hi"}'
+        assert (await asyncio.wait_for(second.get(), 1))['data'] == '{"message": "hi"}'
+        await hub.stop()
+
+    @pytest.mark.asyncio
+    async def test_subscribe_waits_for_confirmation(self):
+        redis = FakeRedis()
+        hub = SubscriptionHub(redis, poll_timeout=0.05)
+        subscribed = asyncio.ensure_future(hub.subscribe('session', asyncio.Queue().put_nowait))
+
+        # nobody reads the confirmation until the hub is started
+        await asyncio.sleep(0.05)
+        assert not subscribed.done()
+
+        await hub.start()
+        await asyncio.wait_for(subscribed, 1)
+        assert 'session' not in hub.confirmations
+        await hub.stop()
+
+    @pytest.mark.asyncio
+    async def test_unsubscribe_last_listener(self):
+        redis = FakeRedis()
+        hub = SubscriptionHub(redis, poll_timeout=0.05)
+        await hub.start()
+        first, second = asyncio.Queue(), asyncio.Queue()
+
+        await hub.subscribe('session', first.put_nowait)
+        await hub.subscribe('session', second.put_nowait)
+        await hub.unsubscribe('session', first.put_nowait)
+        assert hub.subscribers('session') == 1
+        assert ('UNSUBSCRIBE', 'session') not in redis.pubsubs[0].commands
+
+        await hub.unsubscribe('session', second.put_nowait)
+        assert hub.subscribers('session') == 0
+        assert redis.pubsubs[0].commands[-1] == ('UNSUBSCRIBE', 'session')
+        await hub.stop()
+
+
+class TestSocketConnection:
+
+    @pytest.mark.asyncio
+    async def test_delivers_in_order(self):
+        websocket, stats = FakeWebSocket(), DeliveryStats()
+        connection = SocketConnection(websocket, max_queue=10, stats=stats)
+        sender = asyncio.ensure_future(connection.run())
+
+        for i in range(3):
+            connection.push(frame(message=str(i), direction='IN'))
+        await asyncio.sleep(0.01)
+
+        assert [json.loads(data)['message'] for data in websocket.sent] == ['0', '1', '2']
+        assert stats.snapshot()['delivered'] == 3
+        sender.cancel()
+        connection.close()
+        assert stats.snapshot()['connections'] == 0
+
+    def test_drop_oldest(self):
+        stats = DeliveryStats()
+        connection = SocketConnection(FakeWebSocket(), max_queue=2, policy=DROP_OLDEST, stats=stats)
+
+        for i in range(4):
+            connection.push(frame(message=str(i), direction='IN'))
+
+        assert [json.loads(f['data'])['message'] for f in connection.frames] == ['2', '3']
+        assert stats.snapshot()['dropped'] == 2
+        assert stats.snapshot()['queued'] == 2
+
+    def test_coalesce_sys_frames(self):
+        stats = DeliveryStats()
+        connection = SocketConnection(FakeWebSocket(), max_queue=2, policy=COALESCE, stats=stats)
+
+        connection.push(frame(message='intro-1', direction='SYS'))
+        connection.push(frame(message='hello', direction='IN'))
+        connection.push(frame(message='intro-2', direction='SYS'))
+
+        assert [json.loads(f['data'])['message'] for f in connection.frames] == ['hello', 'intro-2']
+        assert stats.coalesced == 1 and stats.dropped == 0
+
+    @pytest.mark.asyncio
+    async def test_disconnect_slow_consumer(self):
+        websocket = FakeWebSocket()
+        connection = SocketConnection(websocket, max_queue=1, policy=DISCONNECT, stats=DeliveryStats())
+
+        connection.push(frame(message='0', direction='IN'))
+        connection.push(frame(message='1', direction='IN'))
+        await asyncio.wait_for(connection.run(), 1)
+
+        assert websocket.closed_with == 1013
+        assert websocket.sent == []
+
+
+class FailingHub:
+    def __init__(self):
+        self.unsubscribed = []
+
+    async def subscribe(self, channel, listener):
+        raise ConnectionError("redis is gone")
+
+    async def unsubscribe(self, channel, listener):
+        self.unsubscribed.append(channel)
+
+
+class ChatWebSocket(FakeWebSocket):
+    def __init__(self, hub):
+        super().__init__()
+        replay = SimpleNamespace(position=lambda last_event_id, since: None)
+        self.app = SimpleNamespace(state=SimpleNamespace(hub=hub, db=SimpleNamespace(replay=replay)))
+
+    async def accept(self):
+        pass
+
+    async def receive_json(self):
+        await asyncio.Event().wait()
+
+
+class TestChatSocket:
+
+    @pytest.mark.asyncio
+    async def test_failed_subscribe_releases_the_socket(self):
+        hub = FailingHub()
+        users_repo = SimpleNamespace(check_chat_info=lambda: asyncio.sleep(0, result=object()))
+        connections = set(delivery_stats.connections)
+
+        with pytest.raises(ConnectionError):
+            await views.chat(channel="session", websocket=ChatWebSocket(hub), last_event_id=None, since=None,
+                             users_repo=users_repo)
+        await asyncio.sleep(0)
+
+        assert hub.unsubscribed == ["session"]
+        assert delivery_stats.connections == connections
+        assert not [task for task in asyncio.all_tasks()
+                    if task.get_coro().__name__ == 'receiving' and not task.done()]
+
+    def test_slow_consumer_policy_checked_at_startup(self, monkeypatch):
+        tasks.check_delivery_settings()
+
+        monkeypatch.setattr(tasks, "WS_SLOW_CONSUMER_POLICY", "drop_newest")
+        with pytest.raises(ValueError):
+            tasks.check_delivery_settings()
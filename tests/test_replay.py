@@ -0,0 +1,95 @@
+import json
+import time
+
+import pytest
+
+from core.realtime.delivery import SocketConnection, DeliveryStats, event_position, message_frame
+from core.realtime.replay import ReplayBuffer
+from core.realtime.sharding import RedisShards
+from tests.fakes import FakeRedis
+from tests.test_realtime import FakeWebSocket
+
+
+def buffer(redis, maxlen=10, ttl=600):
+    return ReplayBuffer(RedisShards({"redis": redis}, primary=redis), maxlen=maxlen, ttl=ttl)
+
+
+def messages(frames):
+    return [json.loads(frame['data'])['message'] for frame in frames]
+
+
+class TestReplayBuffer:
+
+    @pytest.mark.asyncio
+    async def test_publish_tags_events(self):
+        redis = FakeRedis()
+        replay = buffer(redis)
+        pubsub = redis.pubsub()
+        await pubsub.subscribe("session")
+
+        await replay.publish("session", json.dumps({"message": "hi"}))
+        live = None
+        while live is None:
+            live = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+        [(event_id, fields)] = await redis.xrange(replay.key("session"))
+
+        assert json.loads(live['data']) == {"event_id": event_id, "message": "hi"}
+        assert event_position(live['data']) == tuple(map(int, event_id.split('-')))
+        assert fields == {"data": json.dumps({"message": "hi"})}
+        assert redis.expirations[replay.key("session")] == 600
+
+    @pytest.mark.asyncio
+    async def test_since_event_id(self):
+        replay = buffer(FakeRedis())
+        [(_, first)] = await replay.record([("session", json.dumps({"message": "0"}))])
+        await replay.publish_many([("session", json.dumps({"message": str(i)})) for i in (1, 2)])
+
+        missed = await replay.since("session", event_position(first))
+
+        assert messages(missed) == ["1", "2"]
+        assert replay.snapshot()["replayed"] == 2
+
+    @pytest.mark.asyncio
+    async def test_since_timestamp(self):
+        replay = buffer(FakeRedis())
+        await replay.publish("session", json.dumps({"message": "0"}))
+
+        assert messages(await replay.since("session", replay.position(since=int(time.time())))) == ["0"]
+        assert await replay.since("session", replay.position(since=int(time.time()) + 1)) == []
+
+    @pytest.mark.asyncio
+    async def test_resync_when_trimmed_or_expired(self):
+        replay = buffer(FakeRedis(), maxlen=2)
+        [(_, first)] = await replay.record([("session", json.dumps({"message": "0"}))])
+        for i in (1, 2):
+            await replay.publish("session", json.dumps({"message": str(i)}))
+
+        assert await replay.since("session", event_position(first)) is None
+        assert await replay.since("empty", replay.position(since=int(time.time()) - 3600)) is None
+        assert await replay.since("empty", replay.position(since=int(time.time()))) == []
+        assert replay.snapshot()["resynced"] == 2
+
+    def test_position(self):
+        assert ReplayBuffer.position("1700000000000-3") == (1700000000000, 3)
+        assert ReplayBuffer.position(None, 1700000000)[0] == 1699999999999
+        assert ReplayBuffer.position("garbage") is None
+        assert ReplayBuffer.position() is None
+
+
+class TestResume:
+
+    @pytest.mark.asyncio
+    async def test_replayed_before_live_without_duplicates(self):
+        replay = buffer(FakeRedis())
+        connection = SocketConnection(FakeWebSocket(), stats=DeliveryStats())
+        [(_, seen)] = await replay.record([("session", json.dumps({"message": "0"}))])
+        tagged = await replay.record([("session", json.dumps({"message": str(i)})) for i in (1, 2)])
+
+        connection.hold()
+        # published before and after the replay was read
+        connection.push(message_frame("session", tagged[1][1]))
+        connection.push(message_frame("session", json.dumps({"message": "3"})))
+        connection.resume(await replay.since("session", event_position(seen)), event_position(seen))
+        connection.push(message_frame("session", tagged[0][1]))
+
+        assert messages(connection.frames) == ["1", "2", "3"]
@@ -0,0 +1,131 @@
+import json
+import time
+
+import pytest
+from databases import Database
+
+from db.migrations import migrate
+from db.repositories.base import BaseDatabase
+from db.repositories.models import UserRepository, AgentRepository
+from tests.fakes import FakeRedis
+
+SESSION_ID = "f9eb7ff2-eed0-4c0a-83ba-b0503b59a5cc"
+
+
+@pytest.fixture
+async def dbs(tmp_path):
+    database = Database(f"sqlite:///{tmp_path}/chat.db")
+    await database.connect()
+    await migrate(database)
+    await database.execute("INSERT INTO tropico_chat (name, city, lang, session_id, is_default) "
+                           "VALUES ('London-1', 'London', 'en', :session_id, 1)", {"session_id": SESSION_ID})
+    await database.execute("INSERT INTO tropico_welcomes (name, message, lang, created_at) "
+                           "VALUES ('Anna', 'Hello!', 'en', 0)")
+    await database.execute("INSERT INTO tropico_intro (message, quick_replies, lang) "
+                           "VALUES ('How can we help?', '[\"Buy\"]', 'en')")
+    yield BaseDatabase(FakeRedis(), database)
+    await database.disconnect()
+
+
+async def add_message(dbs, message, direction='IN', name='-', created_at=None):
+    await dbs.db.execute("INSERT INTO tropico_messages (name, message, chat_id, direction, created_at) "
+                         "VALUES (:name, :message, 1, :direction, :created_at)",
+                         {"name": name, "message": message, "direction": direction,
+                          "created_at": created_at or int(time.time())})
+
+
+class TestUserRepository:
+
+    @pytest.mark.asyncio
+    async def test_bootstrap_new_chat(self, dbs):
+        bootstrap = await UserRepository(dbs, session_id=SESSION_ID).get_bootstrap()
+
+        assert bootstrap.chat.session_id == SESSION_ID
+        assert [message.message for message in bootstrap.history] == ["Hello!"]
+        assert bootstrap.intro.quick_replies == ["Buy"]
+        assert bootstrap.last_agent.name == "Anna"
+
+    @pytest.mark.asyncio
+    async def test_bootstrap_with_recent_messages(self, dbs):
+        await add_message(dbs, "Hi, any villas?", created_at=int(time.time()) - 100000)
+        await add_message(dbs, "Welcome back", direction='OUT', name='Maria', created_at=int(time.time()) - 90000)
+        await add_message(dbs, "Still looking")
+
+        bootstrap = await UserRepository(dbs, session_id=SESSION_ID).get_bootstrap()
+        assert [message.message for message in bootstrap.history] == ["Still looking"]
+        assert bootstrap.last_agent.name == "Maria"
+        assert bootstrap.intro.name == "Maria"
+
+        # served from the history buffer this time
+        bootstrap = await UserRepository(dbs, session_id=SESSION_ID).get_bootstrap()
+        assert bootstrap.last_agent.name == "Maria"
+        assert dbs.history.hits == 1
+
+    @pytest.mark.asyncio
+    async def test_intro_frame_is_not_published(self, dbs):
+        repository = UserRepository(dbs, session_id=SESSION_ID)
+        pubsub = dbs.redis.pubsub()
+        await pubsub.subscribe(SESSION_ID)
+        await pubsub.get_message()
+
+        bootstrap = await repository.get_bootstrap()
+        frame = json.loads(await repository.initial_pass_chat_info(bootstrap.chat, intro=bootstrap.intro))
+
+        assert frame["direction"] == "SYS"
+        assert frame["intro"]["quick_replies"] == ["Buy"]
+        assert await pubsub.get_message(timeout=0.01) is None
+
+    @pytest.mark.asyncio
+    async def test_history_etag_follows_the_data(self, dbs):
+        await add_message(dbs, "Hi")
+        users = UserRepository(dbs, session_id=SESSION_ID)
+        etag = await users.get_history_etag(limit=15)
+        assert await users.get_history_etag(limit=15) == etag
+        assert await users.get_history_etag(before_id=10, limit=15) != etag
+
+        # the cached version answers, moderation outside the service shows once it expired
+        await dbs.db.execute("UPDATE tropico_messages SET status = 'REJECTED'")
+        assert await users.get_history_etag(limit=15) == etag
+        await dbs.redis.delete("chat:history:1:version")
+        moderated = await users.get_history_etag(limit=15)
+        assert moderated != etag
+
+        await dbs.messages.insert([{"name": "-", "message": "Anyone?", "chat_id": 1, "direction": "IN",
+                                    "created_at": int(time.time()), "avatar": None}])
+        assert await users.get_history_etag(limit=15) != moderated
+
+    @pytest.mark.asyncio
+    async def test_history_follows_published_messages(self, dbs):
+        repository = UserRepository(dbs, session_id=SESSION_ID)
+        assert [message.message for message in await repository.get_last_chat_history()] == ["Hello!"]
+
+        await repository.set_chat_message(message="Do you have offplan?")
+        await AgentRepository(dbs).set_chat_message(name="Maria", message="Sure", channel=SESSION_ID)
+
+        history = await repository.get_last_chat_history()
+        assert [(message.direction, message.message) for message in history] == [
+            ("OUT", "Sure"), ("IN", "Do you have offplan?")]
+        rows = await dbs.db.fetch_all("SELECT message FROM tropico_messages ORDER BY id")
+        assert [row['message'] for row in rows] == ["Do you have offplan?", "Sure"]
+
+
+class TestAgentRepository:
+
+    @pytest.mark.asyncio
+    async def test_broadcast(self, dbs):
+        await dbs.db.execute("INSERT INTO tropico_chat (name, city, lang, session_id, is_default) "
+                             "VALUES ('Dubai-1', 'Dubai', 'en', 'second', 1)")
+        pubsub = dbs.redis.pubsub()
+        await pubsub.subscribe(SESSION_ID)
+        await pubsub.get_message()
+
+        results = await AgentRepository(dbs).broadcast(name="Maria", message="Happy holidays!",
+                                                       session_ids=[SESSION_ID, "missing", "second", SESSION_ID])
+
+        assert [(result.session_id, result.status, result.receivers) for result in results] == [
+            (SESSION_ID, "sent", 1), ("missing", "not_found", 0), ("second", "sent", 0)]
+        rows = await dbs.db.fetch_all("SELECT chat_id, message, direction FROM tropico_messages ORDER BY chat_id")
+        assert [(row["chat_id"], row["message"], row["direction"]) for row in rows] == [
+            (1, "Happy holidays!", "OUT"), (2, "Happy holidays!", "OUT")]
+        frame = json.loads((await pubsub.get_message())['data'])
+        assert (frame["name"], frame["message"], frame["direction"]) == ("Maria", "Happy holidays!", "OUT")
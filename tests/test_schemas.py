@@ -0,0 +1,38 @@
+import pytest
+
+from core.clients.schemas import RabbitBody, WIRE_MAGIC, FLAG_ZLIB
+
+SESSION_ID = "f9eb7ff2-eed0-4c0a-83ba-b0503b59a5cc"
+
+
+class TestRabbitBody:
+
+    def test_roundtrip(self):
+        body = RabbitBody("Привет, any villas in Phuket? 🌴", SESSION_ID)
+        encoded = body.encode()
+
+        assert encoded[0] == WIRE_MAGIC
+        assert not encoded[2] & FLAG_ZLIB
+        assert RabbitBody.decode(encoded) == body
+        assert len(encoded) < len(body.encode_legacy())
+
+    def test_large_message_is_compressed(self):
+        body = RabbitBody("Looking for a sea view villa. " * 100, SESSION_ID)
+        encoded = body.encode()
+
+        assert encoded[2] & FLAG_ZLIB
+        assert len(encoded) < len(body.message)
+        assert RabbitBody.decode(encoded) == body
+
+    def test_legacy_payloads_are_decoded(self):
+        body = RabbitBody("hi", SESSION_ID)
+
+        assert RabbitBody.decode(body.encode_legacy()) == body
+        assert RabbitBody.decode(body.encode_legacy().decode()) == body
+
+    def test_unknown_version(self):
+        encoded = bytearray(RabbitBody("hi", SESSION_ID).encode())
+        encoded[1] = 99
+
+        with pytest.raises(ValueError):
+            RabbitBody.decode(bytes(encoded))
@@ -0,0 +1,24 @@
+import json
+
+import pytest
+
+from core import serialization
+
+
+class TestSerialization:
+
+    def test_roundtrip(self):
+        event = {"channel_id": "s1", "name": "Анна", "message": "Hi \"there\"", "avatar": None, "created_at": 1}
+
+        assert serialization.loads(serialization.dumps(event)) == event
+        assert json.loads(serialization.dumps(event)) == event
+
+    def test_explicit_backend(self):
+        name, dumps, loads = serialization.load_backend('json')
+
+        assert name == 'json'
+        assert dumps({"message": "привет"}) == '{"message":"привет"}'
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError):
+            serialization.load_backend('pickle')
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+from core.realtime.hub import ShardedSubscriptionHub
+from core.realtime.sharding import HashRing, RedisShards, shard_name
+from tests.fakes import FakeRedis
+
+CHANNELS = [f"session-{i}" for i in range(2000)]
+
+
+class TestHashRing:
+
+    def test_shard_name(self):
+        assert shard_name("redis://:secret@redis-2:6380/8") == "redis-2:6380/8"
+        assert shard_name("redis://redis-1") == "redis-1:6379/0"
+
+    def test_balanced_and_stable(self):
+        ring = HashRing(["a", "b", "c"])
+        owners = [ring.node(channel) for channel in CHANNELS]
+
+        assert owners == [HashRing(["c", "a", "b"]).node(channel) for channel in CHANNELS]
+        assert all(owners.count(node) > len(CHANNELS) / 5 for node in "abc")
+
+    def test_minimal_movement(self):
+        ring = HashRing(["a", "b", "c"])
+        before = {channel: ring.node(channel) for channel in CHANNELS}
+
+        ring.add("d")
+        moved = [channel for channel in CHANNELS if ring.node(channel) != before[channel]]
+        # only the channels taken over by the new node move
+        assert {ring.node(channel) for channel in moved} == {"d"}
+        assert len(moved) < len(CHANNELS) / 3
+
+        ring.remove("d")
+        assert {channel: ring.node(channel) for channel in CHANNELS} == before
+
+
+class TestShardedPubSub:
+
+    @pytest.mark.asyncio
+    async def test_publisher_and_subscriber_agree(self):
+        primary = FakeRedis()
+        clients = {"redis-1": FakeRedis(), "redis-2": FakeRedis(), "redis-3": FakeRedis()}
+        shards = RedisShards(clients, primary=primary, pinned=("invalidate",))
+        hub = ShardedSubscriptionHub(shards, poll_timeout=0.01)
+        await hub.start()
+
+        received = asyncio.Queue()
+        channels = CHANNELS[:30]
+        for channel in channels + ["invalidate"]:
+            await hub.subscribe(channel, received.put_nowait)
+
+        for channel in channels:
+            assert await shards.publish(channel, channel) == 1
+            assert channel in shards.client(channel).pubsubs[0].channels
+        assert all(client.pubsubs[0].channels for client in clients.values())
+
+        assert await shards.publish("invalidate", "all") == 1
+        assert primary.pubsubs[0].channels == {"invalidate"}
+
+        messages = [await asyncio.wait_for(received.get(), timeout=1) for _ in range(len(channels) + 1)]
+        assert sorted(message['data'] for message in messages) == sorted(channels + ["all"])
+        await hub.stop()
+
+    def test_single_node_shares_the_primary(self):
+        redis = FakeRedis()
+        shards = RedisShards({"redis": redis}, primary=redis, pinned=("invalidate",))
+
+        assert shards.items() == [("redis", redis)]
+        assert shards.client("invalidate") is redis
+        assert shards.client("session") is redis
@@ -5,12 +5,16 @@ from typing import List, Optional
 
 import pytest
 from fastapi import FastAPI
-from starlette.status import HTTP_400_BAD_REQUEST
+from starlette.datastructures import Secret
+from starlette.status import HTTP_400_BAD_REQUEST, HTTP_403_FORBIDDEN
 from starlette.testclient import TestClient
 
 from api import tools
-from db.models import UserInfo, UserChat
-from db.repositories.models import UserRepository
+from api.dependencies import auth
+from api.routes import views
+from core.realtime.presence import PresenceRegistry
+from db.models import UserInfo, UserChat, ChatBootstrap, IntroChat
+from db.repositories.models import UserRepository, AgentRepository
 
 
 class MockUserRepository:
@@ -34,6 +38,12 @@ class MockUserRepository:
     async def _create_message(self, name_, message_, avatar: Optional[str] = None):
         pass
 
+    async def _bootstrap(self) -> ChatBootstrap:
+        history = await self._chat_history()
+        return ChatBootstrap(channel_id=self.fake_chat_info.session_id, chat=self.fake_chat_info,
+                             intro=IntroChat(name="Anna", message="How can we help?", lang="en"),
+                             last_agent=history[0], history=history)
+
 
 class MockAgentRepository:
 
@@ -55,6 +65,52 @@ class TestChatRequests:
                                              "user-agent": "Mozilla/5.0"})
         assert response.status_code == 200
 
+    @pytest.mark.asyncio
+    async def test_user_chat_history_page(self, app, client, monkeypatch):
+        async def mock_get_chat_history_page(*args, **kwargs):
+            return await MockUserRepository()._chat_history()
+
+        async def mock_get_history_etag(*args, **kwargs):
+            return 'W/"abc"'
+
+        monkeypatch.setattr(UserRepository, 'get_chat_history_page', mock_get_chat_history_page)
+        monkeypatch.setattr(UserRepository, 'get_history_etag', mock_get_history_etag)
+        headers = {"x-session-id": "f9eb7ff2-eed0-4c0a-83ba-b0503b59a5cc", "user-agent": "Mozilla/5.0"}
+
+        response = await client.get(app.url_path_for("chat-history-page"), params={"before_id": 10},
+                                    headers=headers)
+        assert response.status_code == 200
+        assert response.headers["etag"] == 'W/"abc"'
+        assert [message["id"] for message in response.json()] == [1, 2]
+
+        response = await client.get(app.url_path_for("chat-history-page"), params={"before_id": 10},
+                                    headers={**headers, "if-none-match": 'W/"abc"'})
+        assert response.status_code == 304
+        assert response.content == b''
+
+        response = await client.get(app.url_path_for("chat-history-page"),
+                                    params={"before_id": 10, "after_id": 2}, headers=headers)
+        assert response.status_code == HTTP_400_BAD_REQUEST
+
+    @pytest.mark.asyncio
+    async def test_chat_bootstrap(self, app, client, monkeypatch):
+        async def mock_get_bootstrap(*args, **kwargs):
+            return await MockUserRepository()._bootstrap()
+
+        monkeypatch.setattr(UserRepository, 'get_bootstrap', mock_get_bootstrap)
+        response = await client.get(app.url_path_for("chat-bootstrap"),
+                                    headers={"x-session-id": "f9eb7ff2-eed0-4c0a-83ba-b0503b59a5cc",
+                                             "user-agent": "Mozilla/5.0"})
+        assert response.status_code == 200
+        body = response.json()
+        assert body["intro"]["message"] == "How can we help?"
+        assert body["chat"] == {"name": "FooBar", "lang": "en", "is_default": False}
+        assert "id" not in body["history"][0]
+
+        frame = (await MockUserRepository()._bootstrap()).json(include=views.BOOTSTRAP_INCLUDE,
+                                                                 exclude=views.BOOTSTRAP_EXCLUDE)
+        assert json.loads(frame) == body
+
     @pytest.mark.asyncio
     async def test_user_form_submit(self, app, client, monkeypatch):
         async def mock_set_chat_info(*args, **kwargs):
@@ -89,6 +145,58 @@ class TestChatRequests:
 
         assert response.status_code == 201
 
+    @pytest.mark.asyncio
+    async def test_agent_broadcast_requires_operator(self, app, client, monkeypatch):
+        async def mock_broadcast(*args, **kwargs):
+            return []
+
+        monkeypatch.setattr(AgentRepository, 'broadcast', mock_broadcast)
+        monkeypatch.setattr(auth, 'OPERATOR_TOKEN', Secret("operator-secret"))
+        headers = {"x-session-id": "f9eb7ff2-eed0-4c0a-83ba-b0503b59a5cc", "user-agent": "Mozilla/5.0"}
+        broadcast = {"name": "Maria", "message": "Hello", "online": True}
+
+        response = await client.post(app.url_path_for("agent-broadcast"), json=broadcast, headers=headers)
+        assert response.status_code == HTTP_403_FORBIDDEN
+
+        response = await client.post(app.url_path_for("agent-broadcast"), json=broadcast,
+                                     headers={**headers, "x-operator-token": "guess"})
+        assert response.status_code == HTTP_403_FORBIDDEN
+
+        response = await client.post(app.url_path_for("agent-broadcast"), json={**broadcast, "online": False, "session_ids": []},
+                                     headers={**headers, "x-operator-token": "operator-secret"})
+        assert response.status_code == 201
+
+    @pytest.mark.asyncio
+    async def test_presence_sessions_require_operator(self, app, client, monkeypatch):
+        async def mock_online(*args, **kwargs):
+            return {"online": 2, "sessions": ["s1", "s2"], "nodes": {"node-a": 2}}
+
+        monkeypatch.setattr(PresenceRegistry, 'online', mock_online)
+        monkeypatch.setattr(auth, 'OPERATOR_TOKEN', Secret("operator-secret"))
+        headers = {"x-session-id": "f9eb7ff2-eed0-4c0a-83ba-b0503b59a5cc", "user-agent": "Mozilla/5.0"}
+
+        response = await client.get(app.url_path_for("presence"), headers=headers)
+        assert response.json() == {"online": 2, "nodes": 1}
+
+        response = await client.get(app.url_path_for("agent-presence"), headers=headers)
+        assert response.status_code == HTTP_403_FORBIDDEN
+
+        response = await client.get(app.url_path_for("agent-presence"),
+                                    headers={**headers, "x-operator-token": "operator-secret"})
+        assert response.json()["sessions"] == ["s1", "s2"]
+
+    @pytest.mark.asyncio
+    async def test_query_stats_require_operator(self, app, client, monkeypatch):
+        monkeypatch.setattr(auth, 'OPERATOR_TOKEN', Secret("operator-secret"))
+        headers = {"x-session-id": "f9eb7ff2-eed0-4c0a-83ba-b0503b59a5cc", "user-agent": "Mozilla/5.0"}
+
+        response = await client.get(app.url_path_for("query-stats"), headers=headers)
+        assert response.status_code == HTTP_403_FORBIDDEN
+
+        response = await client.get(app.url_path_for("query-stats"),
+                                    headers={**headers, "x-operator-token": "operator-secret"})
+        assert response.status_code == 200
+
     @pytest.mark.asyncio
     async def test_chat_websocket(self, app: FastAPI, monkeypatch):
         os.environ["TESTING"] = "1"
@@ -120,3 +228,35 @@ class TestTools:
             data = json.loads(js)
             assert data['foo'] in ['bar', 'zulu']
 
+
+    def test_json_fixer_keeps_order_and_duplicates(self):
+        frames = tools.json_fixer('{"n": 1} {"n": 2}\n{"n": 1}')
+        assert [json.loads(js)['n'] for js in frames] == [1, 2, 1]
+
+    def test_stream_decoder_strings(self):
+        decoder = tools.JSONStreamDecoder()
+        glued = '{"text": "a } brace \\" and {"}[1, {"k": "\\\\"}]'
+
+        assert decoder.feed(glued) == [{"text": 'a } brace " and {'}, [1, {"k": "\\"}]]
+
+    def test_stream_decoder_chunks(self):
+        decoder = tools.JSONStreamDecoder()
+        encoded = '{"message": "Привет \\"villa\\""}{"message": "ok"}'.encode()
+
+        decoded = []
+        for i in range(len(encoded)):
+            decoded.extend(decoder.feed(encoded[i:i + 1]))
+        decoder.close()
+        assert [data['message'] for data in decoded] == ['Привет "villa"', 'ok']
+
+    def test_stream_decoder_limits(self):
+        decoder = tools.JSONStreamDecoder(max_frame_size=16)
+        with pytest.raises(ValueError):
+            decoder.feed('{"message": "' + 'x' * 32)
+
+        assert decoder.feed('{"n": 1}') == [{"n": 1}]
+        with pytest.raises(ValueError):
+            decoder.feed('garbage')
+        decoder.feed('{"n": ')
+        with pytest.raises(ValueError):
+            decoder.close()
@@ -0,0 +1,181 @@
+import asyncio
+import json
+
+import pytest
+from databases import Database
+
+from db.repositories.writer import MessageWriter
+from tests.fakes import FakeRedis, FakeDatabase
+
+
+class FlakyDatabase(FakeDatabase):
+    """
+    Fails the first ``outages`` statements like a database that is down.
+    """
+
+    def __init__(self, outages):
+        super().__init__()
+        self.outages = outages
+
+    async def execute(self, query, values=None):
+        if self.outages:
+            self.outages -= 1
+            raise ConnectionRefusedError("database is down")
+        return await super().execute(query, values)
+
+
+class GatedDatabase(FakeDatabase):
+    """
+    Holds the first statement until ``gate`` is set, then fails it.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.gate = asyncio.Event()
+        self.failed = False
+
+    async def execute(self, query, values=None):
+        if not self.failed:
+            await self.gate.wait()
+            self.failed = True
+            raise ConnectionRefusedError("database is down")
+        return await super().execute(query, values)
+
+
+def message(i, direction='IN'):
+    return {"name": "-", "chat_id": 1, "message": f"message {i}", "direction": direction,
+            "created_at": 1650000000 + i, "avatar": None}
+
+
+class TestMessageWriter:
+
+    @pytest.mark.asyncio
+    async def test_flush_on_batch_size(self):
+        db = FakeDatabase()
+        writer = MessageWriter(db, FakeRedis(), batch_size=3, interval=10)
+        await writer.start()
+
+        for i in range(3):
+            await writer.write(message(i))
+        await asyncio.sleep(0.01)
+
+        assert len(db.calls) == 1
+        query, values = db.calls[0]
+        assert query.count("(:name_") == 3
+        assert values["message_2"] == "message 2"
+        await writer.stop()
+
+    @pytest.mark.asyncio
+    async def test_stop_flushes_everything(self):
+        db, redis = FakeDatabase(), FakeRedis()
+        writer = MessageWriter(db, redis, batch_size=2, interval=10)
+        await writer.start()
+        writer.flusher.cancel()
+
+        for i in range(5):
+            await writer.write(message(i))
+        await writer.stop()
+
+        assert sum(query.count("(:name_") for query, _ in db.calls) == 5
+        assert redis.lists[writer.journal] == []
+        assert writer.token not in redis.sets[MessageWriter.JOURNALS_KEY]
+
+    @pytest.mark.asyncio
+    async def test_adopts_orphaned_journal(self):
+        db, redis = FakeDatabase(), FakeRedis()
+        await redis.sadd(MessageWriter.JOURNALS_KEY, "dead")
+        await redis.rpush(f"{MessageWriter.JOURNAL_KEY}dead", json.dumps(message(0)), json.dumps(message(1)))
+
+        writer = MessageWriter(db, redis, batch_size=10, interval=10)
+        await writer.start()
+        await writer.flush()
+
+        assert db.calls[0][1]["message_0"] == "message 0"
+        assert "dead" not in redis.sets[MessageWriter.JOURNALS_KEY]
+        await writer.stop()
+
+    @pytest.mark.asyncio
+    async def test_failing_flush_while_adopted(self):
+        redis, db = FakeRedis(), GatedDatabase()
+        owner = MessageWriter(db, redis, batch_size=100, interval=10)
+        await owner.start()
+        owner.flusher.cancel()
+        for i in range(3):
+            await owner.write(message(i))
+        flush = asyncio.ensure_future(owner.flush())
+        await asyncio.sleep(0.01)
+
+        # the owner looks dead while its insert hangs
+        await redis.delete(f"{owner.journal}:alive")
+        survivor = MessageWriter(FakeDatabase(), redis, batch_size=100, interval=10)
+        await survivor.start()
+        survivor.flusher.cancel()
+        await owner.write(message(3))
+        db.gate.set()
+        with pytest.raises(ConnectionRefusedError):
+            await flush
+
+        assert await owner.flush() == 1
+        assert await survivor.flush() == 3
+        assert [values["message_0"] for _, values in db.calls] == ["message 3"]
+        assert [values["message_2"] for _, values in survivor.db.calls] == ["message 2"]
+        await owner.stop()
+        await survivor.stop()
+
+    @pytest.mark.asyncio
+    async def test_multi_row_insert(self, tmp_path):
+        database = Database(f"sqlite:///{tmp_path}/messages.db")
+        await database.connect()
+        await database.execute("CREATE TABLE tropico_messages (id INTEGER PRIMARY KEY, name TEXT, message TEXT, "
+                               "chat_id INTEGER, direction TEXT, created_at INTEGER, avatar TEXT)")
+
+        await MessageWriter(database, FakeRedis()).insert([message(0), message(1, direction='OUT')])
+
+        rows = await database.fetch_all("SELECT message, direction FROM tropico_messages ORDER BY id")
+        assert [tuple(row) for row in rows] == [("message 0", "IN"), ("message 1", "OUT")]
+        await database.disconnect()
+
+    @pytest.mark.asyncio
+    async def test_outage_keeps_journal(self):
+        db, redis = FlakyDatabase(outages=6), FakeRedis()
+        writer = MessageWriter(db, redis, batch_size=100, interval=10)
+        await writer.start()
+        writer.flusher.cancel()
+
+        for i in range(10):
+            await writer.write(message(i))
+        for _ in range(6):
+            with pytest.raises(ConnectionRefusedError):
+                await writer.flush()
+
+        assert len(redis.lists[writer.processing]) == 10
+        assert await writer.flush() == 10
+        assert sum(query.count("(:name_") for query, _ in db.calls) == 10
+        assert MessageWriter.DEAD_LETTER_KEY not in redis.lists
+        await writer.stop()
+
+    @pytest.mark.asyncio
+    async def test_rejected_rows_are_dead_lettered(self, tmp_path):
+        database = Database(f"sqlite:///{tmp_path}/messages.db")
+        await database.connect()
+        await database.execute("CREATE TABLE tropico_messages (id INTEGER PRIMARY KEY, name TEXT, message TEXT, "
+                               "chat_id INTEGER NOT NULL, direction TEXT, created_at INTEGER, avatar TEXT)")
+        redis = FakeRedis()
+        writer = MessageWriter(database, redis, batch_size=10, interval=10)
+        await writer.start()
+        writer.flusher.cancel()
+
+        await writer.write(message(0))
+        await writer.write({**message(1), "chat_id": None})
+        await writer.write(message(2))
+        assert await writer.flush() == 3
+
+        rows = await database.fetch_all("SELECT message FROM tropico_messages ORDER BY id")
+        assert [row['message'] for row in rows] == ["message 0", "message 2"]
+        assert [json.loads(row)['message'] for row in redis.lists[MessageWriter.DEAD_LETTER_KEY]] == ["message 1"]
+
+        assert await writer.requeue_dead_letters() == 1
+        assert MessageWriter.DEAD_LETTER_KEY not in redis.lists
+        assert [json.loads(row)['message'] for row in redis.lists[writer.journal]] == ["message 1"]
+        await writer.stop()
+        await database.disconnect()